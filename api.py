@@ -0,0 +1,191 @@
+# Versioned JSON API (/api/v1) over the same queries as the HTML pages
+import hashlib
+import json
+from datetime import datetime, timezone
+from functools import wraps
+
+from flask import Blueprint, Response, abort, current_app, request
+from werkzeug.exceptions import HTTPException
+from werkzeug.http import is_resource_modified
+
+import cache
+import matching
+import queries
+from auth import current_user
+from db import get_db
+from images import responsive_sources
+from storage import get_storage
+
+api = Blueprint('api', __name__, url_prefix='/api/v1')
+
+# Largest page a client may ask for with ?limit=
+MAX_LIMIT = 100
+
+# Field names of each resource, in the column order of the matching queries.py rows
+EVENT_FIELDS = ('event_id', 'date', 'time', 'venue', 'description', 'status', 'organizer')
+MUSICIAN_BOOKING_FIELDS = ('event_id', 'date', 'time', 'venue', 'description', 'organizer')
+ORGANIZATION_BOOKING_FIELDS = ('event_id', 'date', 'time', 'venue', 'description', 'musician_id', 'musician')
+PROFILE_FIELDS = ('username', 'email', 'user_type', 'profile_info')
+SUGGESTION_FIELDS = ('musician_id', 'username', 'score')
+IMAGE_FIELDS = ('url', 'date', 'venue', 'musician', 'image_id', 'width', 'height', 'sources')
+
+
+def dumps(payload):
+    # Compact JSON: no whitespace, and non-ASCII text as UTF-8 rather than \u escapes
+    return json.dumps(payload, separators=(',', ':'), ensure_ascii=False)
+
+
+def selected_fields(available):
+    # ?fields=a,b,c picks a subset of a resource's fields; unknown names are an error rather than silently dropped
+    fields = request.args.get('fields')
+    if not fields:
+        return available
+    wanted = [field for field in fields.split(',') if field]
+    unknown = sorted(set(wanted) - set(available))
+    if unknown:
+        abort(400, f"Unknown fields: {', '.join(unknown)}")
+    return [field for field in available if field in wanted]
+
+
+def serialize(rows, available):
+    # Turn query rows into dicts holding only the selected fields
+    fields = selected_fields(available)
+    indexes = [available.index(field) for field in fields]
+    return [{field: row[i] for field, i in zip(fields, indexes)} for row in rows]
+
+
+def page_limit():
+    limit = request.args.get('limit', queries.PAGE_SIZE, type=int)
+    return max(1, min(limit, MAX_LIMIT))
+
+
+def endpoint(*generations, public=False, per_user=False):
+    # Wrap a view returning a JSON-able payload. The response's ETag and Last-Modified come from the generation
+    # stamps of the data sets it is built from (cache.stamp, kept in memory for STAMP_TTL), so a client that already
+    # has the current version gets a 304 before the view runs any query.
+    def decorator(view):
+        @wraps(view)
+        def wrapped(*args, **kwargs):
+            user = None if public else current_user()
+            if not public and user is None:
+                abort(401, "Not logged in")
+
+            ttl = current_app.config.get('API_STAMP_TTL', cache.STAMP_TTL)
+            stamps = [cache.stamp(name, ttl) for name in generations]
+            key = [request.full_path, [generation for generation, _ in stamps], user['id'] if per_user else None]
+            etag = hashlib.sha1(dumps(key).encode()).hexdigest()[:20]
+            last_modified = datetime.fromtimestamp(int(max(updated_at for _, updated_at in stamps)), timezone.utc)
+
+            if is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+                response = Response(dumps(view(*args, **kwargs)), mimetype='application/json')
+            else:
+                response = Response(status=304)
+            response.set_etag(etag)
+            response.last_modified = last_modified
+            # Clients may keep the response but must revalidate it (cheaply, see above) before each use
+            response.cache_control.no_cache = True
+            if public:
+                response.cache_control.public = True
+            else:
+                response.cache_control.private = True
+                response.vary.add('Cookie')
+            return response
+        return wrapped
+    return decorator
+
+
+@api.errorhandler(HTTPException)
+def api_error(e):
+    return Response(dumps({'error': e.description}), status=e.code, mimetype='application/json')
+
+
+@api.route('/events')
+@endpoint('events', 'users')
+def events():
+    # Pending events, filtered like the musician dashboard (?date_from=, ?date_to=, ?venue=)
+    rows, next_cursor = queries.available_events(
+        get_db().cursor(), after=request.args.get('cursor'), limit=page_limit(),
+        date_from=request.args.get('date_from') or None, date_to=request.args.get('date_to') or None,
+        venue=request.args.get('venue') or None)
+    return {'data': serialize(rows, EVENT_FIELDS), 'next_cursor': next_cursor}
+
+
+@api.route('/events/<int:event_id>')
+@endpoint('events', 'users')
+def event(event_id):
+    row = queries.event_detail(get_db().cursor(), event_id)
+    if row is None:
+        abort(404, "Event not found")
+    return {'data': serialize([row], EVENT_FIELDS)[0]}
+
+
+@api.route('/bookings')
+@endpoint('events', 'users', per_user=True)
+def bookings():
+    # A musician's confirmed bookings, or the confirmed bookings for an organization's events
+    user = current_user()
+    cursor = get_db().cursor()
+    after = request.args.get('cursor')
+    if user['user_type'] == 'organization':
+        rows, next_cursor = queries.organization_bookings(cursor, user['id'], after=after, limit=page_limit())
+        fields = ORGANIZATION_BOOKING_FIELDS
+    else:
+        rows, next_cursor = queries.confirmed_events(cursor, user['id'], after=after, limit=page_limit())
+        fields = MUSICIAN_BOOKING_FIELDS
+    return {'data': serialize(rows, fields), 'next_cursor': next_cursor}
+
+
+@api.route('/recommendations')
+@endpoint('events', 'users', per_user=True)
+def recommendations():
+    # Open events ranked for the logged-in musician (best first, with their scores)
+    user = current_user()
+    if user['user_type'] != 'musician':
+        abort(403, "Recommendations are for musicians")
+    ranked = matching.recommended_events(user['id'], page_limit())
+    scores = dict(ranked)
+    rows = queries.events_by_id(get_db().cursor(), [event_id for event_id, _ in ranked])
+    rows = [row + (round(scores[row[0]], 4),) for row in rows]
+    return {'data': serialize(rows, EVENT_FIELDS + ('score',))}
+
+
+@api.route('/events/<int:event_id>/suggestions')
+@endpoint('events', 'users', per_user=True)
+def suggestions(event_id):
+    # Musicians ranked for one of the logged-in organization's open events
+    user = current_user()
+    row = get_db().execute("SELECT OrganizerUserID FROM Events WHERE EventID = ?", (event_id,)).fetchone()
+    if row is None:
+        abort(404, "Event not found")
+    if row[0] != user['id']:
+        abort(403, "Not your event")
+    ranked = matching.suggested_musicians([event_id], page_limit()).get(event_id, [])
+    names = queries.usernames(get_db().cursor(), [musician_id for musician_id, _ in ranked])
+    rows = [(musician_id, names[musician_id], round(score, 4)) for musician_id, score in ranked if musician_id in names]
+    return {'data': serialize(rows, SUGGESTION_FIELDS)}
+
+
+@api.route('/profiles/<int:user_id>')
+@endpoint('users')
+def profile(user_id):
+    row = queries.user_profile(get_db().cursor(), user_id)
+    if row is None:
+        abort(404, "User not found")
+    return {'data': serialize([row], PROFILE_FIELDS)[0]}
+
+
+@api.route('/gallery')
+@endpoint('gallery', public=True)
+def gallery():
+    # Gallery images newest first, with the srcset of each rendition format under 'sources'
+    conn = get_db()
+    rows, next_cursor = queries.gallery_images(conn.cursor(), venue=request.args.get('venue') or None,
+                                               after=request.args.get('cursor'), limit=page_limit())
+    storage = get_storage()
+    sources = responsive_sources(conn, [row[4] for row in rows])
+    rows = [(storage.url(row[0]),) + row[1:] + (sources.get(row[4], {}),) for row in rows]
+    return {'data': serialize(rows, IMAGE_FIELDS), 'next_cursor': next_cursor}
+
+
+def init_app(app):
+    app.register_blueprint(api)
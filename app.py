@@ -1,33 +1,250 @@
 # Import necessary modules
-from flask import Flask, flash, render_template, request, redirect, url_for, session, send_from_directory
-from flask_session import Session
-from werkzeug.security import check_password_hash, generate_password_hash
-from werkzeug.utils import secure_filename
-import secrets
+from flask import Flask, Response, current_app, flash, g, render_template, request, redirect, url_for, session, send_from_directory, jsonify, abort
+from markupsafe import Markup
+from werkzeug.security import safe_join
+from auth import (HasherBusy, check_password, current_user, hash_password, login_required, login_user,
+                  refresh_principal, registration_error, throttled, init_app as init_auth)
+from db import get_db, get_pool, init_app as init_db
+from migrate import init_app as init_migrations
+import api
+import bookings
+import bulk
+import cache
+import feed
+import health
+import images as image_pipeline
+import instrumentation
+import jobs
+import lifecycle
+import matching
+import notifications  # Registers the email task handlers
+import mimetypes
+import queries
+import rendering
+import search
+import sessions
+import storage
 import sqlite3
 import re
 import os
+from datetime import date
+
+# The site's pages: @route collects each view with its URL rule, and create_app() adds them to every application it
+# builds under the view's own name, so url_for('home') in the views and templates keeps working
+ROUTES = []
+
+
+def route(rule, **options):
+    def register(view):
+        ROUTES.append((rule, view, options))
+        return view
+    return register
+
+
+def configure(app, config=None):
+    # Defaults first (several can be set with CRESCENDO_* environment variables), then the Python settings file named
+    # by CRESCENDO_SETTINGS, then the mapping passed to create_app()
+
+    # Define the path to the SQLite database file (CRESCENDO_DATABASE points the app at another one, e.g. a seeded
+    # benchmark database)
+    app.config['DATABASE'] = os.environ.get('CRESCENDO_DATABASE', os.path.join(app.root_path, 'crescendo.db'))
+
+    # Size of the shared connection pool and how long a request waits for a free connection
+    app.config['DB_POOL_SIZE'] = 8
+    app.config['DB_POOL_TIMEOUT'] = 5.0
+
+    # Log as JSON lines written by a background thread, time every request and pooled SQL statement (exported at
+    # /metrics), log statements slower than SLOW_QUERY_MS with their query plan, and profile requests that send the
+    # X-Crescendo-Profile header when CRESCENDO_PROFILER=1
+    app.config['LOG_LEVEL'] = os.environ.get('CRESCENDO_LOG_LEVEL', 'INFO')
+    app.config['ACCESS_LOG'] = os.environ.get('CRESCENDO_ACCESS_LOG', '1') == '1'
+    app.config['SLOW_QUERY_MS'] = 100
+    app.config['PROFILER_ENABLED'] = os.environ.get('CRESCENDO_PROFILER') == '1'
+    # /metrics, /stats/db and /stats/cache are off unless CRESCENDO_STATS=1, and then need an
+    # "Authorization: Bearer <CRESCENDO_STATS_TOKEN>" header when a token is set
+    app.config['STATS_ENABLED'] = os.environ.get('CRESCENDO_STATS') == '1'
+    app.config['STATS_TOKEN'] = os.environ.get('CRESCENDO_STATS_TOKEN')
+
+    # Apply pending schema migrations at startup
+    app.config['AUTO_MIGRATE'] = True
+
+    # Keep sessions server-side, in the Sessions table ('sqlite') or a cachelib directory ('cachelib'), under a
+    # secret key shared by every worker (CRESCENDO_SECRET_KEY, or one generated once into the instance folder)
+    app.config['SESSION_BACKEND'] = os.environ.get('CRESCENDO_SESSION_BACKEND', 'sqlite')
+    app.config['SESSION_DIR'] = os.environ.get('CRESCENDO_SESSION_DIR')
+
+    # Hash passwords in PASSWORD_HASH_WORKERS processes (0 hashes on the request thread) with at most
+    # PASSWORD_HASH_QUEUE hashes pending per server process; a login that finds no free slot within
+    # PASSWORD_HASH_TIMEOUT seconds gets a 503. Stored hashes made with another method or cost are upgraded at the
+    # user's next login.
+    app.config['PASSWORD_HASH_METHOD'] = os.environ.get('CRESCENDO_PASSWORD_HASH', 'scrypt:32768:8:1')
+    app.config['PASSWORD_HASH_WORKERS'] = int(os.environ.get('CRESCENDO_HASH_WORKERS',
+                                                             max(1, (os.cpu_count() or 2) // 2)))
+    app.config['PASSWORD_HASH_QUEUE'] = 16
+    app.config['PASSWORD_HASH_TIMEOUT'] = 1.0
+    # Token-bucket limits, as (burst, seconds to regain it), checked before any hashing: logins per IP address and
+    # per username, registrations per IP address. Buckets live in the RateLimits table ('sqlite') or in each process
+    # ('memory').
+    app.config['RATE_LIMIT_ENABLED'] = os.environ.get('CRESCENDO_RATE_LIMIT', '1') == '1'
+    app.config['RATE_LIMIT_BACKEND'] = os.environ.get('CRESCENDO_RATE_LIMIT_BACKEND', 'sqlite')
+    app.config['RATE_LIMITS'] = {
+        'login_ip': (20, 60),
+        'login_username': (5, 60),
+        'register_ip': (5, 600),
+    }
+
+    # Background job worker threads per server process
+    app.config['JOBS_WORKERS'] = 2
+
+    # Each process's notification broker also polls for other processes' notifications every FEED_POLL_INTERVAL
+    # seconds
+    app.config['FEED_POLL_INTERVAL'] = 1.0
+
+    # API ETags are checked against generation counters cached for API_STAMP_TTL seconds
+    app.config['API_STAMP_TTL'] = 1.0
+
+    # Recommend events to musicians, and musicians for organizations' open requests, from a TF-IDF index each process
+    # keeps in memory (needs NumPy) and updates from the MatchingChanges log at most every MATCHING_REFRESH_INTERVAL
+    # seconds
+    app.config['MATCHING_ENABLED'] = os.environ.get('CRESCENDO_MATCHING', '1') == '1'
+    app.config['MATCHING_DIMENSIONS'] = 1024
+    app.config['MATCHING_REFRESH_INTERVAL'] = 1.0
+
+    # Every LIFECYCLE_INTERVAL seconds (0 turns it off) a background job marks past events completed or expired,
+    # moves events finished more than ARCHIVE_AFTER_DAYS ago to ARCHIVE_DATABASE (by default next to DATABASE),
+    # deletes orphaned gallery images and files, prunes old notifications and jobs, and vacuums and analyzes the hot
+    # tables (see `flask lifecycle`)
+    app.config['LIFECYCLE_INTERVAL'] = int(os.environ.get('CRESCENDO_LIFECYCLE_INTERVAL', 15 * 60))
+    app.config['ARCHIVE_DATABASE'] = os.environ.get('CRESCENDO_ARCHIVE_DATABASE')
+    app.config['ARCHIVE_AFTER_DAYS'] = 365
+    app.config['NOTIFICATION_RETENTION_DAYS'] = 90
+    app.config['JOB_RETENTION_DAYS'] = 30
+
+    # Serve uploads from the 'uploads' directory in the static folder
+    app.config['UPLOAD_FOLDER'] = os.path.join(app.static_folder, 'uploads')
+
+    # Reject request bodies over 16 MB before they are read, so oversized uploads can't exhaust worker memory
+    app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024
+
+    # Where uploads are stored: 'local' (under static/) or 's3' (with S3_BUCKET and optionally S3_ENDPOINT_URL)
+    app.config['STORAGE_BACKEND'] = os.environ.get('CRESCENDO_STORAGE', 'local')
+    app.config['S3_BUCKET'] = os.environ.get('CRESCENDO_S3_BUCKET')
+    app.config['S3_ENDPOINT_URL'] = os.environ.get('CRESCENDO_S3_ENDPOINT_URL')
+
+    # Browser cache lifetime (seconds) for uploads that aren't content-addressed; they are revalidated by ETag
+    app.config['UPLOADS_MAX_AGE'] = 24 * 60 * 60
+
+    # Let a front proxy send the file body: X-Sendfile (Apache/lighttpd) or X-Accel-Redirect to an internal nginx
+    # location that maps onto static/uploads, e.g. CRESCENDO_ACCEL_REDIRECT=/_uploads/
+    app.config['USE_X_SENDFILE'] = os.environ.get('CRESCENDO_X_SENDFILE') == '1'
+    app.config['UPLOADS_ACCEL_REDIRECT'] = os.environ.get('CRESCENDO_ACCEL_REDIRECT')
+
+    # Size of the in-process fragment cache; set CACHE_DIR (same host) or CACHE_REDIS_URL (any host) to share
+    # rendered fragments between worker processes
+    app.config['CACHE_MAX_BYTES'] = 8 * 1024 * 1024
+    app.config['CACHE_DIR'] = os.environ.get('CRESCENDO_CACHE_DIR')
+    app.config['CACHE_REDIS_URL'] = os.environ.get('CRESCENDO_CACHE_REDIS_URL')
+
+    # Compress HTML and JSON responses (Brotli when the brotli package is installed, otherwise gzip)
+    app.config['COMPRESS_RESPONSES'] = os.environ.get('CRESCENDO_COMPRESS', '1') == '1'
+
+    app.config.from_envvar('CRESCENDO_SETTINGS', silent=True)
+    if config:
+        app.config.update(config)
+    if not app.config['ARCHIVE_DATABASE']:
+        app.config['ARCHIVE_DATABASE'] = os.path.splitext(app.config['DATABASE'])[0] + '-archive.db'
+
+
+def create_app(config=None):
+    # Build a configured application with every component and page registered. The startup work (migrations, the
+    # secret key, the instance and cache directories) happens here, once per process, or once in all under gunicorn's
+    # preload_app (see gunicorn.conf.py); connections, threads and hashing processes start in each worker as needed.
+    app = Flask(__name__)
+    configure(app, config)
+
+    # JSON logs, request and SQL metrics, the slow-query log and the profiler
+    instrumentation.init_app(app)
+
+    # Hand out pooled connections per request and return them on teardown
+    init_db(app)
+
+    # Apply pending schema migrations and register the `flask db` commands
+    init_migrations(app)
+
+    # Server-side sessions, password hashing and rate limits
+    sessions.init_app(app)
+    init_auth(app)
+
+    # Register the `flask images` commands (renditions for existing uploads)
+    image_pipeline.init_app(app)
+
+    # Run queued background jobs (image renditions, emails) on worker threads, and register the `flask jobs` commands
+    jobs.init_app(app)
+
+    # Register the `flask data` commands (bulk import/export of users and events)
+    bulk.init_app(app)
+
+    # Push notifications to open pages over Server-Sent Events
+    feed.init_app(app)
 
-# Initialize a Flask application instance
-app = Flask(__name__)
+    # Serve the JSON API under /api/v1
+    api.init_app(app)
 
-# Generate a random 32-character hexadecimal string as a secret key
-secret_key = secrets.token_hex(16)
-app.secret_key = secret_key  # Set the secret key for the Flask application
+    # Event and musician recommendations
+    matching.init_app(app)
 
-# Define the path to the SQLite database file
-DATABASE = './crescendo.db'
+    # Complete, archive and clean up past events (and register the `flask lifecycle` commands)
+    lifecycle.init_app(app)
+
+    # Load compiled templates from instance/jinja_cache instead of recompiling them in every worker, and compress
+    # responses
+    rendering.init_app(app)
+
+    # Liveness and readiness probes for the process manager or load balancer
+    health.init_app(app)
+
+    # The pages, the oversized-upload error page, and the template helper linking to an upload wherever the storage
+    # backend keeps it
+    for rule, view, options in ROUTES:
+        app.add_url_rule(rule, view_func=view, **options)
+    app.register_error_handler(413, upload_too_large)
+    app.jinja_env.globals['upload_url'] = lambda path: storage.get_storage().url(path)
+    return app
+
+
+def start_worker(app):
+    # Per-process startup, run in each server worker before it takes requests (gunicorn's post_worker_init): open a
+    # pooled connection (applying the pragmas), start the log listener and build the recommendation index, so the
+    # first requests don't pay for them
+    with app.app_context():
+        instrumentation.ensure_log_listener(app)
+        get_db()
+        matching.get_index(app)
+
+
+def shutdown(app, timeout=None):
+    # Let this process's job workers finish the job they are running (for up to timeout seconds) and stop its
+    # password hashing processes; jobs cut off here are picked up again once their lease expires
+    pool = app.extensions.get('job_workers')
+    if pool is not None and pool.pid == os.getpid():
+        pool.stop(timeout)
+    app.extensions['password_hasher'].shutdown()
+
+
+# Recommendations shown on the musician dashboard, and musicians suggested per open request
+RECOMMENDED_EVENTS = 5
+SUGGESTED_MUSICIANS = 3
 
 
 # Define a route for the landing page
-@app.route('/')
+@route('/')
 def landingpage():
     # Render and return the 'landingpage.html' template
     return render_template('landingpage.html')
 
 
 # Define a route for user registration with support for GET and POST methods
-@app.route('/register', methods=['GET', 'POST'])
+@route('/register', methods=['GET', 'POST'])
 def register():
     # Check if the request method is POST (form submission)
     if request.method == 'POST':
@@ -40,37 +257,46 @@ def register():
         # Optional profile information
         profile_info = request.form.get('profile_info', '')
 
-        # Username validation: No spaces and must be alphanumeric
-        if " " in username or not re.match(r"^\w+$", username):
-            return "Username must not contain spaces and must be alphanumeric", 400
+        # Username validation (no spaces, alphanumeric) and password validation (8+ characters with a number and
+        # an uppercase letter); the same rules apply to `flask data import users`
+        error = registration_error(username, password)
+        if error:
+            return error, 400
 
-        # Password validation: Minimum 8 characters, must include a number and an uppercase letter
-        if not re.match(r"^(?=.*[A-Z])(?=.*\d).{8,}$", password):
-            return "Password must be at least 8 characters long, contain a number and an uppercase letter", 400
+        # Each registration costs a password hash, so addresses are limited before any work is done
+        wait = throttled(('register_ip', request.remote_addr))
+        if wait is not None:
+            return "Too many registrations from this address. Please try again later.", 429, {'Retry-After': str(wait)}
 
-        # Hash the password for secure storage
-        hashed_password = generate_password_hash(password)
-
-        # Connect to the database
-        conn = sqlite3.connect(DATABASE)
+        # Borrow a pooled connection to the database
+        conn = get_db()
         cursor = conn.cursor()
 
         try:
-            # Check if the username or email already exists in the database
+            # Check if the username or email already exists in the database (answered from the unique indexes)
             cursor.execute(
-                "SELECT * FROM Users WHERE Username = ? OR Email = ?", (username, email))
+                "SELECT 1 FROM Users WHERE Username = ? OR Email = ? LIMIT 1", (username, email))
             if cursor.fetchone():
                 return "Username or email already exists", 400
 
+            # Hash the password for secure storage (in the hashing processes)
+            hashed_password = hash_password(password)
+
             # Insert the new user into the database
             cursor.execute("INSERT INTO Users (Username, Password, Email, UserType, ProfileInformation) VALUES (?, ?, ?, ?, ?)",
                            (username, hashed_password, email, user_type, profile_info))
+            # New profiles show up in the API
+            cache.invalidate(conn, 'users')
             conn.commit()  # Commit the changes to the database
-        except sqlite3.Error as e:
-            print(e)  # Print the error for debugging
+        except sqlite3.IntegrityError:
+            # Another registration claimed the username or email between the check and the insert
+            return "Username or email already exists", 400
+        except HasherBusy:
+            return "The server is busy. Please try again in a moment.", 503, {'Retry-After': '1'}
+        except sqlite3.Error:
+            conn.rollback()
+            current_app.logger.exception("Registering user %s failed", username)
             return "An error occurred", 500  # Return an error response
-        finally:
-            conn.close()  # Close the database connection
 
         # Redirect the user to the login page upon successful registration
         return redirect(url_for('login'))
@@ -80,24 +306,31 @@ def register():
 
 
 # Define a route for login (with support for both GET and POST methods)
-@app.route('/login', methods=['GET', 'POST'])
+@route('/login', methods=['GET', 'POST'])
 def login():
     # Check if the request method is POST (form submission)
     if request.method == 'POST':
         username = request.form['username']
         password = request.form['password']
-        # Connect to the database
-        conn = sqlite3.connect(DATABASE)
+
+        # Refuse guessing from one address, or at one account, before looking anything up or hashing
+        wait = throttled(('login_ip', request.remote_addr), ('login_username', username.lower()))
+        if wait is not None:
+            error_message = f"Too many login attempts. Please try again in {wait} seconds."
+            return render_template('login.html', error=error_message), 429, {'Retry-After': str(wait)}
+
+        # Borrow a pooled connection to the database
+        conn = get_db()
         cursor = conn.cursor()
 
         # Fetch the user record from the database
         try:
             cursor.execute("SELECT * FROM Users WHERE username=?", (username,))
             user = cursor.fetchone()
-            # Check if the user exists and the password is correct
-            if user and check_password_hash(user[2], password):
-                session['user_id'] = user[0]  # Store user ID in session
-                session['user_type'] = user[4]
+            # Check if the user exists and the password is correct (upgrading a hash made with older parameters)
+            if user and check_password(user[0], user[2], password):
+                # Store the user ID and the principal (name and type) in a fresh session
+                login_user(user[0], user[1], user[4])
                 # Redirect to home page after successful login
                 return redirect(url_for('home'))
             else:
@@ -105,64 +338,61 @@ def login():
                 error_message = "Invalid username or password."
                 # Render and return 'login.html' template with an error message
                 return render_template('login.html', error=error_message)
-        except sqlite3.Error as e:
+        except HasherBusy:
+            error_message = "The server is busy. Please try again in a moment."
+            return render_template('login.html', error=error_message), 503, {'Retry-After': '1'}
+        except sqlite3.Error:
             # Return an error message if an error occurs while fetching the user record
-            print(e)
+            current_app.logger.exception("Looking up user %s failed", username)
             error_message = "A database error occurred."
             return render_template('login.html', error=error_message)
-        finally:
-            conn.close()
     else:
         # Render and return the 'login.html' template for GET requests
         return render_template('login.html')
 
 
 # Define a route for the home page (Performer Dashboard)
-@app.route('/home')
+@route('/home')
+@login_required
 def home():
-    # Check if the user ID is stored in the session
-    if 'user_id' not in session:
-        print("User ID not in session")
-        return redirect(url_for('login'))
-    else:
-        # User ID is stored in the session
-        # Debugging purposes
-        print(f"User ID in session: {session['user_id']}")
-
-    # Fetch the user record from the database
-    user_id = session['user_id']
-    conn = sqlite3.connect(DATABASE)
+    # The user type (performer or organization) comes from the session's principal, not a query
+    user_id = g.user['id']
+    user_type = g.user['user_type']
+    conn = get_db()
     cursor = conn.cursor()
 
-    # Determine the user type (performer or organization)
-    cursor.execute("SELECT UserType FROM Users WHERE UserID = ?", (user_id,))
-    user_type = cursor.fetchone()[0]
-
     if user_type == 'musician':
-        # Fetch available events for musicians
-        cursor.execute("""
-            SELECT e.EventID, e.Date, e.Time, e.Venue, e.Description, e.Status, 
-                   (SELECT Username FROM Users WHERE UserID = e.OrganizerUserID) as OrganizerName
-            FROM Events e
-            WHERE e.Status = 'pending'
-        """)
-        available_events = cursor.fetchall()
-
-        # Fetch confirmed events for musicians
-        cursor.execute("""
-            SELECT e.EventID, e.Date, e.Time, e.Venue, e.Description,
-                   (SELECT Username FROM Users WHERE UserID = e.OrganizerUserID) as OrganizerName
-            FROM Events e
-            JOIN Bookings b ON e.EventID = b.EventID
-            WHERE b.MusicianUserID = ? AND b.Status = 'confirmed'
-        """, (user_id,))
-        confirmed_events = cursor.fetchall()
-
-        conn.close()
-        # Check if there is a notification message in the session
-        notification = session.pop('event_notification', None)
-        # Render and return the 'home.html' template passing in the events, confirmed_events, and notification parameters
-        return render_template('home.html', events=available_events, confirmed_events=confirmed_events, notification=notification)
+        # Read the optional date range / venue filters from the query string
+        filters = dashboard_filters()
+
+        # The first page of available events is the same for every musician; it is rendered once per change to
+        # the events (and filter combination) and kept in the fragment cache
+        def render_available():
+            events, available_cursor = queries.available_events(cursor, model=rendering.AvailableEvent, **filters)
+            return render_template('dashboard_available.html', events=events, available_cursor=available_cursor)
+        available_events = rendering.fragment(rendering.dashboard_key(conn, 'available', filters=filters),
+                                              render_available)
+
+        # The first page of the musician's confirmed events, cached until their bookings change
+        def render_confirmed():
+            events, confirmed_cursor = queries.confirmed_events(cursor, user_id, model=rendering.ConfirmedEvent,
+                                                                **filters)
+            return render_template('dashboard_confirmed.html', confirmed_events=events,
+                                   confirmed_cursor=confirmed_cursor)
+        confirmed_events = rendering.fragment(rendering.dashboard_key(conn, 'confirmed', user_id, filters),
+                                              render_confirmed)
+
+        # The open events that best match the musician's profile, past bookings and usual days (none without NumPy)
+        ranked = matching.recommended_events(user_id, RECOMMENDED_EVENTS)
+        recommended_events = [rendering.AvailableEvent(*row)
+                              for row in queries.events_by_id(cursor, [event_id for event_id, _ in ranked])]
+
+        # Show the notifications (e.g. cancellations) the musician hasn't seen yet
+        unseen = unseen_notifications(user_id)
+        # Render and return the 'home.html' template around the two lists (their cursors let the page lazy-load
+        # further rows from /home/events/<section>)
+        return render_template('home.html', available_events=available_events, confirmed_events=confirmed_events,
+                               recommended_events=recommended_events, filters=filters, notifications=unseen)
 
     elif user_type == 'organization':
         # Render organization dashboard
@@ -173,69 +403,118 @@ def home():
         return "Unsupported user type", 400
 
 
+def unseen_notifications(user_id):
+    # A user's unseen notifications, marked as seen now that a dashboard shows them
+    conn = get_db()
+    unseen = [rendering.Notification(*row) for row in feed.unread(conn, user_id)]
+    if unseen:
+        feed.mark_seen(conn, user_id, unseen[0].notification_id)
+        conn.commit()
+    return unseen
+
+
+def dashboard_filters():
+    # Date range and venue filters shared by the dashboard page and its JSON endpoint
+    return {
+        'date_from': request.args.get('date_from') or None,
+        'date_to': request.args.get('date_to') or None,
+        'venue': request.args.get('venue') or None,
+    }
+
+
+# Define a JSON route returning further pages of the musician dashboard lists (used for infinite scroll)
+@route('/home/events/<section>')
+def home_events(section):
+    if current_user() is None:
+        return jsonify(error="Not logged in"), 401
+    if section not in ('available', 'confirmed'):
+        return jsonify(error="Unknown section"), 404
+
+    cursor = get_db().cursor()
+    after = request.args.get('cursor')
+    filters = dashboard_filters()
+
+    if section == 'available':
+        rows, next_cursor = queries.available_events(cursor, after=after, **filters)
+        columns = ('event_id', 'date', 'time', 'venue', 'description', 'status', 'organizer')
+    else:
+        rows, next_cursor = queries.confirmed_events(cursor, g.user['id'], after=after, **filters)
+        columns = ('event_id', 'date', 'time', 'venue', 'description', 'organizer')
+
+    return jsonify(events=[dict(zip(columns, row)) for row in rows], next_cursor=next_cursor)
+
+
+# Define a Server-Sent Events route pushing the logged-in user's notifications as they happen
+@route('/notifications/stream')
+def notification_stream():
+    user = current_user()
+    if user is None:
+        return jsonify(error="Not logged in"), 401
+
+    channels = feed.channels_for(user)
+    broker = feed.get_broker()
+    # Subscribe before reading the backlog so nothing published in between is missed
+    subscription = broker.subscribe(channels)
+
+    # A reconnecting browser sends the last ID it received; replay what it missed
+    after = request.headers.get('Last-Event-ID', type=int) or request.args.get('after', type=int)
+    backlog = []
+    if after is None:
+        after = broker.last_id
+    else:
+        backlog = feed.since(get_db(), channels, after)
+
+    # The request's pooled connection is returned when this view returns, before the stream starts
+    return Response(feed.stream(broker, subscription, backlog, after), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
 # Define a route for applying for an event with GET and POST support
-@app.route('/apply_for_event/<int:event_id>', methods=['GET', 'POST'])
+@route('/apply_for_event/<int:event_id>', methods=['GET', 'POST'])
+@login_required(message="Please log in to apply for events.")
 def apply_for_event(event_id):
-    # Check if the user ID is stored in the session
-    if 'user_id' not in session:
-        flash("Please log in to apply for events.")
-        return redirect(url_for('login'))
-
-    # Fetch the user record from the database
-    user_id = session['user_id']
+    user_id = g.user['id']
 
-    conn = sqlite3.connect(DATABASE)
+    conn = get_db()
     cursor = conn.cursor()
 
-    # Check if the user has already applied for the event
+    # Book the event if it is still pending; when several musicians apply at once only the first one gets it
     if request.method == 'POST':
         try:
-            # Update status in the Events table
-            cursor.execute(
-                "UPDATE Events SET Status = 'confirmed' WHERE EventID = ?", (event_id,))
-
-            # Insert into Bookings table and set status as 'confirmed'
-            cursor.execute("INSERT INTO Bookings (EventID, MusicianUserID, Status, RequestDate) VALUES (?, ?, 'confirmed', CURRENT_DATE)",
-                           (event_id, user_id))
-
-            conn.commit()
+            bookings.apply_for_event(conn, event_id, user_id)
             flash("Application submitted successfully!")
-        except sqlite3.Error as e:
-            # Return an error message if an error occurs while fetching the user record
-            print(e)
+        except bookings.AlreadyTaken:
+            flash("Sorry, this event has already been taken.")
+        except bookings.EventNotFound:
+            flash("Event not found.")
+        except sqlite3.Error:
+            # Return an error message if the booking could not be written (e.g. the database stayed busy)
+            current_app.logger.exception("Booking event %s for user %s failed", event_id, user_id)
             flash("An error occurred while submitting the application.")
-        finally:
-            conn.close()
 
         return redirect(url_for('home'))
 
     # Fetch event details to display
     cursor.execute("SELECT * FROM Events WHERE EventID = ?", (event_id,))
     event = cursor.fetchone()
-    conn.close()
     # Render and return the 'apply_for_event.html' template passing in the events parameter
     return render_template('apply_for_event.html', event=event)
 
 
 # Define a route for logging out
-@app.route('/logout')
+@route('/logout')
 def logout():
-    # Remove the user ID from the session
-    session.pop('user_id', None)
+    # Drop the whole session (user ID and principal) from the store
+    session.clear()
     # Redirect to the landing page
     return redirect(url_for('landingpage'))
 
 
 # Define a route for requesting events with support for POST
-@app.route('/request_event', methods=['POST'])
+@route('/request_event', methods=['POST'])
+@login_required(message="Please log in to request events.")
 def request_event():
-    # Check if the user ID is stored in the session
-    if 'user_id' not in session:
-        flash("Please log in to request events.")
-        return redirect(url_for('login'))
-
-    # Fetch the user record from the database
-    user_id = session['user_id']
+    user_id = g.user['id']
 
     # Retrieve form data
     date = request.form['date']
@@ -243,7 +522,7 @@ def request_event():
     venue = request.form['venue']
     description = request.form['description']
 
-    conn = sqlite3.connect(DATABASE)
+    conn = get_db()
     cursor = conn.cursor()
     #  Insert the new event into the database
     try:
@@ -251,109 +530,122 @@ def request_event():
             INSERT INTO Events (OrganizerUserID, Date, Time, Venue, Description, Status)
             VALUES (?, ?, ?, ?, ?, 'pending')
         """, (user_id, date, time, venue, description))
+        # Push the new event to musicians' open pages
+        feed.publish(conn, feed.MUSICIANS, 'event_created', f"New event at {venue} on {date} at {time}.",
+                     event_id=cursor.lastrowid)
+        # Event lists served by the API, and the organization's dashboard, have changed
+        cache.invalidate(conn, 'events')
+        cache.invalidate(conn, cache.user_scope(user_id))
         conn.commit()
         flash("Event request submitted successfully!")
-    except sqlite3.Error as e:
-        # Return an error message if an error occurs while fetching the user record
-        print(e)
+    except sqlite3.Error:
+        # Keep none of a half-written request, then return an error message
+        conn.rollback()
+        current_app.logger.exception("Saving an event request from user %s failed", user_id)
         flash("An error occurred while submitting the event request.")
-    finally:
-        conn.close()
-        # Redirect to the organization home page
+    # Redirect to the organization home page
     return redirect(url_for('organization'))
 
 
 # Define a route for viewing organization events / organization home page
-@app.route('/organization')
+@route('/organization')
+@login_required
 def organization():
-    # Check if the user ID is stored in the session
-    if 'user_id' not in session:
-        flash("Please log in to view this page.")
-        return redirect(url_for('login'))
-
-    # Fetch the user record from the database
-    user_id = session['user_id']
-    print(f"User ID in organization route: {user_id}")  # Debugging statement
-
-    conn = sqlite3.connect(DATABASE)
+    user_id = g.user['id']
+    conn = get_db()
     cursor = conn.cursor()
-    # Fetch confirmed events for the logged-in organization
-    cursor.execute("SELECT * FROM Users WHERE UserID = ?", (user_id,))
-    user_record = cursor.fetchone()
-    if not user_record:
-        flash("User record not found.")
-        return redirect(url_for('login'))
 
-    # Fetch confirmed events for the logged-in organization
+    # Fetch confirmed events for the logged-in organization, rendered once per change to its bookings and events
+    def render_bookings():
+        bookings, _ = queries.organization_bookings(cursor, user_id, limit=None, model=rendering.OrganizationBooking)
+        return render_template('organization_bookings.html', confirmed_events=bookings)
+
+    confirmed_events = ''
     try:
-        cursor.execute("""
-            SELECT e.EventID, e.Date, e.Time, e.Venue, e.Description, u.UserID, u.Username
-            FROM Events e
-            JOIN Bookings b ON e.EventID = b.EventID AND b.Status = 'confirmed'
-            JOIN Users u ON b.MusicianUserID = u.UserID
-            WHERE e.OrganizerUserID = ?
-        """, (user_id,))
-        confirmed_events = cursor.fetchall()
-    except sqlite3.Error as e:
-        # Return an error message if an error occurs while fetching the user record
-        print(e)
+        confirmed_events = rendering.fragment(rendering.dashboard_key(conn, 'organization', user_id),
+                                              render_bookings)
+    except sqlite3.Error:
+        # Return an error message if the bookings could not be read
+        current_app.logger.exception("Fetching bookings for organization %s failed", user_id)
         flash("An error occurred while fetching confirmed events.")
-    finally:
-        conn.close()
-
-    # Render organization dashboard
-    return render_template('organization.html', confirmed_events=confirmed_events)
-
 
-@app.route('/delete_event/<int:event_id>', methods=['POST'])
+    # The organization's open requests, each with the musicians who match it best (ranked in one batch)
+    open_requests = []
+    try:
+        rows = queries.organization_requests(cursor, user_id, date.today().isoformat())
+        suggestions = matching.suggested_musicians([row[0] for row in rows], SUGGESTED_MUSICIANS)
+        names = queries.usernames(cursor, {musician_id for ranked in suggestions.values() for musician_id, _ in ranked})
+        open_requests = [rendering.OpenRequest(*row, [(musician_id, names[musician_id])
+                                                      for musician_id, _ in suggestions.get(row[0], ())
+                                                      if musician_id in names])
+                         for row in rows]
+    except sqlite3.Error:
+        current_app.logger.exception("Fetching open requests for organization %s failed", user_id)
+
+    # Render organization dashboard, with the bookings it hasn't been told about yet
+    return render_template('organization.html', confirmed_events=confirmed_events, open_requests=open_requests,
+                           notifications=unseen_notifications(user_id))
+
+
+@route('/delete_event/<int:event_id>', methods=['POST'])
+@login_required(role='organization')
 def delete_event(event_id):
-    # Ensure the user is logged in and has the appropriate user type
-    if 'user_id' not in session or session.get('user_type') != 'organization':
-        flash("Unauthorized access.")
-        return redirect(url_for('login'))
-
-    conn = sqlite3.connect(DATABASE)
+    conn = get_db()
     cursor = conn.cursor()
 
     try:
         # Retrieve event details before deletion
         cursor.execute(
-            "SELECT Date, Time, Venue, Description FROM Events WHERE EventID = ?", (event_id,))
+            "SELECT Date, Time, Venue, Description, OrganizerUserID FROM Events WHERE EventID = ?", (event_id,))
         event = cursor.fetchone()
 
         if event:
+            # Remember who was booked so they can be told about the cancellation
+            cursor.execute(
+                "SELECT MusicianUserID FROM Bookings WHERE EventID = ?", (event_id,))
+            musician_ids = [row[0] for row in cursor.fetchall()]
+
             # Delete the event from Bookings and Events tables
             cursor.execute(
                 "DELETE FROM Bookings WHERE EventID = ?", (event_id,))
             cursor.execute("DELETE FROM Events WHERE EventID = ?", (event_id,))
 
-            # Create a notification message with event details
-            notification_msg = f"Event on {event[0]} at {
-                event[1]} ({event[2]}) has been cancelled."
-            session['event_notification'] = notification_msg
+            # Notify every booked musician (live if they have a page open, otherwise on their next visit) and
+            # take the event off the other musicians' dashboards
+            notification_msg = f"Event on {event[0]} at {event[1]} ({event[2]}) has been cancelled."
+            for musician_id in musician_ids:
+                feed.publish(conn, feed.user_channel(musician_id), 'event_cancelled', notification_msg,
+                             event_id=event_id)
+            feed.publish(conn, feed.MUSICIANS, 'event_removed', notification_msg, event_id=event_id)
+
+            # Email the affected musicians in the background
+            jobs.enqueue(conn, 'notify_event_cancelled',
+                         {'message': notification_msg, 'musician_ids': musician_ids}, commit=False)
+
+            # The event's images no longer appear in the gallery, and it drops out of the event lists
+            cache.invalidate(conn, 'gallery')
+            cache.invalidate(conn, 'events')
+            # ...and off the dashboards of its organizer and booked musicians
+            for dashboard_user_id in {event[4], *musician_ids}:
+                cache.invalidate(conn, cache.user_scope(dashboard_user_id))
 
             conn.commit()
             flash("Event deleted successfully.")
         else:
             flash("Event not found.")
-    except sqlite3.Error as e:
-        # Return an error message if an error occurs while fetching the user record
-        print(e)
+    except sqlite3.Error:
+        # Undo whatever part of the deletion went through, then return an error message
+        conn.rollback()
+        current_app.logger.exception("Deleting event %s failed", event_id)
         flash("An error occurred while deleting the event.")
-    finally:
-        conn.close()
 
     # Redirect to the organization home page
     return redirect(url_for('organization'))
 
 
-# Reference the directory named 'uploads' in the 'static' folder
-UPLOAD_FOLDER = 'static/uploads'
+# Image types accepted for upload
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
 
-# Configure the upload folder
-app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
-
 
 def allowed_file(filename):
     # Check if the file extension is allowed
@@ -361,12 +653,9 @@ def allowed_file(filename):
 
 
 # Define a route for uploading files
-@app.route('/upload/<int:event_id>', methods=['GET', 'POST'])
+@route('/upload/<int:event_id>', methods=['GET', 'POST'])
+@login_required
 def upload_file(event_id):
-    # Check if the user ID is stored in the session
-    if 'user_id' not in session:
-        return redirect(url_for('login'))
-
     # Fetch the user record from the database
     uploaded_file_url = None
     if request.method == 'POST':
@@ -383,85 +672,169 @@ def upload_file(event_id):
             flash('No selected file')
             return redirect(request.url)
 
-        # If the file is valid, save it to the upload folder
+        # If the file is valid, store it under its content hash (identical uploads are kept once)
         if file and allowed_file(file.filename):
-            filename = secure_filename(file.filename)
-            file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            file.save(file_path)
+            # Normalise the extension so 'photo.JPG' and 'photo.jpeg' map to the same blob
+            extension = file.filename.rsplit('.', 1)[1].lower().replace('jpeg', 'jpg')
 
-            # Save the relative path (from 'static') in the database
-            db_file_path = os.path.join('uploads', filename)
-
-            conn = sqlite3.connect(DATABASE)
+            conn = get_db()
             cursor = conn.cursor()
+            # The blob file this upload created, deleted again if its rows are rolled back
+            created_path = None
             # Insert the new event image into the database
             try:
+                # Stream the upload into storage in chunks, hashing as it goes; the returned path is
+                # relative to 'static' like the paths saved before
+                db_file_path, created = storage.store_upload(conn, file.stream, extension)
+                if created:
+                    created_path = db_file_path
                 cursor.execute("INSERT INTO EventImages (EventID, MusicianUserID, ImagePath) VALUES (?, ?, ?)",
-                               (event_id, session['user_id'], db_file_path))
+                               (event_id, g.user['id'], db_file_path))
+
+                # Create the downscaled copies the gallery serves in the background
+                jobs.enqueue(conn, 'process_image', {'image_id': cursor.lastrowid}, commit=False)
+                # Drop the cached gallery pages
+                cache.invalidate(conn, 'gallery')
                 conn.commit()
-            except sqlite3.Error as e:
-                # Return an error message if an error occurs while saving the image
-                print(e)
+                uploaded_file_url = storage.get_storage().url(db_file_path)
+            except sqlite3.Error:
+                # Undo the half-saved image, then return an error message
+                conn.rollback()
+                if created_path:
+                    storage.get_storage().delete(created_path)
+                current_app.logger.exception("Saving an image for event %s failed", event_id)
                 flash("An error occurred while saving the file information.")
-            finally:
-                conn.close()
-            uploaded_file_url = url_for('uploaded_file', filename=filename)
+            except OSError:
+                # Undo any rows written for it, then return an error message if the file couldn't be stored
+                conn.rollback()
+                if created_path:
+                    storage.get_storage().delete(created_path)
+                current_app.logger.exception("Storing an upload for event %s failed", event_id)
+                flash("An error occurred while saving the file.")
 
     # Render and return the 'upload.html' template with the event_id and uploaded_file_url parameters
     return render_template('upload.html', event_id=event_id, uploaded_file_url=uploaded_file_url)
 
 
-# Define a route for uploading file/image
-@app.route('/uploads/<filename>')
+# Tell the user when an upload is over MAX_CONTENT_LENGTH
+def upload_too_large(e):
+    return f"File is too large (the limit is {current_app.config['MAX_CONTENT_LENGTH'] // (1024 * 1024)} MB)", 413
+
+
+# Blob uploads are named after the SHA-256 of their contents, so a given URL never changes
+HASHED_UPLOAD = re.compile(r"^blobs/[0-9a-f]{2}/([0-9a-f]{64})\.\w+$")
+
+
+# Define a route for uploading file/image (content-addressed uploads live in subfolders)
+@route('/uploads/<path:filename>')
 def uploaded_file(filename):
-    # Logic to display the uploaded file
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    # Content-addressed files can be cached forever and use their hash as a strong ETag
+    hashed = HASHED_UPLOAD.match(filename)
+    max_age = 365 * 24 * 60 * 60 if hashed else current_app.config['UPLOADS_MAX_AGE']
+
+    accel_prefix = current_app.config.get('UPLOADS_ACCEL_REDIRECT')
+    if accel_prefix:
+        # Answer conditional requests here, and let nginx stream the body (and any byte ranges) itself
+        file_path = safe_join(current_app.config['UPLOAD_FOLDER'], filename)
+        if file_path is None or not os.path.isfile(file_path):
+            abort(404)
+        stat = os.stat(file_path)
+        response = current_app.response_class(mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream')
+        response.headers['X-Accel-Redirect'] = accel_prefix.rstrip('/') + '/' + filename
+        response.set_etag(hashed.group(1) if hashed else f"{stat.st_mtime}-{stat.st_size}")
+        response.last_modified = stat.st_mtime
+        response.cache_control.max_age = max_age
+        response = response.make_conditional(request)
+    else:
+        # send_from_directory handles If-None-Match / If-Modified-Since (304) and Range (206) requests,
+        # and hands the body to the server when USE_X_SENDFILE is on
+        response = send_from_directory(current_app.config['UPLOAD_FOLDER'], filename, max_age=max_age,
+                                       etag=hashed.group(1) if hashed else True)
+
+    response.cache_control.public = True
+    if hashed:
+        response.cache_control.immutable = True
+    return response
 
 
 # Define a route for the gallery
-@app.route('/gallery')
+@route('/gallery')
 def gallery():
-    # Fetch the user record from the database
-    conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
-    cursor.execute("""
-        SELECT ei.ImagePath, e.Date, e.Venue, u.Username
-        FROM EventImages ei
-        JOIN Events e ON ei.EventID = e.EventID
-        JOIN Users u ON ei.MusicianUserID = u.UserID
-    """)
-    # Assign the images parameter to the list of images returned by the query
-    images = cursor.fetchall()
-    conn.close()
-    # Render and return the 'gallery.html' template with the images parameter
-    return render_template('gallery.html', images=images)
+    # Read the page number (past the last reachable page there is nothing to show) and optional venue filter
+    page = min(max(request.args.get('page', 1, type=int), 1), queries.MAX_GALLERY_PAGE)
+    venue = request.args.get('venue') or None
+
+    conn = get_db()
+    fragment_cache = cache.get_cache()
+    # The gallery's generation changes whenever an image or event is added or removed, so stale pages are never hit
+    key = f"gallery:{cache.generation(conn, 'gallery')}:{page}:{venue or ''}"
+    cards = fragment_cache.get(key)
+
+    if cards is None:
+        # Fetch one page of images, newest first
+        images, next_cursor = queries.gallery_images(conn.cursor(), venue=venue, page=page)
+        has_next = next_cursor is not None
+        # Look up the srcset of downscaled renditions for each image
+        sources = image_pipeline.responsive_sources(conn, [image[4] for image in images])
+        # Render the cards once and keep the HTML for the next visitor
+        cards = render_template('gallery_cards.html', images=images, sources=sources, page=page,
+                                has_next=has_next, venue=venue)
+        fragment_cache.set(key, cards)
+
+    # Render and return the 'gallery.html' template around the cached cards
+    return render_template('gallery.html', cards=Markup(cards))
+
+
+# Define a route reporting fragment cache hit rates and size
+@route('/stats/cache')
+@instrumentation.stats_endpoint
+def cache_stats():
+    return jsonify(cache.get_cache().stats())
+
+
+# Define a route for searching events and musician profiles
+@route('/search')
+@login_required(message="Please log in to search.")
+def search_page():
+    query = request.args.get('q', '').strip()
+    kind = 'musicians' if request.args.get('type') == 'musicians' else 'events'
+    page = max(request.args.get('page', 1, type=int), 1)
+
+    # Run the ranked full-text query against the matching FTS5 index
+    cursor = get_db().cursor()
+    if kind == 'events':
+        results, has_next = search.search_events(cursor, query, page)
+        columns = ('event_id', 'date', 'time', 'venue', 'description', 'status', 'organizer')
+    else:
+        results, has_next = search.search_users(cursor, query, page)
+        columns = ('user_id', 'username', 'user_type', 'profile_info')
+
+    # Return JSON for scripts and as-you-type search boxes
+    if request.args.get('format') == 'json':
+        return jsonify(results=[dict(zip(columns, row)) for row in results], page=page, has_next=has_next)
+
+    # Render and return the 'search.html' template with the results
+    return render_template('search.html', query=query, kind=kind, results=results, page=page, has_next=has_next)
+
 
 # Route to update profile
 
 
-@app.route('/update_profile', methods=['GET', 'POST'])
+@route('/update_profile', methods=['GET', 'POST'])
+@login_required(message="Please log in to update your profile.")
 def update_profile():
-    # Ensure the user is logged in
-    if 'user_id' not in session:
-        flash("Please log in to update your profile.")
-        return redirect(url_for('login'))
-
     # Handle the GET request (display the form with current user data)
     if request.method == 'GET':
-        conn = sqlite3.connect(DATABASE)
+        conn = get_db()
         cursor = conn.cursor()
 
         try:
             # Fetch the current user's data
-            cursor.execute(
-                "SELECT Username, Email, UserType, ProfileInformation FROM Users WHERE UserID = ?", (session['user_id'],))
-            user_data = cursor.fetchone()
-        except sqlite3.Error as e:
-            print(e)
+            user_data = queries.user_profile(cursor, g.user['id'])
+        except sqlite3.Error:
+            current_app.logger.exception("Fetching the profile of user %s failed", g.user['id'])
             flash("An error occurred while fetching user data.")
             return redirect(url_for('home'))
-        finally:
-            conn.close()
 
         # Check if the user data was found
         if user_data:
@@ -483,7 +856,7 @@ def update_profile():
         user_type = request.form['user_type']
         profile_info = request.form.get('profile_info', '')
 
-        conn = sqlite3.connect(DATABASE)
+        conn = get_db()
         cursor = conn.cursor()
 
         try:
@@ -491,40 +864,36 @@ def update_profile():
             cursor.execute("""
                 UPDATE Users SET Username = ?, Email = ?, UserType = ?, ProfileInformation = ?
                 WHERE UserID = ?
-            """, (username, email, user_type, profile_info, session['user_id']))
+            """, (username, email, user_type, profile_info, g.user['id']))
+            # Gallery cards and the API show the user's name and profile
+            cache.invalidate(conn, 'gallery')
+            cache.invalidate(conn, 'users')
             conn.commit()
+            # Sessions of this user cached the old name and type
+            refresh_principal(g.user['id'])
             flash("Profile updated successfully!")
-        except sqlite3.Error as e:
-            print(e)
+        except sqlite3.Error:
+            conn.rollback()
+            current_app.logger.exception("Updating the profile of user %s failed", g.user['id'])
             flash("An error occurred while updating the profile.")
-        finally:
-            conn.close()
 
         # Redirect to the home page after updating the profile
         return redirect(url_for('home'))
 
 
 # Route to view profile
-@app.route('/profile/<int:user_id>')
+@route('/profile/<int:user_id>')
+@login_required(message="Please log in to view profiles.")
 def view_profile(user_id):
-    # Ensure the user is logged in
-    if 'user_id' not in session:
-        flash("Please log in to view profiles.")
-        return redirect(url_for('login'))
-
-    conn = sqlite3.connect(DATABASE)
+    conn = get_db()
     cursor = conn.cursor()
     try:
         # Fetch the user's data
-        cursor.execute(
-            "SELECT Username, Email, UserType, ProfileInformation FROM Users WHERE UserID = ?", (user_id,))
-        user_data = cursor.fetchone()
-    except sqlite3.Error as e:
-        print(e)
+        user_data = queries.user_profile(cursor, user_id)
+    except sqlite3.Error:
+        current_app.logger.exception("Fetching the profile of user %s failed", user_id)
         flash("An error occurred while fetching user data.")
         return redirect(url_for('organization'))
-    finally:
-        conn.close()
 
     # Check if the user data was found
     if user_data:
@@ -542,6 +911,13 @@ def view_profile(user_id):
         return redirect(url_for('organization'))
 
 
+# Define a route reporting connection pool usage (open/in-use connections, waits and timeouts)
+@route('/stats/db')
+@instrumentation.stats_endpoint
+def db_stats():
+    return jsonify(get_pool().stats())
+
+
 # Run the Flask application
 if __name__ == '__main__':
-    app.run(debug=True)
+    create_app().run(debug=True)
@@ -0,0 +1,327 @@
+# Accounts: registration rules, password hashing off the request thread, login rate limits, and the logged-in user
+# ("principal") loaded once per session instead of on every request
+import math
+import os
+import random
+import re
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import wraps
+
+from flask import current_app, flash, g, redirect, session, url_for
+from werkzeug.security import check_password_hash, generate_password_hash
+
+from db import get_db
+
+# Account types a user can register as
+USER_TYPES = ('musician', 'organization')
+
+# Usernames are letters, digits and underscores; passwords are 8+ characters with an uppercase letter and a number
+USERNAME_PATTERN = re.compile(r"^\w+$")
+PASSWORD_PATTERN = re.compile(r"^(?=.*[A-Z])(?=.*\d).{8,}$")
+
+
+def registration_error(username, password):
+    # The message register shows for an unacceptable username or password, or None if both are fine
+    if " " in username or not USERNAME_PATTERN.match(username):
+        return "Username must not contain spaces and must be alphanumeric"
+    if not PASSWORD_PATTERN.match(password):
+        return "Password must be at least 8 characters long, contain a number and an uppercase letter"
+    return None
+
+
+# werkzeug's default method, spelled out so hashes made with other parameters are recognised and upgraded
+DEFAULT_HASH_METHOD = 'scrypt:32768:8:1'
+
+# Roughly one rate-limited attempt in this many also deletes buckets that have refilled completely
+CLEANUP_EVERY = 1000
+
+
+# Raised when every hashing slot stays taken for the hasher's timeout; the caller answers 503 instead of queueing
+class HasherBusy(Exception):
+    pass
+
+
+# Run in the hashing processes
+def _generate_hash(password, method):
+    return generate_password_hash(password, method=method)
+
+
+def _check_hash(password_hash, password):
+    return check_password_hash(password_hash, password)
+
+
+# Hashes and checks passwords in a small process pool, so hashing neither holds the GIL of the process serving
+# pages nor uses more than `workers` CPUs however many logins arrive. At most `queue` hashes wait or run at once;
+# a request that finds no free slot within `timeout` seconds gets HasherBusy. workers=0 hashes on the calling thread.
+class PasswordHasher:
+    def __init__(self, method=DEFAULT_HASH_METHOD, workers=1, queue=16, timeout=1.0):
+        self.method = method
+        self.workers = workers
+        self.queue = queue
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(queue)
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pid = None
+        # The "method:cost" prefix of hashes made with the current parameters, found on first use
+        self._prefix = None
+        self._in_flight = 0
+        self._counts = {'hashes': 0, 'checks': 0, 'rehashes': 0, 'busy': 0}
+
+    def count(self, name):
+        with self._lock:
+            self._counts[name] += 1
+
+    def _get_executor(self):
+        # One pool per process: a server worker forked after the pool started must not use its parent's
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+                self._pid = os.getpid()
+            return self._executor
+
+    def _run(self, function, *args):
+        if not self._slots.acquire(timeout=self.timeout):
+            self.count('busy')
+            raise HasherBusy()
+        with self._lock:
+            self._in_flight += 1
+        try:
+            if not self.workers:
+                return function(*args)
+            try:
+                return self._get_executor().submit(function, *args).result()
+            except BrokenProcessPool:
+                # A hashing process died (e.g. killed for memory); the next call starts a new pool
+                with self._lock:
+                    self._executor = None
+                raise HasherBusy()
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+            self._slots.release()
+
+    def hash(self, password):
+        self.count('hashes')
+        return self._run(_generate_hash, password, self.method)
+
+    def check(self, password_hash, password):
+        self.count('checks')
+        return self._run(_check_hash, password_hash, password)
+
+    def needs_rehash(self, password_hash):
+        # Stored hashes start with the method and cost they were made with ("scrypt:32768:8:1$salt$hash")
+        if self._prefix is None:
+            self._prefix = self._run(_generate_hash, '', self.method).split('$', 1)[0]
+        return password_hash.split('$', 1)[0] != self._prefix
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None and self._pid == os.getpid():
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counts)
+            stats['in_flight'] = self._in_flight
+        stats.update({'workers': self.workers, 'queue': self.queue})
+        return stats
+
+
+def get_hasher(app=None):
+    return (app or current_app).extensions['password_hasher']
+
+
+def hash_password(password):
+    # Hash for a new or changed password, made with the current PASSWORD_HASH_METHOD; may raise HasherBusy
+    return get_hasher().hash(password)
+
+
+def check_password(user_id, password_hash, password):
+    # Whether password matches a user's stored hash; a hash made with older parameters is replaced by one made
+    # with the current ones while the plain password is at hand. May raise HasherBusy.
+    hasher = get_hasher()
+    if not hasher.check(password_hash, password):
+        return False
+    try:
+        if hasher.needs_rehash(password_hash):
+            new_hash = hasher.hash(password)
+            conn = get_db()
+            conn.execute("UPDATE Users SET Password = ? WHERE UserID = ? AND Password = ?",
+                         (new_hash, user_id, password_hash))
+            conn.commit()
+            hasher.count('rehashes')
+    except HasherBusy:
+        # The login itself succeeded; the hash is upgraded on a later one
+        pass
+    return True
+
+
+# Token buckets: a key holds up to `burst` tokens and regains `rate` tokens a second; each attempt takes one, and
+# an attempt that finds less than one token is refused. take() returns (granted, tokens left).
+
+# Buckets kept in this process's memory: nothing to write, but each server process counts on its own
+class MemoryBucketStore:
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        # key -> (tokens, updated at, time it is full again)
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def take(self, key, burst, rate, now):
+        with self._lock:
+            tokens, updated, _ = self._buckets.get(key, (burst, now, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            granted = tokens >= 1
+            if granted:
+                tokens -= 1
+            self._buckets[key] = (tokens, now, now + (burst - tokens) / rate)
+            if len(self._buckets) > self.max_keys:
+                # A full bucket is the same as none at all
+                self._buckets = {key: bucket for key, bucket in self._buckets.items() if bucket[2] > now}
+        return granted, tokens
+
+
+# Buckets in the RateLimits table, shared by every server process using the database
+class SqliteBucketStore:
+    def __init__(self, retention=3600):
+        # Buckets untouched for this long (the longest refill period) are full and can be deleted
+        self.retention = retention
+
+    def take(self, key, burst, rate, now):
+        conn = get_db()
+        # One statement, so concurrent attempts on a key can't both spend its last token
+        tokens, granted = conn.execute("""
+            INSERT INTO RateLimits (Key, Tokens, UpdatedAt, Granted) VALUES (:key, :burst - 1, :now, 1)
+            ON CONFLICT (Key) DO UPDATE SET
+                Tokens = MIN(:burst, Tokens + (:now - UpdatedAt) * :rate)
+                         - (MIN(:burst, Tokens + (:now - UpdatedAt) * :rate) >= 1),
+                Granted = MIN(:burst, Tokens + (:now - UpdatedAt) * :rate) >= 1,
+                UpdatedAt = :now
+            RETURNING Tokens, Granted
+        """, {'key': key, 'burst': burst, 'rate': rate, 'now': now}).fetchone()
+        if random.randrange(CLEANUP_EVERY) == 0:
+            conn.execute("DELETE FROM RateLimits WHERE UpdatedAt < ?", (now - self.retention,))
+        conn.commit()
+        return bool(granted), tokens
+
+
+# Named limits, each (burst, period): up to `burst` attempts at once, regained evenly over `period` seconds
+class RateLimiter:
+    def __init__(self, store, limits):
+        self.store = store
+        self.limits = limits
+        self._lock = threading.Lock()
+        self.refused = {rule: 0 for rule in limits}
+
+    def retry_after(self, rule, value):
+        # None if an attempt under rule by value (an IP address or a username) may go ahead, otherwise the whole
+        # seconds until it may; rules without a limit always go ahead
+        limit = self.limits.get(rule)
+        if not limit:
+            return None
+        burst, period = limit
+        rate = burst / period
+        granted, tokens = self.store.take(f"{rule}:{value}", burst, rate, time.time())
+        if granted:
+            return None
+        with self._lock:
+            self.refused[rule] += 1
+        return max(1, math.ceil((1 - tokens) / rate))
+
+
+def throttled(*attempts):
+    # Seconds to wait if any (rule, value) attempt is over its limit, else None. Checked in order and stopping at
+    # the first refusal, so e.g. an address that is already blocked doesn't also use up a username's tokens.
+    limiter = current_app.extensions.get('rate_limiter')
+    if limiter is None:
+        return None
+    for rule, value in attempts:
+        wait = limiter.retry_after(rule, value)
+        if wait is not None:
+            return wait
+    return None
+
+
+def principal_from_row(user_id, username, user_type):
+    # What routes and templates need to know about the logged-in user; kept small since it lives in the session
+    return {'id': user_id, 'username': username, 'user_type': user_type}
+
+
+def login_user(user_id, username, user_type):
+    # Start a fresh session for the user (new session ID, so one seen before login can't be reused after it)
+    session.clear()
+    regenerate = getattr(current_app.session_interface, 'regenerate', None)
+    if regenerate is not None:
+        regenerate(session)
+    session['user_id'] = user_id
+    session['principal'] = principal_from_row(user_id, username, user_type)
+    g.user = session['principal']
+
+
+def current_user():
+    # The principal for this request: from g, then the session, and only when neither has it from Users
+    if 'user' in g:
+        return g.user
+    user = None
+    if 'user_id' in session:
+        user = session.get('principal')
+        if user is None or user['id'] != session['user_id']:
+            row = get_db().execute("SELECT UserID, Username, UserType FROM Users WHERE UserID = ?",
+                                   (session['user_id'],)).fetchone()
+            if row is None:
+                # The account is gone; treat the session as logged out
+                session.clear()
+            else:
+                user = session['principal'] = principal_from_row(*row)
+    g.user = user
+    return user
+
+
+def refresh_principal(user_id):
+    # Forget the cached principal in every session of a user (after their profile changed); the current
+    # session reloads it right away, the others on their next request
+    current_app.session_interface.store.forget_key(user_id, 'principal')
+    if session.get('user_id') == user_id:
+        session.pop('principal', None)
+        g.pop('user', None)
+
+
+def login_required(view=None, *, role=None, message="Please log in to view this page."):
+    # Redirect to the login page unless someone is logged in (and, with role=, has that user type).
+    # The view finds the principal in g.user.
+    def decorator(view):
+        @wraps(view)
+        def wrapped(*args, **kwargs):
+            user = current_user()
+            if user is None:
+                flash(message)
+                return redirect(url_for('login'))
+            if role is not None and user['user_type'] != role:
+                flash("Unauthorized access.")
+                return redirect(url_for('login'))
+            return view(*args, **kwargs)
+        return wrapped
+
+    if view is not None:
+        return decorator(view)
+    return decorator
+
+
+def init_app(app):
+    app.extensions['password_hasher'] = PasswordHasher(
+        app.config.get('PASSWORD_HASH_METHOD', DEFAULT_HASH_METHOD), app.config.get('PASSWORD_HASH_WORKERS', 1),
+        app.config.get('PASSWORD_HASH_QUEUE', 16), app.config.get('PASSWORD_HASH_TIMEOUT', 1.0))
+
+    # RATE_LIMIT_BACKEND: 'sqlite' (default, shared by every worker using the database) or 'memory' (per process)
+    limits = app.config.get('RATE_LIMITS') or {}
+    if app.config.get('RATE_LIMIT_ENABLED', True) and limits:
+        if app.config.get('RATE_LIMIT_BACKEND', 'sqlite') == 'memory':
+            store = MemoryBucketStore()
+        else:
+            store = SqliteBucketStore(retention=max(period for _, period in limits.values()))
+        app.extensions['rate_limiter'] = RateLimiter(store, limits)
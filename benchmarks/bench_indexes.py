@@ -0,0 +1,74 @@
+# Compare the hot app.py queries before and after the index migration
+#
+#   python -m benchmarks.bench_indexes --events 300000
+import argparse
+import os
+import tempfile
+import time
+
+from benchmarks.seed import create_database
+from migrate import upgrade
+
+# (label, SQL, parameters) for the queries the routes run on every page view
+QUERIES = [
+    ("register existence check", "SELECT 1 FROM Users WHERE Username = ? OR Email = ? LIMIT 1",
+     ("user500", "nobody@example.com")),
+    ("login lookup", "SELECT * FROM Users WHERE username = ?", ("user500",)),
+    ("home: pending events", """
+        SELECT e.EventID, e.Date, e.Time, e.Venue, e.Description, e.Status, u.Username
+        FROM Events e JOIN Users u ON u.UserID = e.OrganizerUserID
+        WHERE e.Status = 'pending' ORDER BY e.Date, e.Time, e.EventID LIMIT 20""", ()),
+    ("home: confirmed events", """
+        SELECT e.EventID, e.Date, e.Time, e.Venue, e.Description
+        FROM Events e JOIN Bookings b ON e.EventID = b.EventID
+        WHERE b.MusicianUserID = ? AND b.Status = 'confirmed'""", (42,)),
+    ("organization: confirmed events", """
+        SELECT e.EventID, e.Date, e.Time, e.Venue, e.Description, u.UserID, u.Username
+        FROM Events e
+        JOIN Bookings b ON e.EventID = b.EventID AND b.Status = 'confirmed'
+        JOIN Users u ON b.MusicianUserID = u.UserID
+        WHERE e.OrganizerUserID = ?""", (900,)),
+    ("delete_event: bookings", "SELECT BookingID FROM Bookings WHERE EventID = ?", (1234,)),
+    ("gallery: images for event", "SELECT ImagePath FROM EventImages WHERE EventID = ?", (1234,)),
+]
+
+
+def measure(conn, repeat):
+    results = {}
+    for label, sql, params in QUERIES:
+        plan = [row[-1] for row in conn.execute("EXPLAIN QUERY PLAN " + sql, params)]
+        started = time.perf_counter()
+        for _ in range(repeat):
+            conn.execute(sql, params).fetchall()
+        elapsed_ms = (time.perf_counter() - started) / repeat * 1000
+        results[label] = (plan, elapsed_ms)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark hot queries before and after indexing.")
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--events', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'bench.db')
+        print(f"Seeding {args.users} users and {args.events} events...")
+        conn = create_database(path, target=1, users=args.users, events=args.events,
+                               bookings=args.events // 2, images=args.events // 5)
+        before = measure(conn, args.repeat)
+        upgrade(conn)
+        after = measure(conn, args.repeat)
+        conn.close()
+
+    for label, _, _ in QUERIES:
+        plan_before, ms_before = before[label]
+        plan_after, ms_after = after[label]
+        print(f"\n{label}: {ms_before:.3f} ms -> {ms_after:.3f} ms ({ms_before / max(ms_after, 1e-6):.0f}x)")
+        print("  before: " + " | ".join(plan_before))
+        print("  after:  " + " | ".join(plan_after))
+
+
+if __name__ == '__main__':
+    main()
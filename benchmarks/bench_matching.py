@@ -0,0 +1,83 @@
+# Measure the recommendation index at scale: full build, batch ranking latency, and incremental updates
+#
+#   python -m benchmarks.bench_matching --users 1000 --events 10000 --bookings 5000
+import argparse
+import os
+import random
+import statistics
+import tempfile
+import time
+
+from benchmarks.seed import WORDS, create_database
+
+
+def timed(function, repeat):
+    # Milliseconds per call for each of repeat calls, sorted
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    return timings
+
+
+def report(name, timings):
+    print(f"{name:<36} {statistics.median(timings):>9.2f} {timings[int(len(timings) * 0.95) - 1]:>9.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the musician-event matching index.")
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--events', type=int, default=10000)
+    parser.add_argument('--bookings', type=int, default=5000)
+    parser.add_argument('--repeat', type=int, default=50, help="Calls per measurement.")
+    parser.add_argument('--batch', type=int, default=100, help="Musicians ranked in one batch.")
+    args = parser.parse_args()
+
+    import matching
+    if matching.np is None:
+        raise SystemExit("NumPy is not installed")
+
+    rng = random.Random(19)
+    with tempfile.TemporaryDirectory() as tmp:
+        database = os.path.join(tmp, 'bench.db')
+        conn = create_database(database, users=args.users, events=args.events, bookings=args.bookings, images=0)
+        # The seeded dates lie in the past; move them so the latest is a year from now and most events are open
+        latest = conn.execute("SELECT MAX(Date) FROM Events").fetchone()[0]
+        conn.execute("UPDATE Events SET Date = date(Date, '+' || (julianday('now', '+1 year') - julianday(?)) || ' days')",
+                     (latest,))
+        conn.commit()
+
+        index = matching.MatchingIndex()
+        report("build (ms)", timed(lambda: index.load(conn), 3))
+        stats = index.stats()
+        print(f"{stats['events']} open events, {stats['musicians']} musicians, {stats['bytes'] / 1e6:.1f} MB")
+
+        musicians = list(index.musicians.row_of)
+        events = list(index.events.row_of)
+        print(f"{'':<36} {'p50 ms':>9} {'p95 ms':>9}")
+        report("rank events, 1 musician", timed(lambda: index.rank_events([rng.choice(musicians)], 10), args.repeat))
+        report(f"rank events, {args.batch} musicians",
+               timed(lambda: index.rank_events(rng.sample(musicians, min(args.batch, len(musicians))), 10),
+                     max(3, args.repeat // 10)))
+        report("rank musicians, 20 events",
+               timed(lambda: index.rank_musicians(rng.sample(events, min(20, len(events))), 3), args.repeat))
+
+        # Incremental updates: a profile edit and a new event per round, picked up through the change log
+        def update():
+            conn.execute("UPDATE Users SET ProfileInformation = ? WHERE UserID = ?",
+                         (" ".join(rng.choice(WORDS) for _ in range(12)), rng.choice(musicians)))
+            conn.execute("INSERT INTO Events (OrganizerUserID, Date, Time, Venue, Description, Status) "
+                         "VALUES (?, date('now', '+30 days'), '19:00', 'Tower Theatre', ?, 'pending')",
+                         (args.users, " ".join(rng.choice(WORDS) for _ in range(10))))
+            conn.commit()
+            index.refresh(conn, interval=0)
+        report("refresh after 2 changes", timed(update, args.repeat))
+        report("full rebuild, for comparison", timed(lambda: index.load(conn), 3))
+        print(index.stats())
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,518 @@
+# Load-test every app.py route against a seeded database and keep the results as a JSON baseline
+#
+#   python -m benchmarks.bench_routes --users 1000 --events 10000 --output baseline.json
+#   python -m benchmarks.bench_routes --mode server --concurrency 8 --baseline baseline.json
+#   python -m benchmarks.bench_routes --compare baseline.json current.json
+#
+# 'client' mode drives the app through Flask's test client, 'server' mode through a threaded werkzeug server over
+# real HTTP (or, with --url, any server already running against --database, e.g. gunicorn). Both run each route
+# --requests times from --concurrency threads, each with its own logged-in session.
+import argparse
+import gzip
+import http.client
+import io
+import itertools
+import json
+import os
+import platform
+import random
+import re
+import secrets
+import sqlite3
+import struct
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from datetime import datetime, timezone
+from http.cookies import SimpleCookie
+from urllib.parse import urlencode, urlsplit
+
+from benchmarks.seed import PASSWORD, PASSWORD_METHOD, WORDS, create_database
+
+# A route is slower than in the baseline when its p95 latency grew by more than the threshold (and by more than
+# MIN_DELTA_MS, so sub-millisecond noise isn't reported), or its throughput fell by more than the threshold
+THRESHOLD = 0.2
+MIN_DELTA_MS = 1.0
+
+# Responses that count as success; anything else is an error
+OK_STATUSES = {200, 302, 304}
+
+UPLOAD_URL = re.compile(rb'/uploads/blobs/[0-9a-f]{2}/[0-9a-f]{64}\.png')
+
+
+def tiny_png(n):
+    # A valid 1x1 PNG whose colour comes from n, so every upload is a new blob
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+    pixel = b'\x00' + (n & 0xffffff).to_bytes(3, 'big')
+    return (b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', 1, 1, 8, 2, 0, 0, 0))
+            + chunk(b'IDAT', zlib.compress(pixel)) + chunk(b'IEND', b''))
+
+
+def percentile(sorted_values, fraction):
+    # Nearest-rank percentile of an already sorted list
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values))) - 1))]
+
+
+def decoded(body, encoding):
+    # Bodies are asked for gzipped, as browsers do, and unpacked like a browser would
+    return gzip.decompress(body) if encoding == 'gzip' else body
+
+
+# Test client session: requests go straight into the WSGI app, no sockets
+class ClientSession:
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, form=None, upload=None, stream=False):
+        # Returns (status, body); a stream is read up to its first message and then closed
+        data = dict(form or {})
+        if upload is not None:
+            data['file'] = (io.BytesIO(upload[1]), upload[0])
+        response = self.client.open(path, method=method, data=data or None, buffered=not stream,
+                                    headers={'Accept-Encoding': 'gzip'})
+        if stream:
+            next(iter(response.response), b'')
+            response.close()
+            return response.status_code, b''
+        return response.status_code, decoded(response.get_data(), response.headers.get('Content-Encoding'))
+
+
+# HTTP/1.1 session over one keep-alive connection, carrying its cookies like a browser
+class HttpSession:
+    def __init__(self, base_url):
+        parts = urlsplit(base_url)
+        self.host, self.port = parts.hostname, parts.port or 80
+        self.prefix = parts.path.rstrip('/')
+        self.cookies = {}
+        self.conn = None
+
+    def _connection(self):
+        if self.conn is None:
+            self.conn = http.client.HTTPConnection(self.host, self.port, timeout=30)
+        return self.conn
+
+    def request(self, method, path, form=None, upload=None, stream=False):
+        # Like a browser, accept compressed responses
+        headers = {'Accept-Encoding': 'gzip'}
+        body = None
+        if upload is not None:
+            boundary = secrets.token_hex(16)
+            parts = [f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode()
+                     for name, value in (form or {}).items()]
+            parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{upload[0]}"\r\n'
+                         f'Content-Type: image/png\r\n\r\n'.encode() + upload[1] + b'\r\n')
+            body = b''.join(parts) + f'--{boundary}--\r\n'.encode()
+            headers['Content-Type'] = f'multipart/form-data; boundary={boundary}'
+        elif form is not None:
+            body = urlencode(form).encode()
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        if self.cookies:
+            headers['Cookie'] = '; '.join(f'{name}={value}' for name, value in self.cookies.items())
+
+        conn = self._connection()
+        try:
+            conn.request(method, self.prefix + path, body=body, headers=headers)
+            response = conn.getresponse()
+        except (http.client.HTTPException, OSError):
+            # The server closed the idle connection; retry once on a new one
+            self.close()
+            conn = self._connection()
+            conn.request(method, self.prefix + path, body=body, headers=headers)
+            response = conn.getresponse()
+
+        for header in response.headers.get_all('Set-Cookie') or ():
+            for name, morsel in SimpleCookie(header).items():
+                if morsel['expires'] and 'Thu, 01 Jan 1970' in morsel['expires']:
+                    self.cookies.pop(name, None)
+                else:
+                    self.cookies[name] = morsel.value
+        if stream:
+            response.readline()
+            self.close()
+            return response.status, b''
+        return response.status, decoded(response.read(), response.getheader('Content-Encoding'))
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+
+# What the scenarios act on, read from the database before each run: the users to log in as, and disjoint
+# shuffled lists of events to apply for and to delete (so no two requests act on the same event)
+class Targets:
+    def __init__(self, database, run_id):
+        conn = sqlite3.connect(database)
+        try:
+            self.musician = conn.execute("""
+                SELECT UserID, Username, Email, ProfileInformation FROM Users
+                WHERE UserType = 'musician' ORDER BY UserID LIMIT 1
+            """).fetchone()
+            self.organization = conn.execute("""
+                SELECT UserID, Username, Email, ProfileInformation FROM Users
+                WHERE UserType = 'organization' ORDER BY UserID DESC LIMIT 1
+            """).fetchone()
+            pending = [row[0] for row in conn.execute("SELECT EventID FROM Events WHERE Status = 'pending'")]
+            others = [row[0] for row in conn.execute("SELECT EventID FROM Events WHERE Status != 'pending'")]
+            self.user_ids = [row[0] for row in conn.execute("SELECT UserID FROM Users")]
+            # An event of the organization's own, for the routes only its organizer may see
+            own = conn.execute("SELECT EventID FROM Events WHERE OrganizerUserID = ? ORDER BY Status != 'pending' LIMIT 1",
+                               (self.organization[0],)).fetchone() if self.organization else None
+        finally:
+            conn.close()
+        if self.musician is None or self.organization is None or not pending:
+            sys.exit("The database needs at least one musician, one organization and one pending event")
+
+        rng = random.Random(run_id)
+        rng.shuffle(pending)
+        rng.shuffle(others)
+        self.event = pending[-1]
+        self.own_event = own[0] if own else self.event
+        self.pending = pending[:-1] or pending
+        self.removable = others or pending
+        self.run_id = run_id
+        self.upload_url = None
+
+    def credentials(self, role):
+        user = self.musician if role == 'musician' else self.organization
+        return {'username': user[1], 'password': PASSWORD}
+
+    def profile_form(self):
+        user_id, username, email, profile_info = self.musician
+        return {'username': username, 'email': email, 'user_type': 'musician', 'profile_info': profile_info or ''}
+
+    def any_user(self, n):
+        return self.user_ids[n * 7919 % len(self.user_ids)]
+
+    def word(self, n):
+        return WORDS[n % len(WORDS)]
+
+
+# One route (or one way of calling it). path and form are values or functions of (targets, n), n counting the
+# scenario's requests from 0; role is the user the session logs in as first; before runs untimed before each request.
+class Scenario:
+    def __init__(self, name, path, method='GET', role=None, form=None, upload=False, stream=False, before=None):
+        self.name = name
+        self.path = path
+        self.method = method
+        self.role = role
+        self.form = form
+        self.upload = upload
+        self.stream = stream
+        self.before = before
+
+    def resolve(self, value, targets, n):
+        return value(targets, n) if callable(value) else value
+
+
+def log_in(session, targets, role):
+    status, _ = session.request('POST', '/login', form=targets.credentials(role))
+    if status != 302:
+        raise RuntimeError(f"Logging in as a {role} failed with status {status}")
+
+
+SCENARIOS = [
+    Scenario('landing', '/'),
+    Scenario('register_form', '/register'),
+    Scenario('login_form', '/login'),
+    Scenario('home', '/home', role='musician'),
+    Scenario('home_events_available', '/home/events/available', role='musician'),
+    Scenario('home_events_confirmed', '/home/events/confirmed', role='musician'),
+    Scenario('notification_stream', '/notifications/stream', role='musician', stream=True),
+    Scenario('apply_form', lambda t, n: f'/apply_for_event/{t.event}', role='musician'),
+    Scenario('organization', '/organization', role='organization'),
+    Scenario('upload_form', lambda t, n: f'/upload/{t.event}', role='musician'),
+    Scenario('uploaded_file', lambda t, n: t.upload_url),
+    Scenario('gallery', '/gallery'),
+    Scenario('gallery_page', lambda t, n: f'/gallery?page={n % 5 + 2}'),
+    Scenario('search', lambda t, n: f'/search?q={t.word(n)}', role='musician'),
+    Scenario('search_musicians', lambda t, n: f'/search?q={t.word(n)}&type=musicians&format=json', role='musician'),
+    Scenario('update_profile_form', '/update_profile', role='musician'),
+    Scenario('view_profile', lambda t, n: f'/profile/{t.any_user(n)}', role='organization'),
+    Scenario('api_events', '/api/v1/events', role='musician'),
+    Scenario('api_event', lambda t, n: f'/api/v1/events/{t.event}', role='musician'),
+    Scenario('api_bookings', '/api/v1/bookings', role='organization'),
+    Scenario('api_recommendations', '/api/v1/recommendations', role='musician'),
+    Scenario('api_suggestions', lambda t, n: f'/api/v1/events/{t.own_event}/suggestions', role='organization'),
+    Scenario('api_profile', lambda t, n: f'/api/v1/profiles/{t.any_user(n)}', role='musician'),
+    Scenario('api_gallery', '/api/v1/gallery'),
+    Scenario('cache_stats', '/stats/cache'),
+    Scenario('db_stats', '/stats/db'),
+    Scenario('metrics', '/metrics'),
+    Scenario('healthz', '/healthz'),
+    Scenario('readyz', '/readyz'),
+
+    # Writes come last so the reads above all see the same data
+    Scenario('login', '/login', method='POST', form=lambda t, n: t.credentials('musician')),
+    Scenario('logout', '/logout', before=lambda session, t: log_in(session, t, 'musician')),
+    Scenario('register', '/register', method='POST',
+             form=lambda t, n: {'username': f'bench{t.run_id}x{n}', 'password': PASSWORD,
+                                'email': f'bench{t.run_id}x{n}@example.com', 'user_type': 'musician'}),
+    Scenario('update_profile', '/update_profile', method='POST', role='musician', form=lambda t, n: t.profile_form()),
+    Scenario('upload', lambda t, n: f'/upload/{t.event}', method='POST', role='musician', upload=True),
+    Scenario('request_event', '/request_event', method='POST', role='organization',
+             form=lambda t, n: {'date': '2030-01-01', 'time': '19:00', 'venue': 'Tower Theatre',
+                                'description': f'benchmark event {n}'}),
+    Scenario('apply', lambda t, n: f'/apply_for_event/{t.pending[n % len(t.pending)]}', method='POST',
+             role='musician'),
+    Scenario('delete_event', lambda t, n: f'/delete_event/{t.removable[n % len(t.removable)]}', method='POST',
+             role='organization'),
+]
+
+
+def uncovered_routes(app, targets):
+    # Endpoints of app.py with no scenario, so a new route can't silently go unbenchmarked
+    adapter = app.url_map.bind('localhost')
+    covered = {adapter.match(scenario.resolve(scenario.path, targets, 0).split('?')[0], method=scenario.method)[0]
+               for scenario in SCENARIOS}
+    return sorted(rule.endpoint for rule in app.url_map.iter_rules()
+                  if rule.endpoint != 'static' and rule.endpoint not in covered)
+
+
+def run_scenario(scenario, make_session, targets, requests, concurrency):
+    # Time `requests` calls of one scenario spread over `concurrency` threads; logging in isn't timed
+    counter = itertools.count()
+    timings, statuses = [], {}
+    lock = threading.Lock()
+    ready = threading.Barrier(concurrency + 1)
+    failures = []
+
+    def worker():
+        session = make_session()
+        try:
+            if scenario.role:
+                log_in(session, targets, scenario.role)
+        except Exception as e:
+            failures.append(e)
+            ready.abort()
+            return
+        ready.wait()
+        local_timings, local_statuses = [], {}
+        while (n := next(counter)) < requests:
+            if scenario.before:
+                scenario.before(session, targets)
+            path = scenario.resolve(scenario.path, targets, n)
+            form = scenario.resolve(scenario.form, targets, n)
+            upload = ('photo.png', tiny_png(hash((targets.run_id, n)))) if scenario.upload else None
+            started = time.perf_counter()
+            try:
+                status, _ = session.request(scenario.method, path, form=form, upload=upload, stream=scenario.stream)
+            except Exception:
+                status = 'exception'
+            local_timings.append((time.perf_counter() - started) * 1000)
+            local_statuses[status] = local_statuses.get(status, 0) + 1
+        if isinstance(session, HttpSession):
+            session.close()
+        with lock:
+            timings.extend(local_timings)
+            for status, count in local_statuses.items():
+                statuses[status] = statuses.get(status, 0) + count
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    try:
+        ready.wait()
+    except threading.BrokenBarrierError:
+        for thread in threads:
+            thread.join()
+        raise failures[0]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    timings.sort()
+    errors = sum(count for status, count in statuses.items() if status not in OK_STATUSES)
+    return {
+        'method': scenario.method,
+        'requests': len(timings),
+        'errors': errors,
+        'statuses': {str(status): count for status, count in sorted(statuses.items(), key=str)},
+        'p50_ms': round(percentile(timings, 0.50), 3),
+        'p95_ms': round(percentile(timings, 0.95), 3),
+        'p99_ms': round(percentile(timings, 0.99), 3),
+        'mean_ms': round(sum(timings) / len(timings), 3) if timings else 0.0,
+        'max_ms': round(timings[-1], 3) if timings else 0.0,
+        'throughput_rps': round(len(timings) / elapsed, 1) if elapsed else 0.0,
+    }
+
+
+def run_mode(label, make_session, database, args, only):
+    targets = Targets(database, secrets.token_hex(3))
+
+    # A first upload gives uploaded_file a real content-addressed file to serve
+    session = make_session()
+    log_in(session, targets, 'musician')
+    _, body = session.request('POST', f'/upload/{targets.event}', upload=('photo.png', tiny_png(0)))
+    match = UPLOAD_URL.search(body)
+    if match is None:
+        sys.exit("Uploading a test image failed; check the server's upload folder")
+    targets.upload_url = match.group().decode()
+    if isinstance(session, HttpSession):
+        session.close()
+
+    results = {}
+    print(f"\n{label}: {args.requests} requests per route, {args.concurrency} concurrent")
+    print(f"{'route':<24} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'req/s':>9} {'errors':>7}")
+    for scenario in SCENARIOS:
+        if only and scenario.name not in only:
+            continue
+        result = run_scenario(scenario, make_session, targets, args.requests, args.concurrency)
+        results[scenario.name] = result
+        print(f"{scenario.name:<24} {result['p50_ms']:>9.2f} {result['p95_ms']:>9.2f} {result['p99_ms']:>9.2f} "
+              f"{result['throughput_rps']:>9.1f} {result['errors']:>7}")
+    return results
+
+
+def load_app(database, upload_root):
+    # Build the application against the seeded database, with uploads kept out of the repository's static folder
+    os.environ.setdefault('CRESCENDO_SECRET_KEY', 'benchmark')
+    os.environ.setdefault('CRESCENDO_ACCESS_LOG', '0')
+    os.environ.setdefault('CRESCENDO_STATS', '1')
+    # Every simulated user logs in from 127.0.0.1, and the seeded password hashes are cheap on purpose: keep both
+    # as they are instead of throttling the run or upgrading every hash during it
+    os.environ.setdefault('CRESCENDO_RATE_LIMIT', '0')
+    os.environ.setdefault('CRESCENDO_PASSWORD_HASH', PASSWORD_METHOD)
+    # The seeded events lie in the past; the lifecycle job would complete and archive them mid-run
+    os.environ.setdefault('CRESCENDO_LIFECYCLE_INTERVAL', '0')
+    from app import create_app
+    import storage
+    app = create_app({'DATABASE': database, 'UPLOAD_FOLDER': os.path.join(upload_root, 'uploads')})
+    app.extensions['storage'] = storage.LocalStorage(upload_root)
+    return app
+
+
+def start_server(app):
+    # A threaded werkzeug server on a free port, like `flask run` without the reloader or the access log
+    from werkzeug.serving import WSGIRequestHandler, make_server
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_request(self, *args, **kwargs):
+            pass
+
+    server = make_server('127.0.0.1', 0, app, threaded=True, request_handler=QuietHandler)
+    threading.Thread(target=server.serve_forever, name='bench-server', daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_port}'
+
+
+def compare(baseline, current, threshold=THRESHOLD, min_delta_ms=MIN_DELTA_MS):
+    # Print every route's change against the baseline and return the regressions as (mode, route, reason)
+    regressions = []
+    for mode, results in current['results'].items():
+        old_results = baseline['results'].get(mode, {})
+        print(f"\n{mode}: p95 and throughput against the baseline")
+        for name, new in results.items():
+            old = old_results.get(name)
+            if old is None:
+                print(f"  {name:<24} (not in the baseline)")
+                continue
+            reasons = []
+            if new['p95_ms'] > old['p95_ms'] * (1 + threshold) and new['p95_ms'] - old['p95_ms'] > min_delta_ms:
+                reasons.append(f"p95 {old['p95_ms']:.2f} -> {new['p95_ms']:.2f} ms")
+            if new['throughput_rps'] < old['throughput_rps'] * (1 - threshold):
+                reasons.append(f"throughput {old['throughput_rps']:.1f} -> {new['throughput_rps']:.1f} req/s")
+            if new['errors'] > old['errors']:
+                reasons.append(f"errors {old['errors']} -> {new['errors']}")
+            p95_change = (new['p95_ms'] / old['p95_ms'] - 1) * 100 if old['p95_ms'] else 0.0
+            rps_change = (new['throughput_rps'] / old['throughput_rps'] - 1) * 100 if old['throughput_rps'] else 0.0
+            flag = "REGRESSION " + "; ".join(reasons) if reasons else ""
+            print(f"  {name:<24} p95 {p95_change:+6.1f}%  req/s {rps_change:+6.1f}%  {flag}")
+            regressions.extend((mode, name, reason) for reason in reasons)
+    return regressions
+
+
+def load_results(path):
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load-test every route of the Crescendo app.")
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--events', type=int, default=10000)
+    parser.add_argument('--bookings', type=int, default=5000)
+    parser.add_argument('--images', type=int, default=2000)
+    parser.add_argument('--database', help="Keep the seeded database at this path and reuse it on later runs "
+                                           "(the write routes change it, so reseed for comparable numbers).")
+    parser.add_argument('--seed-only', action='store_true', help="Seed --database and exit (e.g. for --url).")
+    parser.add_argument('--mode', choices=['client', 'server', 'both'], default='both')
+    parser.add_argument('--url', help="Benchmark a server already running against --database instead of "
+                                      "starting one (implies --mode server).")
+    parser.add_argument('--requests', type=int, default=200, help="Requests per route.")
+    parser.add_argument('--concurrency', type=int, default=4, help="Concurrent sessions.")
+    parser.add_argument('--only', help="Comma-separated route names to run.")
+    parser.add_argument('--output', help="Write the results to this JSON file.")
+    parser.add_argument('--baseline', help="Compare the results with this JSON file; exit 1 on a regression.")
+    parser.add_argument('--compare', nargs=2, metavar=('BASELINE', 'CURRENT'),
+                        help="Only compare two saved result files.")
+    parser.add_argument('--threshold', type=float, default=THRESHOLD,
+                        help="Relative change counted as a regression (default: %(default)s).")
+    args = parser.parse_args()
+
+    if args.compare:
+        regressions = compare(load_results(args.compare[0]), load_results(args.compare[1]), args.threshold)
+        print(f"\n{len(regressions)} regressions")
+        sys.exit(1 if regressions else 0)
+    if args.url and not args.database:
+        parser.error("--url needs --database, the database the server is running against")
+
+    only = set(args.only.split(',')) if args.only else None
+    scale = {'users': args.users, 'events': args.events, 'bookings': args.bookings, 'images': args.images}
+    with tempfile.TemporaryDirectory() as tmp:
+        database = os.path.abspath(args.database or os.path.join(tmp, 'bench.db'))
+        if not os.path.exists(database):
+            started = time.perf_counter()
+            create_database(database, **scale).close()
+            print(f"Seeded {database} ({', '.join(f'{v} {k}' for k, v in scale.items())}) "
+                  f"in {time.perf_counter() - started:.1f}s")
+        if args.seed_only:
+            return
+
+        results = {}
+        if args.url:
+            results['server'] = run_mode(f"server {args.url}", lambda: HttpSession(args.url), database, args, only)
+        else:
+            app = load_app(database, os.path.join(tmp, 'static'))
+            probe = Targets(database, 'probe')
+            probe.upload_url = '/uploads/probe.png'
+            missing = uncovered_routes(app, probe)
+            if missing:
+                print(f"Routes without a scenario: {', '.join(missing)}")
+            if args.mode in ('client', 'both'):
+                results['client'] = run_mode("client", lambda: ClientSession(app), database, args, only)
+            if args.mode in ('server', 'both'):
+                server, url = start_server(app)
+                try:
+                    results['server'] = run_mode(f"server {url}", lambda: HttpSession(url), database, args, only)
+                finally:
+                    server.shutdown()
+
+    report = {
+        'created': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'scale': scale if not args.database else {'database': args.database},
+        'requests': args.requests,
+        'concurrency': args.concurrency,
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+            f.write("\n")
+        print(f"\nWrote {args.output}")
+
+    if args.baseline:
+        regressions = compare(load_results(args.baseline), report, args.threshold)
+        print(f"\n{len(regressions)} regressions")
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
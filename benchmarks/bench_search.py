@@ -0,0 +1,91 @@
+# Measure /search query latency against a large synthetic event table
+#
+#   python -m benchmarks.bench_search --events 1000000
+import argparse
+import bisect
+import itertools
+import os
+import random
+import sqlite3
+import statistics
+import tempfile
+import time
+
+from benchmarks.seed import VENUES, create_database
+from search import search_events, search_users
+
+
+def zipf_vocabulary(rng, size):
+    # Pseudo-words with Zipf-distributed frequencies, like real event descriptions
+    syllables = ["ba", "ce", "di", "fo", "gu", "ha", "ji", "ko", "lu", "ma", "ne", "po", "ra", "si", "tu", "vo"]
+    words = sorted({"".join(rng.choice(syllables) for _ in range(rng.randint(2, 4))) for _ in range(size * 2)})[:size]
+    rng.shuffle(words)
+    cumulative = list(itertools.accumulate(1.0 / rank for rank in range(1, len(words) + 1)))
+    return words, cumulative
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark FTS5 search latency.")
+    parser.add_argument('--events', type=int, default=1000000)
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--vocabulary', type=int, default=20000)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--database', help="Keep the seeded database at this path and reuse it on later runs.")
+    args = parser.parse_args()
+
+    rng = random.Random(9)
+    words, cumulative = zipf_vocabulary(rng, args.vocabulary)
+    total = cumulative[-1]
+
+    def sentence(n):
+        return " ".join(words[bisect.bisect(cumulative, rng.random() * total)] for _ in range(n))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = args.database or os.path.join(tmp, 'bench.db')
+        if os.path.exists(path):
+            conn = sqlite3.connect(path)
+        else:
+            started = time.perf_counter()
+            conn = create_database(path, users=args.users, events=0, bookings=0, images=0)
+            conn.executemany(
+                "INSERT INTO Events (OrganizerUserID, Date, Time, Venue, Description, Status) VALUES (?, ?, ?, ?, ?, ?)",
+                ((1, '2024-01-01', '18:00', rng.choice(VENUES), sentence(12), rng.choice(['pending', 'confirmed']))
+                 for _ in range(args.events)))
+            conn.commit()
+            conn.execute("INSERT INTO EventsSearch (EventsSearch) VALUES ('optimize')")
+            conn.commit()
+            print(f"Seeded and indexed {args.events} events in {time.perf_counter() - started:.1f}s")
+
+        # Queries drawn from the middle of the frequency distribution, typed as prefixes, plus venue names
+        cursor = conn.cursor()
+        rng = random.Random(10)
+        samples = {
+            'one word': [words[rng.randint(50, 5000)] for _ in range(args.queries)],
+            'two words': [f"{words[rng.randint(50, 5000)]} {words[rng.randint(50, 5000)]}" for _ in range(args.queries)],
+            'prefix (3 chars)': [words[rng.randint(50, 5000)][:3] for _ in range(args.queries)],
+            'venue': [rng.choice(VENUES).split()[0] + " " + words[rng.randint(50, 5000)] for _ in range(args.queries)],
+            'page 5': [words[rng.randint(20, 200)] for _ in range(args.queries)],
+        }
+        for label, queries in samples.items():
+            timings = []
+            for query in queries:
+                query_started = time.perf_counter()
+                search_events(cursor, query, page=5 if label == 'page 5' else 1)
+                timings.append((time.perf_counter() - query_started) * 1000)
+            timings.sort()
+            print(f"events, {label:>16}: p50 {statistics.median(timings):.2f} ms, "
+                  f"p95 {timings[int(len(timings) * 0.95) - 1]:.2f} ms, max {timings[-1]:.2f} ms")
+
+        timings = []
+        for _ in range(args.queries):
+            query_started = time.perf_counter()
+            search_users(cursor, f"user{rng.randint(1, args.users)}")
+            timings.append((time.perf_counter() - query_started) * 1000)
+        timings.sort()
+        print(f"users,  {'username':>16}: p50 {statistics.median(timings):.2f} ms, "
+              f"p95 {timings[int(len(timings) * 0.95) - 1]:.2f} ms, max {timings[-1]:.2f} ms")
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+# Measure compile, load and render time of every template, and how well the rendered pages compress
+#
+#   python -m benchmarks.bench_templates --renders 500 --rows 20
+import argparse
+import gzip
+import os
+import random
+import statistics
+import tempfile
+import time
+
+from jinja2 import Environment, FileSystemBytecodeCache
+from markupsafe import Markup
+
+from benchmarks.seed import VENUES, WORDS, create_database
+
+
+def sentence(rng, n):
+    return " ".join(rng.choice(WORDS) for _ in range(n))
+
+
+def contexts(rows, rng):
+    # Representative arguments for each template, shaped like the ones app.py passes
+    import rendering
+
+    def event_row(i):
+        return (i, f"2025-{i % 12 + 1:02d}-{i % 28 + 1:02d}", "19:30", rng.choice(VENUES), sentence(rng, 10))
+
+    available = [rendering.AvailableEvent(*event_row(i), 'pending', f"user{i}") for i in range(rows)]
+    confirmed = [rendering.ConfirmedEvent(*event_row(i), f"user{i}") for i in range(rows)]
+    bookings = [rendering.OrganizationBooking(*event_row(i), i, f"user{i}") for i in range(rows)]
+    notifications = [rendering.Notification(i, 'event_cancelled', {'message': sentence(rng, 8)}) for i in range(3)]
+    images = [(f"uploads/bench_{i}.png", "2025-01-01", rng.choice(VENUES), f"user{i}", i, 800, 600)
+              for i in range(rows)]
+    profile = {'username': 'user1', 'email': 'user1@example.com', 'user_type': 'musician',
+               'profile_info': sentence(rng, 30)}
+    return {
+        'landingpage.html': {},
+        'login.html': {},
+        'register.html': {},
+        'dashboard_available.html': {'events': available, 'available_cursor': 'abc'},
+        'dashboard_confirmed.html': {'confirmed_events': confirmed, 'confirmed_cursor': 'abc'},
+        'home.html': {'available_events': Markup('<table></table>'), 'confirmed_events': Markup('<table></table>'),
+                      'filters': {'date_from': None, 'date_to': None, 'venue': None},
+                      'notifications': notifications},
+        'organization_bookings.html': {'confirmed_events': bookings},
+        'organization.html': {'confirmed_events': Markup('<table></table>'), 'notifications': notifications},
+        'gallery_cards.html': {'images': images, 'sources': {}, 'page': 2, 'has_next': True, 'venue': None},
+        'gallery.html': {'cards': Markup('<div></div>')},
+        'search.html': {'query': 'jazz', 'kind': 'events', 'page': 1, 'has_next': True,
+                        'results': [row[:5] + ('pending', 'user1') for row in map(event_row, range(rows))]},
+        'apply_for_event.html': {'event': (1, 5, "2025-01-01", "19:30", "Tower Theatre", sentence(rng, 10))},
+        'upload.html': {'event_id': 1, 'uploaded_file_url': None},
+        'profile.html': {'user': profile},
+        'profile_edit.html': {'user': profile},
+    }
+
+
+def timed(function, repeat):
+    # Milliseconds per call for each of repeat calls
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark template compile and render times.")
+    parser.add_argument('--renders', type=int, default=500, help="Renders per template.")
+    parser.add_argument('--rows', type=int, default=20, help="Rows in each list (a dashboard page is 20).")
+    parser.add_argument('--compiles', type=int, default=20, help="Compilations and bytecode loads per template.")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        database = os.path.join(tmp, 'bench.db')
+        create_database(database, users=0, events=0, bookings=0, images=0).close()
+        os.environ.setdefault('CRESCENDO_SECRET_KEY', 'benchmark')
+        os.environ.setdefault('CRESCENDO_ACCESS_LOG', '0')
+        from app import create_app
+        app = create_app({'DATABASE': database})
+        import rendering
+
+        templates = contexts(args.rows, random.Random(17))
+        loader = app.jinja_env.loader
+        bytecode_dir = os.path.join(tmp, 'jinja_cache')
+        os.makedirs(bytecode_dir)
+
+        print(f"{'template':<28} {'compile ms':>10} {'cached ms':>10} {'render p50':>11} {'p95 ms':>8} "
+              f"{'bytes':>7} {'gzip':>6} {'gzip ms':>8}" + (f" {'br':>6} {'br ms':>6}" if rendering.brotli else ""))
+        for name, context in templates.items():
+            # Compiling from source (what every worker does on first use without a bytecode cache) against
+            # loading the cached bytecode
+            def load(bytecode_cache):
+                env = Environment(loader=loader, bytecode_cache=bytecode_cache)
+                env.globals.update(app.jinja_env.globals)
+                env.filters.update(app.jinja_env.filters)
+                env.get_template(name)
+            compile_ms = statistics.median(timed(lambda: load(None), args.compiles))
+            load(FileSystemBytecodeCache(bytecode_dir))
+            cached_ms = statistics.median(timed(lambda: load(FileSystemBytecodeCache(bytecode_dir)), args.compiles))
+
+            template = app.jinja_env.get_template(name)
+            with app.test_request_context('/'):
+                app.update_template_context(context)
+                html = template.render(context)
+                renders = timed(lambda: template.render(context), args.renders)
+            data = html.encode()
+            gzip_ms = statistics.median(timed(lambda: gzip.compress(data, rendering.GZIP_LEVEL, mtime=0), 20))
+            line = (f"{name:<28} {compile_ms:>10.2f} {cached_ms:>10.2f} {statistics.median(renders):>11.3f} "
+                    f"{renders[int(len(renders) * 0.95) - 1]:>8.3f} {len(data):>7} "
+                    f"{len(gzip.compress(data, rendering.GZIP_LEVEL, mtime=0)):>6} {gzip_ms:>8.3f}")
+            if rendering.brotli:
+                br_ms = statistics.median(timed(lambda: rendering.brotli.compress(data, quality=rendering.BROTLI_QUALITY),
+                                                20))
+                line += f" {len(rendering.brotli.compress(data, quality=rendering.BROTLI_QUALITY)):>6} {br_ms:>6.3f}"
+            print(line)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+# Synthetic data for benchmarking crescendo.db at scale
+import random
+import sqlite3
+from datetime import date, timedelta
+
+from werkzeug.security import generate_password_hash
+
+VENUES = ["Smith Center", "Tower Theatre", "Saroyan Hall", "Woodward Park", "Fresno Library",
+          "CS50 Fair", "Community Nursing Home", "Fulton Mall", "River Park", "Roeding Park"]
+WORDS = ["jazz", "quartet", "piano", "violin", "festival", "recital", "holiday", "choir", "brunch",
+         "fundraiser", "cello", "acoustic", "guitar", "gala", "orchestra", "trio", "evening", "charity"]
+
+# Every seeded user has the password "Password1", hashed once with a cheap cost so seeding stays fast
+PASSWORD = "Password1"
+PASSWORD_METHOD = 'pbkdf2:sha256:1000'
+PASSWORD_HASH = generate_password_hash(PASSWORD, method=PASSWORD_METHOD)
+
+
+def sentence(rng, n):
+    return " ".join(rng.choice(WORDS) for _ in range(n))
+
+
+def seed(conn, users=1000, events=10000, bookings=5000, images=2000, seed_value=50):
+    # Fill the four Crescendo tables with reproducible random rows in a single transaction
+    rng = random.Random(seed_value)
+    musicians = max(1, users * 4 // 5)
+    start = date(2023, 1, 1)
+
+    conn.executemany(
+        "INSERT INTO Users (Username, Password, Email, UserType, ProfileInformation) VALUES (?, ?, ?, ?, ?)",
+        ((f"user{i}", PASSWORD_HASH, f"user{i}@example.com",
+          'musician' if i <= musicians else 'organization', sentence(rng, 12))
+         for i in range(1, users + 1)))
+
+    conn.executemany(
+        "INSERT INTO Events (OrganizerUserID, Date, Time, Venue, Description, Status) VALUES (?, ?, ?, ?, ?, ?)",
+        ((rng.randint(musicians + 1, users) if users > musicians else 1,
+          (start + timedelta(days=rng.randint(0, 1200))).isoformat(),
+          f"{rng.randint(8, 22):02d}:{rng.choice(['00', '15', '30', '45'])}",
+          rng.choice(VENUES), sentence(rng, 10), rng.choice(['pending', 'confirmed', 'confirmed']))
+         for _ in range(events)))
+
+    # Each booked event gets exactly one confirmed musician
+    booked = rng.sample(range(1, events + 1), min(bookings, events))
+    conn.executemany(
+        "INSERT INTO Bookings (EventID, MusicianUserID, Status, RequestDate) VALUES (?, ?, 'confirmed', '2023-06-01')",
+        ((event_id, rng.randint(1, musicians)) for event_id in booked))
+    # A booked event is no longer open to applications
+    conn.executemany("UPDATE Events SET Status = 'confirmed' WHERE EventID = ?", ((event_id,) for event_id in booked))
+
+    conn.executemany(
+        "INSERT INTO EventImages (EventID, MusicianUserID, ImagePath) VALUES (?, ?, ?)",
+        ((rng.randint(1, events), rng.randint(1, musicians), f"uploads/bench_{i}.png")
+         for i in range(images)))
+    conn.commit()
+
+
+def create_database(path, target=None, **scale):
+    # Build a seeded database at the given schema version (None means fully migrated)
+    from migrate import upgrade
+    conn = sqlite3.connect(path)
+    upgrade(conn, target=target)
+    seed(conn, **scale)
+    return conn
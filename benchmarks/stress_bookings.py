@@ -0,0 +1,100 @@
+# Fire many simultaneous applications at the same pending events and check each ends up with one booking
+#
+#   python -m benchmarks.stress_bookings --applicants 50 --events 20
+import argparse
+import os
+import sqlite3
+import statistics
+import tempfile
+import threading
+import time
+from collections import Counter
+
+import bookings
+from benchmarks.seed import create_database
+from db import connect
+
+
+def applicant(database, event_id, musician_id, barrier, outcomes, latencies, lock):
+    # One musician on their own connection (like a separate worker process), released together with the others
+    conn = connect(database)
+    try:
+        barrier.wait()
+        started = time.perf_counter()
+        try:
+            bookings.apply_for_event(conn, event_id, musician_id)
+            outcome = 'booked'
+        except bookings.AlreadyTaken:
+            outcome = 'taken'
+        except sqlite3.OperationalError as e:
+            outcome = f"error: {e}"
+        elapsed = time.perf_counter() - started
+    finally:
+        conn.close()
+    with lock:
+        outcomes[outcome] += 1
+        latencies.append(elapsed)
+
+
+def run(database, events, applicants):
+    outcomes = Counter()
+    latencies = []
+    lock = threading.Lock()
+    for event_id in range(1, events + 1):
+        barrier = threading.Barrier(applicants)
+        threads = [threading.Thread(target=applicant,
+                                    args=(database, event_id, musician_id, barrier, outcomes, latencies, lock))
+                   for musician_id in range(1, applicants + 1)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    return outcomes, latencies
+
+
+def check(conn, events):
+    # Every contested event must be confirmed with exactly one confirmed booking
+    problems = conn.execute("""
+        SELECT e.EventID, e.Status, COUNT(b.BookingID)
+        FROM Events e LEFT JOIN Bookings b ON b.EventID = e.EventID AND b.Status = 'confirmed'
+        WHERE e.EventID <= ?
+        GROUP BY e.EventID
+        HAVING e.Status != 'confirmed' OR COUNT(b.BookingID) != 1
+    """, (events,)).fetchall()
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stress-test concurrent applications for the same events.")
+    parser.add_argument('--applicants', type=int, default=50, help="musicians applying for each event at once")
+    parser.add_argument('--events', type=int, default=20, help="events to contest, one after another")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        database = os.path.join(tmp, 'stress.db')
+        conn = create_database(database, users=args.applicants + 10, events=args.events, bookings=0, images=0)
+        conn.execute("UPDATE Events SET Status = 'pending'")
+        conn.commit()
+        conn.close()
+
+        started = time.perf_counter()
+        outcomes, latencies = run(database, args.events, args.applicants)
+        elapsed = time.perf_counter() - started
+
+        latencies.sort()
+        print(f"{args.events} events x {args.applicants} applicants in {elapsed:.2f}s")
+        for outcome, count in sorted(outcomes.items()):
+            print(f"  {outcome:<12} {count}")
+        print(f"  latency p50 {statistics.median(latencies) * 1000:.1f} ms, "
+              f"p99 {latencies[int(len(latencies) * 0.99) - 1] * 1000:.1f} ms, max {latencies[-1] * 1000:.1f} ms")
+
+        conn = connect(database)
+        problems = check(conn, args.events)
+        conn.close()
+    if problems or outcomes['booked'] != args.events:
+        raise SystemExit(f"FAILED: {problems or outcomes}")
+    print("OK: every event has exactly one confirmed booking")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+# Booking engine: the first musician to apply for a pending event gets it, however many apply at once
+import cache
+import feed
+import jobs
+from db import write_transaction
+
+
+class BookingError(Exception):
+    pass
+
+
+# The event doesn't exist (any more)
+class EventNotFound(BookingError):
+    pass
+
+
+# Someone else confirmed the event first, or it is no longer open
+class AlreadyTaken(BookingError):
+    pass
+
+
+def _book(conn, event_id, musician_id):
+    # Compare-and-set: only a still-pending event can be claimed, so exactly one concurrent applicant wins
+    claimed = conn.execute("""
+        UPDATE Events SET Status = 'confirmed' WHERE EventID = ? AND Status = 'pending'
+        RETURNING OrganizerUserID, Date, Time, Venue
+    """, (event_id,)).fetchone()
+    if claimed is None:
+        if conn.execute("SELECT 1 FROM Events WHERE EventID = ?", (event_id,)).fetchone() is None:
+            raise EventNotFound(f"Event {event_id} does not exist")
+        raise AlreadyTaken(f"Event {event_id} is no longer available")
+
+    # A musician who had requested this event before has their booking confirmed rather than duplicated
+    booking_id = conn.execute("""
+        INSERT INTO Bookings (EventID, MusicianUserID, Status, RequestDate, ConfirmationDate)
+        VALUES (?, ?, 'confirmed', CURRENT_DATE, CURRENT_DATE)
+        ON CONFLICT (EventID, MusicianUserID) DO UPDATE SET Status = 'confirmed', ConfirmationDate = CURRENT_DATE
+        RETURNING BookingID
+    """, (event_id, musician_id)).fetchone()[0]
+
+    # Everyone else still waiting on this event won't get it
+    conn.execute("UPDATE Bookings SET Status = 'declined' WHERE EventID = ? AND Status = 'requested'", (event_id,))
+
+    # Event lists and bookings served by the API have changed, as have the musician's and organizer's dashboards
+    organizer_id, date, time, venue = claimed
+    cache.invalidate(conn, 'events')
+    cache.invalidate(conn, cache.user_scope(musician_id))
+    cache.invalidate(conn, cache.user_scope(organizer_id))
+
+    # Tell the organizer on their open pages, and take the event off every musician's dashboard
+    musician = conn.execute("SELECT Username FROM Users WHERE UserID = ?", (musician_id,)).fetchone()
+    feed.publish(conn, feed.user_channel(organizer_id), 'booking_confirmed',
+                 f"{musician[0] if musician else 'A musician'} will perform at {venue} on {date} at {time}.",
+                 event_id=event_id, musician_id=musician_id)
+    feed.publish(conn, feed.MUSICIANS, 'event_taken', f"The event at {venue} on {date} has been taken.",
+                 event_id=event_id)
+
+    # Let the organizer know by email in the background, committed together with the booking
+    jobs.enqueue(conn, 'notify_booking_confirmed', {'event_id': event_id, 'musician_id': musician_id}, commit=False)
+    return booking_id
+
+
+def apply_for_event(conn, event_id, musician_id):
+    # Book a pending event for a musician in one BEGIN IMMEDIATE transaction (retried while the database is
+    # busy) and return the BookingID; raises AlreadyTaken or EventNotFound without changing anything
+    return write_transaction(conn, lambda conn: _book(conn, event_id, musician_id))
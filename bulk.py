@@ -0,0 +1,354 @@
+# Bulk import and export of users and events as CSV or JSON Lines (`flask data ...`)
+import csv
+import json
+import os
+import re
+import sys
+import time
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from itertools import islice
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from werkzeug.security import generate_password_hash
+
+import cache
+from auth import USER_TYPES, registration_error
+from db import connect, write_transaction
+
+# Rows inserted per transaction
+BATCH_SIZE = 1000
+
+# Progress is reported after this many rows
+REPORT_EVERY = 10000
+
+# Columns read and written for each kind of record
+USER_EXPORT_COLUMNS = ('user_id', 'username', 'email', 'user_type', 'profile_info')
+EVENT_COLUMNS = ('organizer', 'date', 'time', 'venue', 'description', 'status')
+EVENT_EXPORT_COLUMNS = ('event_id',) + EVENT_COLUMNS
+
+EVENT_STATUSES = ('pending', 'confirmed', 'completed', 'expired')
+DATE_PATTERN = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+TIME_PATTERN = re.compile(r"^\d{2}:\d{2}$")
+
+
+def file_format(path, requested):
+    # --format wins; otherwise .csv means CSV and anything else (.jsonl, .ndjson, stdin) JSON Lines
+    if requested:
+        return requested
+    return 'csv' if path.lower().endswith('.csv') else 'jsonl'
+
+
+def open_data_file(path, mode):
+    # '-' is stdin/stdout; files are opened with newline='' as the csv module expects
+    if path == '-':
+        return nullcontext(sys.stdin if mode == 'r' else sys.stdout)
+    return open(path, mode, encoding='utf-8', newline='')
+
+
+def read_records(f, fmt):
+    # Yield (line number, dict) pairs one at a time, so files of any size stream through
+    if fmt == 'csv':
+        reader = csv.DictReader(f)
+        for record in reader:
+            yield reader.line_num, record
+    else:
+        for line_number, line in enumerate(f, 1):
+            if line.strip():
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    record = None
+                yield line_number, record if isinstance(record, dict) else None
+
+
+def batches(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+# Counts rows as they go by and reports the rate
+class Progress:
+    def __init__(self, label):
+        self.label = label
+        self.started = time.perf_counter()
+        self.rows = 0
+        self._next_report = REPORT_EVERY
+
+    def rate(self):
+        elapsed = time.perf_counter() - self.started
+        return self.rows / elapsed if elapsed else 0.0
+
+    def add(self, count):
+        self.rows += count
+        if self.rows >= self._next_report:
+            click.echo(f"  {self.rows} rows {self.label} ({self.rate():.0f} rows/s)", err=True)
+            self._next_report += REPORT_EVERY
+
+    def done(self):
+        elapsed = time.perf_counter() - self.started
+        click.echo(f"{self.rows} rows {self.label} in {elapsed:.2f}s ({self.rate():.0f} rows/s)", err=True)
+
+
+def validate_user(record, seen_usernames, seen_emails):
+    # The checks register makes, plus duplicates within the file; returns (user, error message), where user has the
+    # record's fields as the strings that are checked and stored
+    if record is None:
+        return None, "Not a JSON object"
+    user = {
+        'username': str(record.get('username') or '').strip(),
+        'password': str(record.get('password') or ''),
+        'email': str(record.get('email') or '').strip(),
+        'user_type': str(record.get('user_type') or ''),
+        'profile_info': str(record.get('profile_info') or ''),
+    }
+    error = registration_error(user['username'], user['password'])
+    if error:
+        return None, error
+    if not user['email']:
+        return None, "Email is required"
+    if user['user_type'] not in USER_TYPES:
+        return None, f"User type must be one of {', '.join(USER_TYPES)}"
+    if user['username'] in seen_usernames or user['email'] in seen_emails:
+        return None, "Username or email appears earlier in the file"
+    seen_usernames.add(user['username'])
+    seen_emails.add(user['email'])
+    return user, None
+
+
+def existing_users(conn, batch):
+    # Usernames and emails of a batch that are already taken, answered from the unique indexes
+    usernames = [user['username'] for _, user in batch]
+    emails = [user['email'] for _, user in batch]
+    placeholders = ",".join("?" * len(batch))
+    rows = conn.execute(f"""
+        SELECT Username, Email FROM Users WHERE Username IN ({placeholders}) OR Email IN ({placeholders})
+    """, usernames + emails).fetchall()
+    return {value for row in rows for value in row}
+
+
+def import_users(conn, records, batch_size=BATCH_SIZE, dry_run=False, workers=None, hash_method=None):
+    # Validate, hash (in a process pool, since hashing is CPU-bound) and insert users one batch per transaction;
+    # returns (rows imported or valid, [(line, error)])
+    progress = Progress('validated' if dry_run else 'imported')
+    errors = []
+    seen_usernames, seen_emails = set(), set()
+    options = {'method': hash_method} if hash_method else {}
+
+    # Validation alone needs no hashing processes
+    pool = None if dry_run else ProcessPoolExecutor(max_workers=workers)
+    try:
+        for batch in batches(records, batch_size):
+            valid = []
+            for line, record in batch:
+                user, error = validate_user(record, seen_usernames, seen_emails)
+                if error:
+                    errors.append((line, error))
+                else:
+                    valid.append((line, user))
+            if valid:
+                taken = existing_users(conn, valid)
+                for line, user in valid:
+                    if user['username'] in taken or user['email'] in taken:
+                        errors.append((line, "Username or email already exists"))
+                valid = [(line, user) for line, user in valid
+                         if user['username'] not in taken and user['email'] not in taken]
+            if not valid:
+                continue
+            if dry_run:
+                progress.add(len(valid))
+                continue
+
+            passwords = [user['password'] for _, user in valid]
+            chunksize = max(1, len(passwords) // ((workers or os.cpu_count() or 1) * 4))
+            hashes = list(pool.map(_hash_password, passwords, [options] * len(passwords), chunksize=chunksize))
+            rows = [(user['username'], password_hash, user['email'], user['user_type'], user['profile_info'])
+                    for (_, user), password_hash in zip(valid, hashes)]
+
+            def insert(conn):
+                conn.executemany("""
+                    INSERT INTO Users (Username, Password, Email, UserType, ProfileInformation) VALUES (?, ?, ?, ?, ?)
+                """, rows)
+                cache.invalidate(conn, 'users')
+            write_transaction(conn, insert)
+            progress.add(len(rows))
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    progress.done()
+    return progress.rows, errors
+
+
+def _hash_password(password, options):
+    return generate_password_hash(password, **options)
+
+
+def parses(text, pattern, fmt):
+    # The right shape and a real date or time (no 2024-02-30 or 25:00)
+    if not pattern.match(text):
+        return False
+    try:
+        datetime.strptime(text, fmt)
+    except ValueError:
+        return False
+    return True
+
+
+def validate_event(record, organizers):
+    # Returns (event, error message), where event has the organizer's ID and the record's other fields as the
+    # strings that are checked and stored
+    if record is None:
+        return None, "Not a JSON object"
+    organizer = str(record.get('organizer') or '').strip()
+    event = {
+        'organizer_id': organizers.get(organizer),
+        'date': str(record.get('date') or '').strip(),
+        'time': str(record.get('time') or '').strip(),
+        'venue': str(record.get('venue') or '').strip(),
+        'description': str(record.get('description') or ''),
+        'status': str(record.get('status') or 'pending'),
+    }
+    if event['organizer_id'] is None:
+        return None, f"Unknown organization '{organizer}'"
+    if not parses(event['date'], DATE_PATTERN, '%Y-%m-%d'):
+        return None, "Date must be a valid YYYY-MM-DD"
+    if not parses(event['time'], TIME_PATTERN, '%H:%M'):
+        return None, "Time must be a valid HH:MM"
+    if not event['venue']:
+        return None, "Venue is required"
+    if event['status'] not in EVENT_STATUSES:
+        return None, f"Status must be one of {', '.join(EVENT_STATUSES)}"
+    return event, None
+
+
+def import_events(conn, records, batch_size=BATCH_SIZE, dry_run=False):
+    # Validate and insert events one batch per transaction; the organizer is given by username (or UserID)
+    progress = Progress('validated' if dry_run else 'imported')
+    errors = []
+    organizers = {}
+    for user_id, username in conn.execute("SELECT UserID, Username FROM Users WHERE UserType = 'organization'"):
+        organizers[username] = user_id
+        organizers[str(user_id)] = user_id
+
+    for batch in batches(records, batch_size):
+        rows = []
+        for line, record in batch:
+            event, error = validate_event(record, organizers)
+            if error:
+                errors.append((line, error))
+                continue
+            rows.append((event['organizer_id'], event['date'], event['time'], event['venue'], event['description'],
+                         event['status']))
+        if rows and not dry_run:
+            def insert(conn):
+                conn.executemany("""
+                    INSERT INTO Events (OrganizerUserID, Date, Time, Venue, Description, Status)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                """, rows)
+                cache.invalidate(conn, 'events')
+            write_transaction(conn, insert)
+        progress.add(len(rows))
+
+    progress.done()
+    return progress.rows, errors
+
+
+EXPORT_QUERIES = {
+    'users': (USER_EXPORT_COLUMNS, """
+        SELECT UserID, Username, Email, UserType, ProfileInformation FROM Users ORDER BY UserID
+    """),
+    'events': (EVENT_EXPORT_COLUMNS, """
+        SELECT e.EventID, u.Username, e.Date, e.Time, e.Venue, e.Description, e.Status
+        FROM Events e LEFT JOIN Users u ON u.UserID = e.OrganizerUserID
+        ORDER BY e.EventID
+    """),
+}
+
+
+def export(conn, kind, f, fmt, batch_size=BATCH_SIZE):
+    # Stream a table out with fetchmany, so memory stays flat however many rows there are
+    columns, sql = EXPORT_QUERIES[kind]
+    progress = Progress('exported')
+    writer = csv.writer(f) if fmt == 'csv' else None
+    if writer:
+        writer.writerow(columns)
+    cursor = conn.execute(sql)
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        if writer:
+            writer.writerows(rows)
+        else:
+            f.writelines(json.dumps(dict(zip(columns, row)), ensure_ascii=False) + "\n" for row in rows)
+        progress.add(len(rows))
+    progress.done()
+    return progress.rows
+
+
+# `flask data ...` commands
+data_cli = AppGroup('data', help="Import and export users and events.")
+
+KINDS = click.Choice(['users', 'events'])
+FORMATS = click.Choice(['csv', 'jsonl'])
+
+
+@data_cli.command('import')
+@click.argument('kind', type=KINDS)
+@click.argument('path', type=click.Path(allow_dash=True))
+@click.option('--format', 'fmt', type=FORMATS, help="File format (default: from the extension).")
+@click.option('--batch-size', type=int, default=BATCH_SIZE, show_default=True, help="Rows per transaction.")
+@click.option('--dry-run', is_flag=True, help="Only validate the file; nothing is written.")
+@click.option('--workers', type=int, default=None, help="Password hashing processes (default: one per CPU).")
+@click.option('--hash-method', default=None, help="werkzeug password hash method (default: PASSWORD_HASH_METHOD).")
+def import_command(kind, path, fmt, batch_size, dry_run, workers, hash_method):
+    """Import users or events from a CSV or JSON Lines file ('-' for stdin).
+
+    Users need username, password, email and user_type (profile_info is optional); events need organizer
+    (username or ID), date, time and venue (description and status are optional). Rows that fail validation
+    are reported and skipped.
+    """
+    fmt = file_format(path, fmt)
+    conn = connect(current_app.config['DATABASE'])
+    try:
+        with open_data_file(path, 'r') as f:
+            records = read_records(f, fmt)
+            if kind == 'users':
+                count, errors = import_users(conn, records, batch_size, dry_run, workers,
+                                             hash_method or current_app.config.get('PASSWORD_HASH_METHOD'))
+            else:
+                count, errors = import_events(conn, records, batch_size, dry_run)
+    finally:
+        conn.close()
+
+    for line, error in errors:
+        click.echo(f"{path}:{line}: {error}", err=True)
+    if errors:
+        raise click.ClickException(f"{len(errors)} invalid rows {'found' if dry_run else 'skipped'}")
+
+
+@data_cli.command('export')
+@click.argument('kind', type=KINDS)
+@click.argument('path', type=click.Path(allow_dash=True))
+@click.option('--format', 'fmt', type=FORMATS, help="File format (default: from the extension).")
+def export_command(kind, path, fmt):
+    """Export users (without passwords) or events to a CSV or JSON Lines file ('-' for stdout)."""
+    fmt = file_format(path, fmt)
+    conn = connect(current_app.config['DATABASE'])
+    try:
+        with open_data_file(path, 'w') as f:
+            export(conn, kind, f, fmt)
+    finally:
+        conn.close()
+
+
+def init_app(app):
+    app.cli.add_command(data_cli)
@@ -0,0 +1,177 @@
+# Two-tier cache for rendered page fragments
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app
+
+from db import get_db
+
+# cachelib (installed with Flask-Session) provides the optional shared tier
+try:
+    from cachelib import FileSystemCache
+except ImportError:
+    FileSystemCache = None
+
+# Generations used as HTTP validators are read from the database at most this often per process, so conditional
+# requests can be answered with a 304 without borrowing a connection
+STAMP_TTL = 1.0
+
+# name -> (generation, updated_at, monotonic time it was read)
+_stamps = {}
+_stamps_lock = threading.Lock()
+
+
+# In-process tier: least-recently-used entries are evicted once the total size passes max_bytes
+class LRUCache:
+    def __init__(self, max_bytes=8 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        size = len(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old)
+            self._entries[key] = value
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= len(evicted)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def size_bytes(self):
+        return self._bytes
+
+
+# Looks in the local LRU first, then the optional shared tier (any cachelib backend), and counts hits
+class FragmentCache:
+    def __init__(self, local, shared=None, timeout=600):
+        self.local = local
+        self.shared = shared
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._counts = {'local_hits': 0, 'shared_hits': 0, 'misses': 0}
+
+    def _count(self, name):
+        with self._lock:
+            self._counts[name] += 1
+
+    def get(self, key):
+        value = self.local.get(key)
+        if value is not None:
+            self._count('local_hits')
+            return value
+        if self.shared is not None:
+            value = self.shared.get(key)
+            if value is not None:
+                self._count('shared_hits')
+                self.local.set(key, value)
+                return value
+        self._count('misses')
+        return None
+
+    def set(self, key, value):
+        self.local.set(key, value)
+        if self.shared is not None:
+            self.shared.set(key, value, timeout=self.timeout)
+
+    def stats(self):
+        with self._lock:
+            counts = dict(self._counts)
+        lookups = sum(counts.values())
+        counts.update({
+            'hit_rate': (counts['local_hits'] + counts['shared_hits']) / lookups if lookups else 0.0,
+            'entries': len(self.local),
+            'bytes': self.local.size_bytes,
+            'max_bytes': self.local.max_bytes,
+            'evictions': self.local.evictions,
+            'shared': type(self.shared).__name__ if self.shared is not None else None,
+        })
+        return counts
+
+
+def get_cache(app=None):
+    # The application's fragment cache, created on first use from the CACHE_* settings
+    app = app or current_app
+    fragment_cache = app.extensions.get('fragment_cache')
+    if fragment_cache is None:
+        shared = None
+        if app.config.get('CACHE_REDIS_URL'):
+            # A Redis server shared by every web node (needs the redis package)
+            import redis
+            from cachelib.redis import RedisCache
+            shared = RedisCache(redis.from_url(app.config['CACHE_REDIS_URL']), key_prefix='crescendo:')
+        elif app.config.get('CACHE_DIR') and FileSystemCache is not None:
+            # A directory shared by the worker processes on one host
+            shared = FileSystemCache(app.config['CACHE_DIR'], threshold=app.config.get('CACHE_SHARED_THRESHOLD', 2000))
+        fragment_cache = FragmentCache(LRUCache(app.config.get('CACHE_MAX_BYTES', 8 * 1024 * 1024)), shared,
+                                       app.config.get('CACHE_TIMEOUT', 600))
+        app.extensions['fragment_cache'] = fragment_cache
+    return fragment_cache
+
+
+def generation(conn, name):
+    # Current generation of a cached data set; it goes into every cache key built from that data
+    row = conn.execute("SELECT Generation FROM CacheGenerations WHERE Name = ?", (name,)).fetchone()
+    return row[0] if row else 0
+
+
+def generations(conn, names):
+    # Current generations of several data sets in one query, in the order of names
+    placeholders = ",".join("?" * len(names))
+    found = dict(conn.execute(f"SELECT Name, Generation FROM CacheGenerations WHERE Name IN ({placeholders})",
+                              list(names)).fetchall())
+    return [found.get(name, 0) for name in names]
+
+
+def user_scope(user_id):
+    # Generation name covering one user's own bookings and events (their dashboard)
+    return f"user:{user_id}"
+
+
+def stamp(name, ttl=STAMP_TTL):
+    # (generation, last change as a Unix time) of a data set, remembered in-process for up to ttl seconds;
+    # other workers' changes therefore show up here at most ttl seconds late
+    now = time.monotonic()
+    with _stamps_lock:
+        entry = _stamps.get(name)
+    if entry is not None and now - entry[2] < ttl:
+        return entry[:2]
+    row = get_db().execute("SELECT Generation, UpdatedAt FROM CacheGenerations WHERE Name = ?", (name,)).fetchone()
+    generation, updated_at = row or (0, 0.0)
+    with _stamps_lock:
+        _stamps[name] = (generation, updated_at, now)
+    return generation, updated_at
+
+
+def invalidate(conn, name):
+    # Bump a generation so every worker's cached fragments for it become unreachable; the caller commits
+    conn.execute("""
+        INSERT INTO CacheGenerations (Name, Generation, UpdatedAt) VALUES (?, 1, ?)
+        ON CONFLICT (Name) DO UPDATE SET Generation = Generation + 1, UpdatedAt = excluded.UpdatedAt
+    """, (name, time.time()))
+    with _stamps_lock:
+        _stamps.pop(name, None)
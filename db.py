@@ -0,0 +1,274 @@
+# Shared SQLite connection layer for crescendo.db
+import os
+import queue
+import random
+import sqlite3
+import threading
+import time
+
+from flask import current_app, g
+
+
+# Pragmas applied once to every new pooled connection
+# - WAL lets readers (gallery, dashboards) proceed while a writer commits
+# - NORMAL sync is durable in WAL mode and avoids an fsync per commit
+# - busy_timeout makes writers wait for the lock instead of failing at once
+CONNECTION_PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA busy_timeout = 5000",
+    "PRAGMA cache_size = -16000",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA mmap_size = 134217728",
+)
+
+
+# Cursor that reports how long each statement took (to its first row) to the connection's observer
+class TracedCursor(sqlite3.Cursor):
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            if self.connection.observer is not None:
+                self.connection.observer(self.connection, sql, parameters, time.perf_counter() - started)
+
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            if self.connection.observer is not None:
+                self.connection.observer(self.connection, sql, None, time.perf_counter() - started)
+
+
+# Connection whose statements all go through TracedCursor; observer(conn, sql, parameters, seconds) is called after
+# each one (parameters is None for executemany)
+class TracedConnection(sqlite3.Connection):
+    observer = None
+
+    def cursor(self, factory=TracedCursor):
+        return super().cursor(factory)
+
+    # sqlite3.Connection.execute would make a plain cursor, bypassing the trace
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+def connect(database, timeout=5.0, **kwargs):
+    # Open a connection with the Crescendo pragmas applied (used by the pool and by background workers)
+    conn = sqlite3.connect(database, timeout=timeout, **kwargs)
+    for pragma in CONNECTION_PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
+# A write transaction that still finds the database locked after busy_timeout is retried this many times,
+# sleeping about BUSY_BACKOFF * 2 ** attempt seconds in between
+BUSY_RETRIES = 5
+BUSY_BACKOFF = 0.05
+
+
+def is_busy(error):
+    # SQLITE_BUSY / SQLITE_LOCKED (including their extended codes), i.e. another connection holds the lock
+    code = getattr(error, 'sqlite_errorcode', None)
+    if code is not None:
+        return code & 0xff in (sqlite3.SQLITE_BUSY, sqlite3.SQLITE_LOCKED)
+    return isinstance(error, sqlite3.OperationalError) and 'locked' in str(error)
+
+
+def write_transaction(conn, work, retries=BUSY_RETRIES, backoff=BUSY_BACKOFF):
+    # Run work(conn) in a BEGIN IMMEDIATE transaction and commit it, returning work's result. Taking the write
+    # lock up front means concurrent writers queue at BEGIN instead of failing halfway through; if the lock
+    # still can't be had, the whole transaction is retried with backoff. Any exception rolls it back.
+    for attempt in range(retries + 1):
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = work(conn)
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+            return result
+        except sqlite3.OperationalError as e:
+            if not is_busy(e) or attempt == retries:
+                raise
+            time.sleep(backoff * 2 ** attempt * random.uniform(0.5, 1.5))
+
+
+# Raised when no connection becomes free within the pool timeout
+class PoolTimeout(sqlite3.OperationalError):
+    pass
+
+
+# A bounded pool of warm connections to a single SQLite database file
+class ConnectionPool:
+    def __init__(self, database, size=8, timeout=5.0, cached_statements=256, observer=None):
+        self.database = database
+        self.pid = os.getpid()
+        self.size = size
+        self.timeout = timeout
+        self.cached_statements = cached_statements
+        # With an observer, connections are TracedConnections reporting every statement to it
+        self.observer = observer
+
+        # Most recently returned connection is handed out first so its page and statement caches stay hot
+        self._idle = queue.LifoQueue(maxsize=size)
+        self._lock = threading.Lock()
+        self._created = 0
+        self._in_use = 0
+
+        # Counters reported by stats()
+        self._peak_in_use = 0
+        self._acquired = 0
+        self._waits = 0
+        self._timeouts = 0
+        self._wait_seconds = 0.0
+
+    def _connect(self):
+        # check_same_thread is off because a connection may be returned by a different thread than the one that
+        # opened it; the pool guarantees only one request uses a connection at a time
+        if self.observer is None:
+            return connect(self.database, timeout=self.timeout, check_same_thread=False,
+                           cached_statements=self.cached_statements)
+        conn = connect(self.database, timeout=self.timeout, check_same_thread=False,
+                       cached_statements=self.cached_statements, factory=TracedConnection)
+        conn.observer = self.observer
+        return conn
+
+    def acquire(self):
+        # Reuse an idle connection when one is available
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            conn = None
+
+        # Otherwise open a new one if the pool has not reached its bound yet
+        if conn is None:
+            with self._lock:
+                can_create = self._created < self.size
+                if can_create:
+                    self._created += 1
+            if can_create:
+                try:
+                    conn = self._connect()
+                except sqlite3.Error:
+                    with self._lock:
+                        self._created -= 1
+                    raise
+
+        # The pool is saturated, so wait for another request to give a connection back
+        if conn is None:
+            started = time.perf_counter()
+            try:
+                conn = self._idle.get(timeout=self.timeout)
+            except queue.Empty:
+                with self._lock:
+                    self._waits += 1
+                    self._timeouts += 1
+                    self._wait_seconds += time.perf_counter() - started
+                raise PoolTimeout(f"No database connection available after {self.timeout}s")
+            with self._lock:
+                self._waits += 1
+                self._wait_seconds += time.perf_counter() - started
+
+        with self._lock:
+            self._acquired += 1
+            self._in_use += 1
+            self._peak_in_use = max(self._peak_in_use, self._in_use)
+        return conn
+
+    def release(self, conn):
+        # Never hand out a connection with a half-finished transaction
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            # A broken connection is dropped and will be replaced on demand
+            conn.close()
+            with self._lock:
+                self._in_use -= 1
+                self._created -= 1
+            return
+
+        with self._lock:
+            self._in_use -= 1
+        self._idle.put_nowait(conn)
+
+    def close(self):
+        # Close every idle connection (used at shutdown and in scripts)
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._created -= 1
+
+    def stats(self):
+        # Snapshot of pool usage; saturation is the share of the bound currently checked out
+        with self._lock:
+            return {
+                'size': self.size,
+                'open': self._created,
+                'in_use': self._in_use,
+                'idle': self._idle.qsize(),
+                'peak_in_use': self._peak_in_use,
+                'saturation': self._in_use / self.size if self.size else 0.0,
+                'acquired': self._acquired,
+                'waits': self._waits,
+                'timeouts': self._timeouts,
+                'wait_seconds': round(self._wait_seconds, 6),
+            }
+
+
+# Pools inherited from a parent process are kept referenced but never used or closed: closing a SQLite connection
+# opened before a fork can release locks and run checkpoints that belong to the parent
+_inherited_pools = []
+
+# Serialises creating pools, so threads making their first requests at once all end up sharing the same one
+_pools_lock = threading.Lock()
+
+
+def get_pool(app=None, name='db_pool', size=None):
+    # Each application keeps its own pool per process, created on first use: 'db_pool' hands out the requests'
+    # connections, other names keep separate connections for writes that must not share a request's transaction
+    app = app or current_app
+    pool = app.extensions.get(name)
+    if pool is not None and pool.pid == os.getpid():
+        return pool
+    with _pools_lock:
+        # Another thread may have created it while this one waited
+        pool = app.extensions.get(name)
+        if pool is None or pool.pid != os.getpid():
+            if pool is not None:
+                _inherited_pools.append(pool)
+            pool = ConnectionPool(app.config['DATABASE'],
+                                  size=size or app.config.get('DB_POOL_SIZE', 8),
+                                  timeout=app.config.get('DB_POOL_TIMEOUT', 5.0),
+                                  observer=app.extensions.get('query_observer'))
+            app.extensions[name] = pool
+    return pool
+
+
+def get_db():
+    # Hand out one pooled connection per app context (i.e. per request)
+    if 'db' not in g:
+        g.db = get_pool().acquire()
+    return g.db
+
+
+def close_db(exception=None):
+    # Return the request's connection to the pool on teardown
+    conn = g.pop('db', None)
+    if conn is not None:
+        get_pool().release(conn)
+
+
+def init_app(app):
+    app.teardown_appcontext(close_db)
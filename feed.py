@@ -0,0 +1,230 @@
+# Live notifications: stored in the Notifications table and pushed to open pages over Server-Sent Events
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+from flask import current_app, g, has_app_context
+
+from db import connect
+
+# Channel every musician listens on (new events, events that are no longer available)
+MUSICIANS = 'musicians'
+
+# How often each process's broker looks for notifications published by other processes
+POLL_INTERVAL = 1.0
+
+# Idle streams get a comment line this often so proxies and load balancers don't time them out
+HEARTBEAT_SECONDS = 15.0
+
+# Most notifications replayed to a stream that reconnects with Last-Event-ID
+CATCH_UP_LIMIT = 100
+
+# Notifications buffered per stream; a client that falls further behind is disconnected and catches up on reconnect
+QUEUE_SIZE = 256
+
+# Set whenever a notification is published so this process's broker delivers it without waiting for the next poll
+_wakeup = threading.Event()
+
+
+def user_channel(user_id):
+    return f"user:{user_id}"
+
+
+def channels_for(user):
+    # Channels a logged-in user's streams subscribe to
+    channels = [user_channel(user['id'])]
+    if user['user_type'] == 'musician':
+        channels.append(MUSICIANS)
+    return channels
+
+
+def publish(conn, channel, kind, message, **data):
+    # Record a notification for a channel and return its ID; the caller commits, which is what makes it visible
+    payload = dict(data, message=message)
+    cursor = conn.execute("INSERT INTO Notifications (Channel, Kind, Payload, CreatedAt) VALUES (?, ?, ?, ?)",
+                          (channel, kind, json.dumps(payload), time.time()))
+    _wakeup.set()
+    if has_app_context():
+        # Wake the broker again once the request has committed (see init_app)
+        g.feed_published = True
+    return cursor.lastrowid
+
+
+def since(conn, channels, after, limit=CATCH_UP_LIMIT):
+    # Notifications on the given channels newer than an ID, oldest first: rows of (NotificationID, Kind, Payload)
+    placeholders = ",".join("?" * len(channels))
+    return conn.execute(f"""
+        SELECT NotificationID, Kind, Payload FROM Notifications
+        WHERE Channel IN ({placeholders}) AND NotificationID > ?
+        ORDER BY NotificationID
+        LIMIT ?
+    """, list(channels) + [after, limit]).fetchall()
+
+
+def unread(conn, user_id, limit=20):
+    # A user's own notifications that they haven't seen yet, newest first, as (NotificationID, Kind, payload dict)
+    rows = conn.execute("""
+        SELECT n.NotificationID, n.Kind, n.Payload FROM Notifications n
+        WHERE n.Channel = ?
+          AND n.NotificationID > COALESCE((SELECT LastSeenID FROM NotificationReads WHERE UserID = ?), 0)
+        ORDER BY n.NotificationID DESC
+        LIMIT ?
+    """, (user_channel(user_id), user_id, limit)).fetchall()
+    return [(notification_id, kind, json.loads(payload)) for notification_id, kind, payload in rows]
+
+
+def mark_seen(conn, user_id, notification_id):
+    # Remember the newest notification the user has seen; the caller commits
+    conn.execute("""
+        INSERT INTO NotificationReads (UserID, LastSeenID) VALUES (?, ?)
+        ON CONFLICT (UserID) DO UPDATE SET LastSeenID = MAX(LastSeenID, excluded.LastSeenID)
+    """, (user_id, notification_id))
+
+
+def prune(conn, older_than):
+    # Delete notifications created before a Unix time; the caller commits
+    return conn.execute("DELETE FROM Notifications WHERE CreatedAt < ?", (older_than,)).rowcount
+
+
+# One open stream's buffer of notifications waiting to be sent
+class Subscription:
+    def __init__(self, channels):
+        self.channels = channels
+        self.queue = queue.Queue(maxsize=QUEUE_SIZE)
+        self.overflowed = False
+
+
+# Fans notifications out to the streams open in this process. A single thread per process polls the table (or is
+# woken by publish), so idle streams cost no database work and hold no pooled connection.
+class Broker:
+    def __init__(self, database, poll_interval=POLL_INTERVAL, logger=None):
+        self.database = database
+        self.pid = os.getpid()
+        self.poll_interval = poll_interval
+        self.logger = logger
+        self.last_id = 0
+        self._subscribers = {}
+        self._lock = threading.Lock()
+        self._started = threading.Event()
+        self._thread = None
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name='notification-broker', daemon=True)
+            self._thread.start()
+        self._started.wait()
+
+    def subscribe(self, channels):
+        self.start()
+        subscription = Subscription(channels)
+        with self._lock:
+            for channel in channels:
+                self._subscribers.setdefault(channel, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            for channel in subscription.channels:
+                subscribers = self._subscribers.get(channel)
+                if subscribers is not None:
+                    subscribers.discard(subscription)
+                    if not subscribers:
+                        del self._subscribers[channel]
+
+    def stream_count(self):
+        with self._lock:
+            return len({subscription for subscribers in self._subscribers.values() for subscription in subscribers})
+
+    def _deliver(self, rows):
+        with self._lock:
+            for notification_id, channel, kind, payload in rows:
+                for subscription in self._subscribers.get(channel, ()):
+                    if subscription.overflowed:
+                        continue
+                    try:
+                        subscription.queue.put_nowait((notification_id, kind, payload))
+                    except queue.Full:
+                        # End the stream rather than block the broker; the client reconnects and catches up
+                        subscription.overflowed = True
+
+    def _run(self):
+        conn = connect(self.database, check_same_thread=False)
+        try:
+            self.last_id = conn.execute("SELECT COALESCE(MAX(NotificationID), 0) FROM Notifications").fetchone()[0]
+            self._started.set()
+            while True:
+                _wakeup.wait(self.poll_interval)
+                _wakeup.clear()
+                try:
+                    rows = conn.execute("""
+                        SELECT NotificationID, Channel, Kind, Payload FROM Notifications
+                        WHERE NotificationID > ?
+                        ORDER BY NotificationID
+                        LIMIT 1000
+                    """, (self.last_id,)).fetchall()
+                except sqlite3.Error:
+                    if self.logger is not None:
+                        self.logger.exception("Notification broker failed to poll")
+                    time.sleep(self.poll_interval)
+                    continue
+                if rows:
+                    self.last_id = rows[-1][0]
+                    self._deliver(rows)
+        finally:
+            self._started.set()
+            conn.close()
+
+
+def get_broker(app=None):
+    # The application's broker in this process, created on first use; its thread starts with the first subscription
+    # (a broker inherited through a fork has lost its thread, so a forked worker makes its own)
+    app = app or current_app
+    broker = app.extensions.get('notification_broker')
+    if broker is None or broker.pid != os.getpid():
+        broker = Broker(app.config['DATABASE'], app.config.get('FEED_POLL_INTERVAL', POLL_INTERVAL), app.logger)
+        app.extensions['notification_broker'] = broker
+    return broker
+
+
+def server_sent_event(notification_id, kind, payload):
+    # One SSE message; payload is already JSON
+    return f"id: {notification_id}\nevent: {kind}\ndata: {payload}\n\n"
+
+
+def stream(broker, subscription, backlog, after):
+    # Body of a text/event-stream response: missed notifications first, then live ones as they arrive
+    try:
+        yield f"retry: {int(POLL_INTERVAL * 5000)}\n\n"
+        last = after
+        for notification_id, kind, payload in backlog:
+            yield server_sent_event(notification_id, kind, payload)
+            last = notification_id
+        while True:
+            try:
+                notification_id, kind, payload = subscription.queue.get(timeout=HEARTBEAT_SECONDS)
+            except queue.Empty:
+                if subscription.overflowed:
+                    return
+                yield ": keep-alive\n\n"
+                continue
+            # The backlog and the live queue can overlap right after subscribing
+            if notification_id > last:
+                last = notification_id
+                yield server_sent_event(notification_id, kind, payload)
+    finally:
+        broker.unsubscribe(subscription)
+
+
+def wake_after_request(exception=None):
+    # publish() runs before its transaction commits, so the broker may look too early; look again at teardown
+    if g.pop('feed_published', False):
+        _wakeup.set()
+
+
+def init_app(app):
+    app.teardown_appcontext(wake_after_request)
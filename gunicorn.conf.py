@@ -0,0 +1,48 @@
+# gunicorn settings for serving crescendo in production:
+#
+#   gunicorn -c gunicorn.conf.py wsgi:app
+#
+# The application is built once in the master (preload_app) and forked into the workers, so migrations, the secret
+# key and template compilation happen once and the workers share that memory copy-on-write. Each worker then opens
+# its own connections and starts its own threads (see app.start_worker).
+#
+#   kill -HUP <master>    restart the workers gracefully with the same code (it is preloaded)
+#   kill -USR2 <master>   start a new master with new code next to the old one; then kill -TERM the old master
+import os
+
+bind = os.environ.get('CRESCENDO_BIND', '127.0.0.1:8000')
+
+# SQLite takes one writer at a time and most requests are short reads, so a process per core, with a few threads
+# each to overlap waiting on the database, storage and password hashing, makes the best use of the machine.
+# Each open notification stream holds a gthread thread; CRESCENDO_WORKER_CLASS=gevent (optional) holds thousands.
+workers = int(os.environ.get('CRESCENDO_WORKERS', os.cpu_count() or 1))
+worker_class = os.environ.get('CRESCENDO_WORKER_CLASS', 'gthread')
+threads = int(os.environ.get('CRESCENDO_THREADS', 8))
+worker_connections = int(os.environ.get('CRESCENDO_WORKER_CONNECTIONS', 1000))
+
+preload_app = True
+
+# Replace each worker after a jittered number of requests, so slow growth in memory stays bounded and the workers
+# don't all restart at once
+max_requests = 5000
+max_requests_jitter = 500
+
+# A worker that stops answering the master for timeout seconds is replaced. On a restart or shutdown, workers finish
+# the requests in hand and their running jobs within graceful_timeout seconds.
+timeout = 60
+graceful_timeout = 30
+keepalive = 5
+
+# The application logs each request itself as a JSON line on stderr
+accesslog = None
+errorlog = '-'
+
+
+def post_worker_init(worker):
+    from app import start_worker
+    start_worker(worker.wsgi)
+
+
+def worker_exit(server, worker):
+    from app import shutdown
+    shutdown(worker.wsgi, graceful_timeout)
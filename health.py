@@ -0,0 +1,63 @@
+# Probes for the process manager or load balancer: /healthz says the process is up and serving (nothing is checked,
+# so a slow database never gets a live worker restarted), /readyz says whether it can serve real requests, i.e. the
+# database answers, its schema is current and the upload directory is writable
+import os
+import sqlite3
+
+from flask import current_app, jsonify
+
+from db import get_db
+from migrate import load_migrations
+
+
+def liveness():
+    response = jsonify(status='alive')
+    response.cache_control.no_store = True
+    return response
+
+
+def check_database(expected_version):
+    # A pooled connection (so an exhausted pool also counts as not ready) and the applied migration version
+    try:
+        version = get_db().execute("SELECT MAX(Version) FROM SchemaVersion").fetchone()[0] or 0
+    except sqlite3.Error as e:
+        return f"error: {e}"
+    if version < expected_version:
+        return f"schema at version {version}, expected {expected_version}"
+    return 'ok'
+
+
+def check_uploads(app):
+    # Only local storage has a directory to check
+    if app.config.get('STORAGE_BACKEND', 'local') != 'local':
+        return 'ok'
+    folder = app.config['UPLOAD_FOLDER']
+    if not os.path.isdir(folder):
+        return f"{folder} is missing"
+    if not os.access(folder, os.W_OK | os.X_OK):
+        return f"{folder} is not writable"
+    return 'ok'
+
+
+def readiness():
+    app = current_app
+    checks = {
+        'database': check_database(app.extensions['schema_version']),
+        'uploads': check_uploads(app),
+    }
+    ready = all(result == 'ok' for result in checks.values())
+    response = jsonify(status='ready' if ready else 'unavailable', checks=checks)
+    response.status_code = 200 if ready else 503
+    response.cache_control.no_store = True
+    return response
+
+
+def init_app(app):
+    # The newest migration shipped with this code, which a ready database must have applied
+    migrations = load_migrations()
+    app.extensions['schema_version'] = migrations[-1][0] if migrations else 0
+    # Create the upload directory once at startup rather than on the first upload
+    if app.config.get('STORAGE_BACKEND', 'local') == 'local':
+        os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+    app.add_url_rule('/healthz', 'healthz', liveness)
+    app.add_url_rule('/readyz', 'readyz', readiness)
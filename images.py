@@ -0,0 +1,208 @@
+# Responsive renditions of uploaded gallery images
+import io
+import os
+import sqlite3
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+
+from cache import invalidate
+from jobs import task
+
+from storage import BLOBS_PREFIX, get_storage
+
+# Pillow is optional: without it uploads are served as they were uploaded
+try:
+    from PIL import Image, ImageOps, UnidentifiedImageError, features
+    from PIL.Image import DecompressionBombError
+except ImportError:
+    Image = None
+
+    # Never raised without Pillow; defined so the except clauses below still name exception classes
+    class UnidentifiedImageError(OSError):
+        pass
+
+    class DecompressionBombError(Exception):
+        pass
+
+# Widths (in pixels) of the downscaled copies made for every upload
+RENDITION_WIDTHS = (320, 640, 1280)
+
+# Encoder settings per output format, best compression first; JPEG is always produced as the fallback
+FORMATS = (
+    ('avif', 'AVIF', {'quality': 55}),
+    ('webp', 'WEBP', {'quality': 78, 'method': 4}),
+    ('jpeg', 'JPEG', {'quality': 82, 'optimize': True, 'progressive': True}),
+)
+
+# Renditions are stored next to the uploads, relative to the 'static' folder like EventImages.ImagePath
+RENDITIONS_FOLDER = 'uploads/renditions'
+
+
+def enabled_formats():
+    # Modern formats are only used when this Pillow build can encode them
+    if Image is None:
+        return []
+    return [fmt for fmt in FORMATS if fmt[0] == 'jpeg' or features.check(fmt[0])]
+
+
+def target_widths(original_width):
+    # Never upscale; an image narrower than the smallest width gets a single re-encoded copy
+    widths = [width for width in RENDITION_WIDTHS if width < original_width]
+    return widths or [original_width]
+
+
+def rendition_stem(image_path):
+    # Renditions are named after the file they are made from, so gallery images sharing a blob share them too: a
+    # blob's hash, or for an upload saved before content-addressed storage its file name ('photo.jpg' -> 'photo-jpg',
+    # so 'photo.png' gets its own)
+    name = os.path.basename(image_path)
+    if image_path.startswith(BLOBS_PREFIX + '/'):
+        return os.path.splitext(name)[0]
+    return name.replace('.', '-')
+
+
+def make_renditions(storage, image_path):
+    # Write every rendition of one file to storage and return (format, width, height, path, bytes) rows
+    if Image is None:
+        return [], None
+
+    with storage.open(image_path) as f, Image.open(f) as original:
+        # Bake the EXIF orientation into the pixels; the EXIF block itself is not copied to the renditions
+        image = ImageOps.exif_transpose(original)
+        image.load()
+    size = image.size
+
+    stem = rendition_stem(image_path)
+    has_alpha = image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info)
+    rows = []
+    for width in target_widths(image.width):
+        resized = image.copy()
+        resized.thumbnail((width, width * 10), Image.LANCZOS)
+        for extension, pil_format, options in enabled_formats():
+            # JPEG has no alpha channel; the other formats keep it
+            mode = 'RGBA' if has_alpha and pil_format != 'JPEG' else 'RGB'
+            encoded = resized if resized.mode == mode else resized.convert(mode)
+            buffer = io.BytesIO()
+            encoded.save(buffer, pil_format, **options)
+            path = f"{RENDITIONS_FOLDER}/{stem}-{width}.{extension}"
+            storage.write(path, buffer.getvalue())
+            rows.append((extension, resized.width, resized.height, path, buffer.tell()))
+    return rows, size
+
+
+def shared_renditions(conn, image_id, image_path):
+    # The renditions and size already made for another gallery image of the same file, or ([], None)
+    row = conn.execute("""
+        SELECT i.ImageID, i.Width, i.Height FROM EventImages i
+        WHERE i.ImagePath = ? AND i.ImageID != ? AND i.Width IS NOT NULL
+          AND EXISTS (SELECT 1 FROM EventImageRenditions r WHERE r.ImageID = i.ImageID)
+        LIMIT 1
+    """, (image_path, image_id)).fetchone()
+    if row is None:
+        return [], None
+    renditions = conn.execute(
+        "SELECT Format, Width, Height, Path, Bytes FROM EventImageRenditions WHERE ImageID = ?", (row[0],)).fetchall()
+    return renditions, (row[1], row[2])
+
+
+def process_image(conn, image_id, storage=None, force=False):
+    # Record the renditions of one EventImages row, reusing those of another image of the same file unless force
+    # is set, in which case the file is decoded and encoded again
+    storage = storage or get_storage()
+    row = conn.execute("SELECT ImagePath FROM EventImages WHERE ImageID = ?", (image_id,)).fetchone()
+    if row is None:
+        return 0
+
+    renditions, size = ([], None) if force else shared_renditions(conn, image_id, row[0])
+    if size is None:
+        renditions, size = make_renditions(storage, row[0])
+    if size is None:
+        return 0
+
+    old_paths = {path for path, in conn.execute("SELECT Path FROM EventImageRenditions WHERE ImageID = ?",
+                                                (image_id,))}
+    conn.execute("DELETE FROM EventImageRenditions WHERE ImageID = ?", (image_id,))
+    conn.executemany(
+        "INSERT INTO EventImageRenditions (ImageID, Format, Width, Height, Path, Bytes) VALUES (?, ?, ?, ?, ?, ?)",
+        [(image_id,) + tuple(rendition) for rendition in renditions])
+    conn.execute("UPDATE EventImages SET Width = ?, Height = ? WHERE ImageID = ?", size + (image_id,))
+    # Files of the image's previous renditions that no image uses any more, e.g. ones named before renditions
+    # were shared
+    stale = [path for path in old_paths - {rendition[3] for rendition in renditions}
+             if conn.execute("SELECT 1 FROM EventImageRenditions WHERE Path = ?", (path,)).fetchone() is None]
+    # Cached gallery pages still point at the original
+    invalidate(conn, 'gallery')
+    conn.commit()
+    for path in stale:
+        storage.delete(path)
+    return len(renditions)
+
+
+# Background job queued by upload_file so the request doesn't wait on the encoders
+@task('process_image')
+def process_image_task(conn, image_id):
+    try:
+        process_image(conn, image_id)
+    except UnidentifiedImageError:
+        # Retrying won't help a file Pillow can't decode; the gallery keeps showing the original
+        current_app.logger.warning("Image %s could not be decoded, no renditions made", image_id)
+    except DecompressionBombError:
+        # Nor one over Pillow's pixel limit, which would fail the same way on every attempt
+        current_app.logger.warning("Image %s is too large to decode safely, no renditions made", image_id)
+
+
+def responsive_sources(conn, image_ids):
+    # Map ImageID -> {'avif'/'webp'/'jpeg': srcset string, 'src': smallest JPEG URL} for the gallery
+    if not image_ids:
+        return {}
+    placeholders = ",".join("?" * len(image_ids))
+    rows = conn.execute(f"""
+        SELECT ImageID, Format, Width, Path FROM EventImageRenditions
+        WHERE ImageID IN ({placeholders})
+        ORDER BY ImageID, Format, Width
+    """, list(image_ids)).fetchall()
+
+    storage = get_storage()
+    sources = {}
+    for image_id, fmt, width, path in rows:
+        entry = sources.setdefault(image_id, {})
+        url = storage.url(path)
+        entry[fmt] = entry[fmt] + f", {url} {width}w" if fmt in entry else f"{url} {width}w"
+        if fmt == 'jpeg' and 'src' not in entry:
+            entry['src'] = url
+    return sources
+
+
+# `flask images ...` commands
+images_cli = AppGroup('images', help="Manage gallery image renditions.")
+
+
+@images_cli.command('backfill')
+@click.option('--force', is_flag=True, help="Regenerate renditions that already exist.")
+def backfill_command(force):
+    """Create renditions for existing uploads."""
+    if Image is None:
+        raise click.ClickException("Pillow is not installed.")
+
+    conn = sqlite3.connect(current_app.config['DATABASE'])
+    try:
+        sql = "SELECT ImageID, ImagePath FROM EventImages"
+        if not force:
+            sql += " WHERE ImageID NOT IN (SELECT ImageID FROM EventImageRenditions)"
+        # With --force each file is still encoded once; its other images reuse those renditions
+        encoded = set()
+        for image_id, image_path in conn.execute(sql).fetchall():
+            try:
+                count = process_image(conn, image_id, force=force and image_path not in encoded)
+                encoded.add(image_path)
+                click.echo(f"{image_path}: {count} renditions")
+            except (OSError, DecompressionBombError) as e:
+                click.echo(f"{image_path}: skipped ({e})", err=True)
+    finally:
+        conn.close()
+
+
+def init_app(app):
+    app.cli.add_command(images_cli)
@@ -0,0 +1,361 @@
+# Observability: request and SQL timings exported at /metrics (Prometheus text format), a slow-query log with query
+# plans, structured JSON logs written off the request thread, and an opt-in per-request profiler
+import atexit
+import bisect
+import cProfile
+import functools
+import hmac
+import json
+import logging
+import os
+import queue
+import re
+import sqlite3
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+from flask import Response, abort, current_app, g, has_app_context, request
+from flask.logging import default_handler
+
+import cache
+from db import get_db, get_pool
+
+# Statements slower than this (milliseconds, to their first row) are logged with their EXPLAIN QUERY PLAN
+SLOW_QUERY_MS = 100
+
+# A request carrying this header is profiled when PROFILER_ENABLED is set
+PROFILE_HEADER = 'X-Crescendo-Profile'
+
+# Functions listed in the log entry of a profiled request
+PROFILE_TOP = 15
+
+# Histogram buckets, in seconds
+REQUEST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+
+
+def _label_value(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_label_value(value)}"' for name, value in pairs) + '}'
+
+
+# A counter per combination of label values. Metrics live in the process that records them; under several workers
+# each one exports its own, and Prometheus sums them across scrape targets.
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels=(), amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = sorted(self._values.items())
+        lines.extend(f"{self.name}{_labels(self.labelnames, labels)} {value}" for labels, value in values)
+        return lines
+
+
+# Bucket counts and the sum of observed values per combination of label values
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=REQUEST_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels, value):
+        # Only the value's own bucket is counted here; render() makes the counts cumulative
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts is None:
+                # One count per bucket plus one above the last bound, then the sum
+                counts = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            values = sorted((labels, list(counts)) for labels, counts in self._values.items())
+        for labels, counts in values:
+            total = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                total += count
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, labels, [('le', bound)])} {total}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, labels)} {counts[-1]:.6f}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, labels)} {total}")
+        return lines
+
+
+REQUESTS = Counter('crescendo_requests_total', "Requests handled, by endpoint, method and status.",
+                   ('endpoint', 'method', 'status'))
+REQUEST_SECONDS = Histogram('crescendo_request_duration_seconds', "Time spent handling a request.",
+                            ('endpoint', 'method'), REQUEST_BUCKETS)
+QUERY_SECONDS = Histogram('crescendo_db_query_duration_seconds',
+                          "Time each SQL statement took to its first row, by statement and table.",
+                          ('statement',), QUERY_BUCKETS)
+SLOW_QUERIES = Counter('crescendo_db_slow_queries_total', "Statements slower than SLOW_QUERY_MS.", ('statement',))
+METRICS = (REQUESTS, REQUEST_SECONDS, QUERY_SECONDS, SLOW_QUERIES)
+
+STATEMENT_VERB = re.compile(r"^\s*(\w+)")
+STATEMENT_TABLE = re.compile(r"\b(?:FROM|INTO|UPDATE|JOIN)\s+(\w+)", re.IGNORECASE)
+
+# SQL text -> metric label; the app's statements are constants, so this stays small (but is bounded anyway)
+_statement_labels = {}
+MAX_STATEMENT_LABELS = 512
+
+
+def statement_label(sql):
+    # 'SELECT Events', 'INSERT Bookings', 'BEGIN': a label with few distinct values, unlike the SQL itself
+    label = _statement_labels.get(sql)
+    if label is None:
+        verb = STATEMENT_VERB.match(sql)
+        table = STATEMENT_TABLE.search(sql)
+        label = verb.group(1).upper() if verb is not None else 'OTHER'
+        if table is not None:
+            label += ' ' + table.group(1)
+        if len(_statement_labels) < MAX_STATEMENT_LABELS:
+            _statement_labels[sql] = label
+    return label
+
+
+def compact_sql(sql):
+    return ' '.join(sql.split())
+
+
+# Observer of the pool's TracedConnections (see db.ConnectionPool): times every statement, counts them per request
+# and logs slow ones with their query plan
+class QueryObserver:
+    def __init__(self, logger, slow_ms=SLOW_QUERY_MS):
+        self.logger = logger
+        self.slow_seconds = slow_ms / 1000
+        # Query plans of slow statements, so a statement that is always slow is only explained once
+        self._plans = {}
+
+    def __call__(self, conn, sql, parameters, seconds):
+        label = statement_label(sql)
+        QUERY_SECONDS.observe((label,), seconds)
+        if has_app_context():
+            g.query_count = g.get('query_count', 0) + 1
+            g.query_seconds = g.get('query_seconds', 0.0) + seconds
+        if seconds >= self.slow_seconds:
+            SLOW_QUERIES.inc((label,))
+            self.logger.warning("Slow query", extra={'fields': {
+                'statement': label, 'duration_ms': round(seconds * 1000, 2), 'sql': compact_sql(sql),
+                'batch': parameters is None, 'plan': self.plan(conn, sql, parameters)}})
+
+    def plan(self, conn, sql, parameters):
+        # EXPLAIN QUERY PLAN with the same parameters, on the same connection, bypassing the trace
+        if sql in self._plans:
+            return self._plans[sql]
+        if parameters is None:
+            return None
+        try:
+            rows = sqlite3.Connection.execute(conn, "EXPLAIN QUERY PLAN " + sql, parameters).fetchall()
+        except sqlite3.Error:
+            return None
+        plan = [row[3] for row in rows]
+        if len(self._plans) < MAX_STATEMENT_LABELS:
+            self._plans[sql] = plan
+        return plan
+
+
+# One JSON object per line: time, level, logger, message, the record's extra={'fields': {...}} and any traceback
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        entry.update(getattr(record, 'fields', {}))
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def configure_logging(app):
+    # Log records are formatted on the thread that logs them and handed to a queue; a listener thread does the
+    # (possibly slow) writes, so a request never waits on stderr or a log file
+    records = queue.SimpleQueue()
+    handler = QueueHandler(records)
+    handler.setFormatter(JsonFormatter())
+    app.logger.removeHandler(default_handler)
+    app.logger.addHandler(handler)
+    app.logger.setLevel(app.config.get('LOG_LEVEL', 'INFO'))
+
+    output = logging.StreamHandler(sys.stderr)
+    output.setFormatter(logging.Formatter('%(message)s'))
+    app.extensions['log_pipeline'] = {'queue': records, 'handlers': (output,), 'listener': None, 'pid': None}
+    ensure_log_listener(app)
+
+
+def ensure_log_listener(app):
+    # Start the listener thread, again in each forked worker (threads don't survive a fork; the queued records do)
+    pipeline = app.extensions['log_pipeline']
+    if pipeline['pid'] == os.getpid():
+        return
+    listener = QueueListener(pipeline['queue'], *pipeline['handlers'])
+    listener.start()
+    pipeline['listener'], pipeline['pid'] = listener, os.getpid()
+    # Write out what is still queued when the process exits
+    atexit.register(listener.stop)
+
+
+def start_request():
+    ensure_log_listener(current_app)
+    g.request_started = time.perf_counter()
+    if current_app.config.get('PROFILER_ENABLED') and request.headers.get(PROFILE_HEADER):
+        g.profiler = cProfile.Profile()
+        g.profiler.enable()
+
+
+def finish_request(response):
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        profiler.disable()
+        response.headers['X-Profile'] = save_profile(profiler)
+
+    started = g.get('request_started')
+    if started is None:
+        return response
+    elapsed = time.perf_counter() - started
+    # Requests that matched no route share one label, so probing random URLs can't grow the metrics
+    endpoint = request.endpoint or 'unmatched'
+    REQUESTS.inc((endpoint, request.method, str(response.status_code)))
+    REQUEST_SECONDS.observe((endpoint, request.method), elapsed)
+    if current_app.config.get('ACCESS_LOG', True):
+        current_app.logger.info("Request", extra={'fields': {
+            'method': request.method, 'path': request.path, 'endpoint': endpoint,
+            'status': response.status_code, 'duration_ms': round(elapsed * 1000, 2),
+            'queries': g.get('query_count', 0), 'query_ms': round(g.get('query_seconds', 0.0) * 1000, 2)}})
+    return response
+
+
+def stop_profiler(exception=None):
+    # A request that failed before after_request ran must not leave the profiler on for the thread's next request
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        profiler.disable()
+
+
+def save_profile(profiler):
+    # Dump the profile for snakeviz / pstats, log its most expensive functions and return the file name
+    directory = current_app.config.get('PROFILE_DIR') or os.path.join(current_app.instance_path, 'profiles')
+    os.makedirs(directory, exist_ok=True)
+    name = f"{time.strftime('%Y%m%d-%H%M%S')}-{request.endpoint or 'unmatched'}-{os.getpid()}-{threading.get_ident()}.prof"
+    profiler.dump_stats(os.path.join(directory, name))
+
+    profiler.create_stats()
+    top = sorted(profiler.stats.items(), key=lambda item: item[1][3], reverse=True)[:PROFILE_TOP]
+    current_app.logger.info("Profiled request", extra={'fields': {
+        'path': request.path, 'file': name,
+        'top': [f"{cumulative * 1000:.2f} ms {function} ({os.path.basename(filename)}:{line})"
+                for (filename, line, function), (_, _, _, cumulative, _) in top]}})
+    return name
+
+
+def gauge_lines(name, documentation, samples, kind='gauge'):
+    # Exposition lines for values read at scrape time; samples are (((label, value), ...), sample value)
+    lines = [f"# HELP {name} {documentation}", f"# TYPE {name} {kind}"]
+    lines.extend(f"{name}{_labels([key for key, _ in labels], [value for _, value in labels])} {value}"
+                 for labels, value in samples)
+    return lines
+
+
+def current_state(app):
+    # Values read when /metrics is scraped: the connection pool, the fragment cache, open notification streams,
+    # password hashing, rate limits and the job queue
+    lines = []
+    pool = get_pool(app).stats()
+    for key in ('size', 'open', 'in_use', 'idle', 'peak_in_use', 'saturation'):
+        lines += gauge_lines(f'crescendo_db_pool_{key}', f"Connection pool {key.replace('_', ' ')}.",
+                             [((), pool[key])])
+    for key in ('acquired', 'waits', 'timeouts', 'wait_seconds'):
+        lines += gauge_lines(f'crescendo_db_pool_{key}_total', f"Connection pool {key.replace('_', ' ')} since start.",
+                             [((), pool[key])], 'counter')
+
+    fragments = cache.get_cache(app).stats()
+    lines += gauge_lines('crescendo_fragment_cache_lookups_total', "Fragment cache lookups by result.",
+                         [((('result', key),), fragments[key]) for key in ('local_hits', 'shared_hits', 'misses')],
+                         'counter')
+    lines += gauge_lines('crescendo_fragment_cache_evictions_total', "Fragment cache evictions.",
+                         [((), fragments['evictions'])], 'counter')
+    for key in ('entries', 'bytes', 'max_bytes'):
+        lines += gauge_lines(f'crescendo_fragment_cache_{key}', f"Fragment cache {key.replace('_', ' ')}.",
+                             [((), fragments[key])])
+
+    broker = app.extensions.get('notification_broker')
+    lines += gauge_lines('crescendo_notification_streams', "Open Server-Sent Events streams in this process.",
+                         [((), broker.stream_count() if broker is not None else 0)])
+
+    hasher = app.extensions.get('password_hasher')
+    if hasher is not None:
+        hashing = hasher.stats()
+        lines += gauge_lines('crescendo_password_hashes_total', "Password hashing calls by kind.",
+                             [((('kind', key),), hashing[key]) for key in ('hashes', 'checks', 'rehashes')], 'counter')
+        lines += gauge_lines('crescendo_password_hash_busy_total', "Logins refused because every hashing slot was taken.",
+                             [((), hashing['busy'])], 'counter')
+        lines += gauge_lines('crescendo_password_hash_in_flight', "Password hashes waiting or running in this process.",
+                             [((), hashing['in_flight'])])
+    limiter = app.extensions.get('rate_limiter')
+    if limiter is not None:
+        lines += gauge_lines('crescendo_rate_limited_total', "Attempts refused by a rate limit, by rule.",
+                             [((('rule', rule),), count) for rule, count in limiter.refused.items()], 'counter')
+
+    jobs = get_db().execute("SELECT Status, COUNT(*) FROM Jobs GROUP BY Status").fetchall()
+    lines += gauge_lines('crescendo_jobs', "Background jobs by status.",
+                         [((('status', status),), count) for status, count in jobs])
+    return lines
+
+
+def stats_endpoint(view):
+    # The operational endpoints (/metrics, /stats/db, /stats/cache) show pool saturation, cache keys, latencies and
+    # table names, so they 404 unless STATS_ENABLED is set, and with STATS_TOKEN set also need it as a bearer token
+    @functools.wraps(view)
+    def wrapped(*args, **kwargs):
+        if not current_app.config.get('STATS_ENABLED'):
+            abort(404)
+        token = current_app.config.get('STATS_TOKEN')
+        if token and not hmac.compare_digest(request.headers.get('Authorization', ''), f"Bearer {token}"):
+            abort(403)
+        return view(*args, **kwargs)
+    return wrapped
+
+
+@stats_endpoint
+def metrics():
+    lines = []
+    for metric in METRICS:
+        lines += metric.render()
+    lines += current_state(current_app)
+    return Response("\n".join(lines) + "\n", mimetype='text/plain; version=0.0.4')
+
+
+def init_app(app):
+    configure_logging(app)
+    # The pool is created later (on first use) and picks the observer up from here
+    app.extensions['query_observer'] = QueryObserver(app.logger, app.config.get('SLOW_QUERY_MS', SLOW_QUERY_MS))
+    app.before_request(start_request)
+    app.after_request(finish_request)
+    app.teardown_request(stop_profiler)
+    app.add_url_rule('/metrics', 'metrics', metrics)
@@ -0,0 +1,247 @@
+# Durable background job queue stored in crescendo.db
+import json
+import os
+import random
+import sqlite3
+import threading
+import time
+import traceback
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+
+from db import connect
+
+# Registered task handlers by name; each is called as handler(conn, **payload)
+TASKS = {}
+
+# Retry delays grow as RETRY_BASE * 2 ** (attempt - 1) seconds, capped at RETRY_MAX
+RETRY_BASE = 5.0
+RETRY_MAX = 3600.0
+
+# A running job whose worker hasn't finished it within the lease is assumed lost and handed out again
+LEASE_SECONDS = 600.0
+
+# Set whenever a job is enqueued so idle in-process workers pick it up without waiting for the next poll
+_wakeup = threading.Event()
+
+
+def task(name):
+    # Register a function as the handler for jobs of the given kind
+    def register(handler):
+        TASKS[name] = handler
+        return handler
+    return register
+
+
+def enqueue(conn, kind, payload=None, delay=0, max_attempts=5, commit=True):
+    # Add a job to the queue and return its ID; the caller's transaction is committed unless commit=False
+    now = time.time()
+    cursor = conn.execute("""
+        INSERT INTO Jobs (Kind, Payload, MaxAttempts, RunAt, CreatedAt, UpdatedAt)
+        VALUES (?, ?, ?, ?, ?, ?)
+    """, (kind, json.dumps(payload or {}), max_attempts, now + delay, now, now))
+    if commit:
+        conn.commit()
+    _wakeup.set()
+    return cursor.lastrowid
+
+
+def claim(conn, lease=LEASE_SECONDS):
+    # Atomically mark the oldest due job as running and return (JobID, Kind, Payload, Attempts, MaxAttempts)
+    now = time.time()
+    row = conn.execute("""
+        UPDATE Jobs SET Status = 'running', Attempts = Attempts + 1, UpdatedAt = ?
+        WHERE JobID = (
+            SELECT JobID FROM Jobs
+            WHERE (Status = 'queued' AND RunAt <= ?) OR (Status = 'running' AND UpdatedAt < ?)
+            ORDER BY RunAt, JobID
+            LIMIT 1
+        )
+        RETURNING JobID, Kind, Payload, Attempts, MaxAttempts
+    """, (now, now, now - lease)).fetchone()
+    conn.commit()
+    return row
+
+
+def complete(conn, job_id):
+    conn.execute("UPDATE Jobs SET Status = 'done', LastError = NULL, UpdatedAt = ? WHERE JobID = ?",
+                 (time.time(), job_id))
+    conn.commit()
+
+
+def fail(conn, job_id, attempts, max_attempts, error):
+    # Schedule a retry with exponential backoff (plus jitter), or give up after the last attempt
+    now = time.time()
+    if attempts >= max_attempts:
+        conn.execute("UPDATE Jobs SET Status = 'failed', LastError = ?, UpdatedAt = ? WHERE JobID = ?",
+                     (error, now, job_id))
+    else:
+        delay = min(RETRY_BASE * 2 ** (attempts - 1), RETRY_MAX) * random.uniform(0.8, 1.2)
+        conn.execute("UPDATE Jobs SET Status = 'queued', RunAt = ?, LastError = ?, UpdatedAt = ? WHERE JobID = ?",
+                     (now + delay, error, now, job_id))
+    conn.commit()
+
+
+def run_one(app, conn):
+    # Run the next due job, if any; returns False when the queue has nothing due
+    job = claim(conn, app.config.get('JOBS_LEASE_SECONDS', LEASE_SECONDS))
+    if job is None:
+        return False
+
+    job_id, kind, payload, attempts, max_attempts = job
+    try:
+        handler = TASKS[kind]
+        with app.app_context():
+            handler(conn, **json.loads(payload))
+    except Exception:
+        # Whatever the handler left uncommitted belongs to the failed attempt
+        if conn.in_transaction:
+            conn.rollback()
+        error = traceback.format_exc(limit=5)
+        app.logger.warning("Job %s (%s) failed on attempt %s/%s", job_id, kind, attempts, max_attempts)
+        fail(conn, job_id, attempts, max_attempts, error)
+    else:
+        complete(conn, job_id)
+    return True
+
+
+# A set of threads that run queued jobs until stopped
+class WorkerPool:
+    def __init__(self, app, workers=2, poll_interval=1.0):
+        self.app = app
+        self.pid = os.getpid()
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self._stopping = threading.Event()
+        self._threads = []
+
+    def _work(self):
+        conn = connect(self.app.config['DATABASE'])
+        try:
+            while not self._stopping.is_set():
+                try:
+                    ran = run_one(self.app, conn)
+                except sqlite3.Error:
+                    # The database was busy or briefly unavailable; try again after the poll interval
+                    self.app.logger.exception("Job worker database error")
+                    ran = False
+                if not ran:
+                    _wakeup.wait(self.poll_interval)
+                    _wakeup.clear()
+        finally:
+            conn.close()
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f"crescendo-jobs-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout=None):
+        self._stopping.set()
+        _wakeup.set()
+        for thread in self._threads:
+            thread.join(timeout)
+
+
+def drain(app, conn):
+    # Run due jobs until none are left (used by `flask jobs work --burst`); returns how many ran
+    count = 0
+    while run_one(app, conn):
+        count += 1
+    return count
+
+
+# `flask jobs ...` commands
+jobs_cli = AppGroup('jobs', help="Inspect and run background jobs.")
+
+
+@jobs_cli.command('work')
+@click.option('--workers', type=int, default=2, help="Number of worker threads.")
+@click.option('--burst', is_flag=True, help="Run the jobs that are due now, then exit.")
+def work_command(workers, burst):
+    """Run background jobs in this process."""
+    app = current_app._get_current_object()
+    if burst:
+        conn = connect(app.config['DATABASE'])
+        try:
+            click.echo(f"Ran {drain(app, conn)} jobs")
+        finally:
+            conn.close()
+        return
+
+    pool = WorkerPool(app, workers)
+    pool.start()
+    click.echo(f"Running {workers} job workers, press Ctrl+C to stop")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pool.stop()
+
+
+@jobs_cli.command('list')
+@click.option('--status', type=click.Choice(['queued', 'running', 'done', 'failed']), default=None)
+@click.option('--limit', type=int, default=20)
+def list_command(status, limit):
+    """Show recent jobs and their status."""
+    conn = sqlite3.connect(current_app.config['DATABASE'])
+    try:
+        counts = conn.execute("SELECT Status, COUNT(*) FROM Jobs GROUP BY Status").fetchall()
+        click.echo(", ".join(f"{name}: {count}" for name, count in counts) or "No jobs")
+
+        sql = "SELECT JobID, Kind, Status, Attempts, MaxAttempts, RunAt, LastError FROM Jobs"
+        params = []
+        if status:
+            sql += " WHERE Status = ?"
+            params.append(status)
+        sql += " ORDER BY JobID DESC LIMIT ?"
+        for job_id, kind, job_status, attempts, max_attempts, run_at, error in conn.execute(sql, params + [limit]):
+            due = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(run_at))
+            click.echo(f"#{job_id} {kind} {job_status} attempts={attempts}/{max_attempts} due={due}")
+            if error and job_status != 'done':
+                click.echo("    " + error.strip().splitlines()[-1])
+    finally:
+        conn.close()
+
+
+@jobs_cli.command('retry')
+@click.argument('job_id', type=int)
+def retry_command(job_id):
+    """Queue a failed job to run again now."""
+    conn = sqlite3.connect(current_app.config['DATABASE'])
+    try:
+        updated = conn.execute("""
+            UPDATE Jobs SET Status = 'queued', Attempts = 0, RunAt = ?, UpdatedAt = ?
+            WHERE JobID = ? AND Status = 'failed'
+        """, (time.time(), time.time(), job_id)).rowcount
+        conn.commit()
+    finally:
+        conn.close()
+    if not updated:
+        raise click.ClickException(f"Job {job_id} is not a failed job")
+    click.echo(f"Job {job_id} queued")
+
+
+def init_app(app):
+    app.cli.add_command(jobs_cli)
+
+    # Start the in-process workers on the first request, so each server process (including each worker forked from
+    # a preloading master) gets its own threads and CLI commands don't start any
+    workers = app.config.get('JOBS_WORKERS', 2)
+    lock = threading.Lock()
+
+    def running():
+        pool = app.extensions.get('job_workers')
+        return pool is not None and pool.pid == os.getpid()
+
+    @app.before_request
+    def start_job_workers():
+        if workers and not running():
+            with lock:
+                if not running():
+                    pool = WorkerPool(app, workers, app.config.get('JOBS_POLL_INTERVAL', 1.0))
+                    pool.start()
+                    app.extensions['job_workers'] = pool
@@ -0,0 +1,355 @@
+# Event lifecycle: past events are marked 'completed' (or 'expired' if nobody was booked), events that finished long
+# ago move to an attached archive database, orphaned gallery images and their files are deleted, old notifications
+# and jobs are pruned, and the hot tables are vacuumed and analyzed, so the routes' queries don't slow down as
+# history piles up. A 'lifecycle' job runs all of it every LIFECYCLE_INTERVAL seconds.
+import json
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+
+import cache
+import feed
+from db import connect, get_db, write_transaction
+from jobs import enqueue, task
+from storage import get_storage, release_blob
+
+# Seconds between runs
+INTERVAL = 15 * 60
+
+# Rows changed per write transaction, so requests never wait long for the write lock
+BATCH_SIZE = 500
+
+# Finished events move to the archive this many days after their date; notifications and finished jobs are deleted
+# after their retention period
+ARCHIVE_AFTER_DAYS = 365
+NOTIFICATION_RETENTION_DAYS = 90
+JOB_RETENTION_DAYS = 30
+
+# Free pages returned to the filesystem per run (only once the database uses auto_vacuum = INCREMENTAL, see
+# `flask lifecycle vacuum`), and rows ANALYZE samples per index
+VACUUM_PAGES = 2000
+ANALYSIS_LIMIT = 1000
+
+# Tables whose planner statistics are refreshed after a run moved rows
+HOT_TABLES = ('Events', 'Bookings', 'EventImages', 'Notifications', 'Jobs')
+
+EVENT_COLUMNS = "EventID, OrganizerUserID, Date, Time, Venue, Description, Status"
+BOOKING_COLUMNS = "BookingID, EventID, MusicianUserID, Status, RequestDate, ConfirmationDate"
+
+ARCHIVE_SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS archive.Events (
+        EventID INTEGER PRIMARY KEY,
+        OrganizerUserID INTEGER,
+        Date TEXT,
+        Time TEXT,
+        Venue TEXT,
+        Description TEXT,
+        Status TEXT,
+        ArchivedAt REAL NOT NULL
+    )""",
+    """CREATE TABLE IF NOT EXISTS archive.Bookings (
+        BookingID INTEGER PRIMARY KEY,
+        EventID INTEGER NOT NULL,
+        MusicianUserID INTEGER,
+        Status TEXT,
+        RequestDate TEXT,
+        ConfirmationDate TEXT,
+        ArchivedAt REAL NOT NULL
+    )""",
+    "CREATE INDEX IF NOT EXISTS archive.idx_archive_events_organizer ON Events (OrganizerUserID, Date)",
+    "CREATE INDEX IF NOT EXISTS archive.idx_archive_bookings_event ON Bookings (EventID)",
+    "CREATE INDEX IF NOT EXISTS archive.idx_archive_bookings_musician ON Bookings (MusicianUserID)",
+)
+
+
+def invalidate_dashboards(conn, user_ids):
+    # Events changed status or disappeared: drop the cached event lists and the dashboards of everyone involved
+    cache.invalidate(conn, 'events')
+    for user_id in set(user_ids) - {None}:
+        cache.invalidate(conn, cache.user_scope(user_id))
+
+
+def involved_users(conn, event_ids):
+    # Organizers and booked musicians of some events
+    ids = json.dumps(event_ids)
+    return [row[0] for row in conn.execute("""
+        SELECT OrganizerUserID FROM Events WHERE EventID IN (SELECT value FROM json_each(?))
+        UNION SELECT MusicianUserID FROM Bookings WHERE EventID IN (SELECT value FROM json_each(?))
+    """, (ids, ids))]
+
+
+def finish_past_events(conn, now=None, batch_size=BATCH_SIZE):
+    # Confirmed events whose date and time have passed become 'completed'; pending ones nobody was booked for become
+    # 'expired' and their open requests are declined. Returns {'completed': n, 'expired': n}.
+    now = now or datetime.now()
+    today, clock = now.strftime('%Y-%m-%d'), now.strftime('%H:%M')
+
+    def finish_batch(conn, old, new):
+        event_ids = [row[0] for row in conn.execute("""
+            UPDATE Events SET Status = ?
+            WHERE EventID IN (
+                SELECT EventID FROM Events
+                WHERE Status = ? AND (Date < ? OR (Date = ? AND Time <= ?))
+                LIMIT ?
+            )
+            RETURNING EventID
+        """, (new, old, today, today, clock, batch_size))]
+        if event_ids and new == 'expired':
+            conn.execute("""
+                UPDATE Bookings SET Status = 'declined'
+                WHERE Status = 'requested' AND EventID IN (SELECT value FROM json_each(?))
+            """, (json.dumps(event_ids),))
+        if event_ids:
+            invalidate_dashboards(conn, involved_users(conn, event_ids))
+        return len(event_ids)
+
+    counts = {}
+    for old, new in (('confirmed', 'completed'), ('pending', 'expired')):
+        counts[new] = 0
+        while True:
+            changed = write_transaction(conn, lambda conn: finish_batch(conn, old, new))
+            counts[new] += changed
+            if changed < batch_size:
+                break
+    return counts
+
+
+def attach_archive(conn, path):
+    # Attach the archive database as 'archive' (once per connection) and create its tables
+    if not any(row[1] == 'archive' for row in conn.execute("PRAGMA database_list")):
+        conn.execute("ATTACH DATABASE ? AS archive", (path,))
+    for statement in ARCHIVE_SCHEMA:
+        conn.execute(statement)
+    conn.commit()
+
+
+def archive_events(conn, path, older_than_days=ARCHIVE_AFTER_DAYS, now=None, batch_size=BATCH_SIZE):
+    # Move finished events dated more than older_than_days ago, and their bookings, to the archive database. Events
+    # with gallery images stay, since the gallery still shows them. A transaction that writes to two database files
+    # is not atomic in WAL mode, so each batch is copied (and committed) first and only then deleted from the hot
+    # tables, and only if its copy is there: a crash in between leaves rows in both places, and the next run
+    # copies them again (INSERT OR REPLACE) and deletes them. Returns the number of events archived.
+    attach_archive(conn, path)
+    cutoff = ((now or datetime.now()) - timedelta(days=older_than_days)).strftime('%Y-%m-%d')
+    archived = 0
+    while True:
+        event_ids = [row[0] for row in conn.execute("""
+            SELECT EventID FROM Events e
+            WHERE Status IN ('completed', 'expired') AND Date < ?
+              AND NOT EXISTS (SELECT 1 FROM EventImages i WHERE i.EventID = e.EventID)
+            LIMIT ?
+        """, (cutoff, batch_size))]
+        if not event_ids:
+            break
+        ids = json.dumps(event_ids)
+
+        def copy(conn):
+            archived_at = time.time()
+            conn.execute(f"""
+                INSERT OR REPLACE INTO archive.Events ({EVENT_COLUMNS}, ArchivedAt)
+                SELECT {EVENT_COLUMNS}, ? FROM main.Events WHERE EventID IN (SELECT value FROM json_each(?))
+            """, (archived_at, ids))
+            conn.execute(f"""
+                INSERT OR REPLACE INTO archive.Bookings ({BOOKING_COLUMNS}, ArchivedAt)
+                SELECT {BOOKING_COLUMNS}, ? FROM main.Bookings WHERE EventID IN (SELECT value FROM json_each(?))
+            """, (archived_at, ids))
+
+        def delete(conn):
+            users = involved_users(conn, event_ids)
+            conn.execute("""
+                DELETE FROM main.Bookings WHERE BookingID IN (
+                    SELECT BookingID FROM archive.Bookings WHERE EventID IN (SELECT value FROM json_each(?)))
+            """, (ids,))
+            deleted = conn.execute("""
+                DELETE FROM main.Events WHERE EventID IN (
+                    SELECT EventID FROM archive.Events WHERE EventID IN (SELECT value FROM json_each(?)))
+            """, (ids,)).rowcount
+            invalidate_dashboards(conn, users)
+            return deleted
+
+        write_transaction(conn, copy)
+        deleted = write_transaction(conn, delete)
+        archived += deleted
+        if len(event_ids) < batch_size or not deleted:
+            break
+    return archived
+
+
+def collect_images(conn, batch_size=BATCH_SIZE):
+    # Delete gallery images whose event no longer exists (delete_event leaves them behind), with their renditions,
+    # and then the files nothing refers to any more: renditions, blobs whose last reference went, and uploads saved
+    # before content-addressed storage that no other image uses. Files are deleted after the rows are committed, so
+    # a crash in between leaves a stray file rather than a row pointing at nothing. Returns the number of images.
+    storage = get_storage()
+    collected = 0
+    while True:
+        rows = conn.execute("""
+            SELECT ImageID, ImagePath FROM EventImages i
+            WHERE NOT EXISTS (SELECT 1 FROM Events e WHERE e.EventID = i.EventID)
+            LIMIT ?
+        """, (batch_size,)).fetchall()
+        if not rows:
+            break
+        image_ids = json.dumps([image_id for image_id, _ in rows])
+
+        def delete(conn):
+            renditions = json.dumps([row[0] for row in conn.execute(
+                "SELECT Path FROM EventImageRenditions WHERE ImageID IN (SELECT value FROM json_each(?))",
+                (image_ids,))])
+            conn.execute("DELETE FROM EventImageRenditions WHERE ImageID IN (SELECT value FROM json_each(?))",
+                         (image_ids,))
+            conn.execute("DELETE FROM EventImages WHERE ImageID IN (SELECT value FROM json_each(?))", (image_ids,))
+            # Rendition files are shared by the images of the same blob; keep those another image still uses
+            files = [row[0] for row in conn.execute("""
+                SELECT DISTINCT value FROM json_each(?)
+                WHERE value NOT IN (SELECT Path FROM EventImageRenditions)
+            """, (renditions,))]
+            files.extend(path for _, path in rows if release_blob(conn, path))
+            files.extend(row[0] for row in conn.execute("""
+                SELECT DISTINCT value FROM json_each(?)
+                WHERE value LIKE 'uploads/%' AND value NOT IN (SELECT Path FROM Blobs)
+                  AND value NOT IN (SELECT ImagePath FROM EventImages WHERE ImagePath IS NOT NULL)
+            """, (json.dumps([path for _, path in rows]),)))
+            cache.invalidate(conn, 'gallery')
+            return files
+
+        for path in write_transaction(conn, delete):
+            storage.delete(path)
+        collected += len(rows)
+        if len(rows) < batch_size:
+            break
+
+    # Blobs left without references, e.g. by a process that died between committing and deleting the file
+    while True:
+        paths = [row[0] for row in conn.execute("SELECT Path FROM Blobs WHERE RefCount <= 0 LIMIT ?", (batch_size,))]
+        if not paths:
+            break
+        write_transaction(conn, lambda conn: conn.execute(
+            "DELETE FROM Blobs WHERE RefCount <= 0 AND Path IN (SELECT value FROM json_each(?))", (json.dumps(paths),)))
+        for path in paths:
+            storage.delete(path)
+        if len(paths) < batch_size:
+            break
+    return collected
+
+
+def prune_history(conn, notification_days=NOTIFICATION_RETENTION_DAYS, job_days=JOB_RETENTION_DAYS):
+    # Delete old notifications and finished jobs; returns {'notifications': n, 'jobs': n}
+    now = time.time()
+    return write_transaction(conn, lambda conn: {
+        'notifications': feed.prune(conn, now - notification_days * 24 * 60 * 60),
+        'jobs': conn.execute("DELETE FROM Jobs WHERE Status = 'done' AND UpdatedAt < ?",
+                             (now - job_days * 24 * 60 * 60,)).rowcount,
+    })
+
+
+def maintain(conn, analyze=True, vacuum_pages=VACUUM_PAGES, analysis_limit=ANALYSIS_LIMIT):
+    # Return up to vacuum_pages free pages to the filesystem (only possible with auto_vacuum = INCREMENTAL), and
+    # refresh the planner statistics of the hot tables, sampling at most analysis_limit rows per index so it stays
+    # cheap on large tables. Returns the number of pages freed.
+    freed = 0
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+        free_pages = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        if free_pages:
+            # Each step of the pragma frees one page and execute() only takes the first, so run it as a script
+            conn.executescript(f"PRAGMA incremental_vacuum({int(vacuum_pages)})")
+            freed = min(free_pages, vacuum_pages)
+    if analyze:
+        conn.execute(f"PRAGMA analysis_limit = {int(analysis_limit)}")
+        for table in HOT_TABLES:
+            conn.execute(f"ANALYZE main.{table}")
+        conn.commit()
+    return freed
+
+
+def run(app, conn, now=None):
+    # One full lifecycle pass; returns what each step did
+    config = app.config
+    batch_size = config.get('LIFECYCLE_BATCH_SIZE', BATCH_SIZE)
+    started = time.perf_counter()
+    result = finish_past_events(conn, now, batch_size)
+    result['archived'] = archive_events(conn, config['ARCHIVE_DATABASE'],
+                                        config.get('ARCHIVE_AFTER_DAYS', ARCHIVE_AFTER_DAYS), now, batch_size)
+    result['images'] = collect_images(conn, batch_size)
+    result.update(prune_history(conn, config.get('NOTIFICATION_RETENTION_DAYS', NOTIFICATION_RETENTION_DAYS),
+                                config.get('JOB_RETENTION_DAYS', JOB_RETENTION_DAYS)))
+    result['freed_pages'] = maintain(conn, analyze=any(result.values()))
+    result['duration_ms'] = round((time.perf_counter() - started) * 1000, 1)
+    app.logger.info("Lifecycle run", extra={'fields': result})
+    return result
+
+
+def schedule(conn, delay=0, states=('queued', 'running')):
+    # Queue a lifecycle run unless one is already queued (or running). The check and the insert share one write
+    # transaction, so processes starting at the same time queue a single run. Returns the job ID, or None.
+    def work(conn):
+        placeholders = ", ".join("?" * len(states))
+        if conn.execute(f"SELECT 1 FROM Jobs WHERE Kind = 'lifecycle' AND Status IN ({placeholders}) LIMIT 1",
+                        states).fetchone():
+            return None
+        return enqueue(conn, 'lifecycle', delay=delay, max_attempts=1, commit=False)
+    return write_transaction(conn, work)
+
+
+@task('lifecycle')
+def lifecycle_task(conn):
+    # Queue the next run first, so one that fails doesn't end the cycle
+    app = current_app._get_current_object()
+    schedule(conn, app.config.get('LIFECYCLE_INTERVAL', INTERVAL), states=('queued',))
+    run(app, conn)
+
+
+# `flask lifecycle ...` commands
+lifecycle_cli = AppGroup('lifecycle', help="Complete, archive and clean up past events.")
+
+
+@lifecycle_cli.command('run')
+def run_command():
+    """Run a lifecycle pass now."""
+    app = current_app._get_current_object()
+    conn = connect(app.config['DATABASE'])
+    try:
+        result = run(app, conn)
+    finally:
+        conn.close()
+    click.echo(", ".join(f"{name}: {value}" for name, value in result.items()))
+
+
+@lifecycle_cli.command('vacuum')
+def vacuum_command():
+    """Rebuild the database with incremental auto-vacuum (stop the app first)."""
+    conn = connect(current_app.config['DATABASE'])
+    try:
+        before = conn.execute("PRAGMA page_count").fetchone()[0]
+        # auto_vacuum can only be changed on an empty database or by a full VACUUM, which rewrites the whole file
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("VACUUM")
+        after = conn.execute("PRAGMA page_count").fetchone()[0]
+    finally:
+        conn.close()
+    click.echo(f"Pages: {before} -> {after}; free pages are now returned a batch at a time by each lifecycle run")
+
+
+def init_app(app):
+    app.cli.add_command(lifecycle_cli)
+
+    # Make sure a run is queued when a process gets its first request; from then on each run queues the next
+    interval = app.config.get('LIFECYCLE_INTERVAL', INTERVAL)
+    lock = threading.Lock()
+    scheduled = {'pid': None}
+
+    @app.before_request
+    def schedule_lifecycle():
+        if interval and scheduled['pid'] != os.getpid() and lock.acquire(blocking=False):
+            scheduled['pid'] = os.getpid()
+            try:
+                schedule(get_db())
+            except Exception:
+                app.logger.exception("Scheduling the lifecycle job failed")
+            finally:
+                lock.release()
@@ -0,0 +1,429 @@
+# Musician–event matching: TF-IDF vectors over profiles, event descriptions and venues, plus when each musician
+# tends to play, held in memory per process (NumPy) and updated row by row as profiles, events and bookings change
+import math
+import os
+import random
+import threading
+import time
+import zlib
+from datetime import date
+from functools import lru_cache
+
+from flask import current_app
+
+from db import get_db
+from search import TOKEN
+
+# NumPy is optional; without it there are no recommendations and the dashboards show the plain lists
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Words are hashed into this many feature columns, so the index never has to grow or renumber a vocabulary
+DIMENSIONS = 1024
+
+# When an event happens: weekday × part of day (before noon, before 5 pm, evening). Events whose date or time
+# can't be read use the extra slot after these, which every musician scores as fully preferred. That only matters
+# when ranking musicians for such an event: an unreadable date is day 0 (see day_number), which rank_events treats
+# as already past, so these events are never recommended to musicians.
+PARTS_OF_DAY = 3
+SLOTS = 7 * PARTS_OF_DAY
+
+# A score is TEXT_WEIGHT × cosine similarity of the texts plus SLOT_WEIGHT × how much the musician prefers the
+# event's slot (1.0 for their most booked slot); pairs without a word in common aren't recommended at all
+TEXT_WEIGHT = 0.8
+SLOT_WEIGHT = 0.2
+
+# Changed rows are weighted with the IDF of the moment; once this fraction of all documents has changed since
+# every row was weighted, all rows are weighted again
+REWEIGHT_FRACTION = 0.1
+
+# A batch of more changes than this fraction of the index (or MIN_REBUILD changes, if more) rebuilds it instead
+REBUILD_FRACTION = 0.25
+MIN_REBUILD = 1000
+
+# The change log is read at most this often per process
+REFRESH_INTERVAL = 1.0
+
+# Roughly one refresh in this many deletes change log entries older than CHANGE_RETENTION seconds
+CLEANUP_EVERY = 1000
+CHANGE_RETENTION = 24 * 60 * 60
+
+# IDs per IN (...) query when changed rows are loaded
+CHUNK_SIZE = 500
+
+STOP_WORDS = frozenset("""
+    a an and are as at be by for from has have in is it its of on or our the their this to we with you your
+""".split())
+
+
+def terms(text):
+    return [word for word in TOKEN.findall((text or '').lower()) if len(word) > 1 and word not in STOP_WORDS]
+
+
+def event_terms(description, venue):
+    # The venue's words, and the venue as a whole, so playing at "Tower Theatre" counts most for that venue
+    venue_words = terms(venue)
+    return terms(description) + venue_words + (["venue:" + " ".join(venue_words)] if venue_words else [])
+
+
+@lru_cache(maxsize=65536)
+def feature_column(word, dimensions):
+    return zlib.crc32(word.encode()) % dimensions
+
+
+def term_frequencies(words, dimensions):
+    # Sublinear term frequency (1 + log count) per hashed column
+    counts = {}
+    for word in words:
+        column = feature_column(word, dimensions)
+        counts[column] = counts.get(column, 0) + 1
+    row = np.zeros(dimensions, np.float32)
+    for column, count in counts.items():
+        row[column] = 1 + math.log(count)
+    return row
+
+
+def event_slot(date_text, time_text):
+    try:
+        weekday = date.fromisoformat(date_text).weekday()
+        hour = int(time_text[:2])
+    except (TypeError, ValueError):
+        return SLOTS
+    return weekday * PARTS_OF_DAY + (0 if hour < 12 else 1 if hour < 17 else 2)
+
+
+def day_number(date_text):
+    try:
+        return date.fromisoformat(date_text).toordinal()
+    except (TypeError, ValueError):
+        return 0
+
+
+# One side of the index (events or musicians): a row of features per item in arrays that double when full; the
+# rows of removed items are zeroed and reused
+class Rows:
+    def __init__(self, dimensions, extra, capacity=256):
+        # extra: {name: (shape of one row, dtype)} for the side's own columns
+        self.columns = {'tf': ((dimensions,), np.float32), 'weighted': ((dimensions,), np.float32),
+                        'valid': ((), np.bool_), 'ids': ((), np.int64), **extra}
+        self.arrays = {name: np.zeros((capacity,) + shape, dtype) for name, (shape, dtype) in self.columns.items()}
+        self.row_of = {}
+        self.free = []
+        # Rows in use or freed (the high-water mark); only arrays[...][:size] is ever read
+        self.size = 0
+
+    def __getitem__(self, name):
+        return self.arrays[name][:self.size]
+
+    def __len__(self):
+        return len(self.row_of)
+
+    def allocate(self, item_id):
+        row = self.row_of.get(item_id)
+        if row is not None:
+            return row
+        if self.free:
+            row = self.free.pop()
+        else:
+            if self.size == len(self.arrays['ids']):
+                self.arrays = {name: np.concatenate([array, np.zeros_like(array)])
+                               for name, array in self.arrays.items()}
+            row = self.size
+            self.size += 1
+        self.row_of[item_id] = row
+        self.arrays['ids'][row] = item_id
+        self.arrays['valid'][row] = True
+        return row
+
+    def release(self, item_id):
+        row = self.row_of.pop(item_id, None)
+        if row is not None:
+            for array in self.arrays.values():
+                array[row] = 0
+            self.free.append(row)
+        return row
+
+
+def top(scores, ids, limit):
+    # The (id, score) pairs of the highest finite scores, best first
+    candidates = np.flatnonzero(np.isfinite(scores))
+    if limit < len(candidates):
+        candidates = candidates[np.argpartition(-scores[candidates], limit - 1)[:limit]]
+    candidates = candidates[np.argsort(-scores[candidates], kind='stable')]
+    return [(int(ids[i]), float(scores[i])) for i in candidates]
+
+
+# The recommendation index of one process. Events are the pending ones on or after the day they were loaded
+# (ranking also skips those whose day has since passed); musicians are every musician, described by their profile
+# and the events they have been booked for.
+class MatchingIndex:
+    def __init__(self, dimensions=DIMENSIONS):
+        self.dimensions = dimensions
+        self.lock = threading.RLock()
+        self.pid = os.getpid()
+        self.checked_at = 0.0
+        self.loading = False
+        self.counts = {'rebuilds': 0, 'updates': 0, 'reweights': 0}
+        self._clear()
+
+    def _clear(self):
+        dimensions = self.dimensions
+        self.events = Rows(dimensions, {'slot': ((), np.int16), 'day': ((), np.int32)})
+        self.musicians = Rows(dimensions, {'preference': ((SLOTS + 1,), np.float32)})
+        # Days (ordinals) each musician has a confirmed booking on, and the other way round
+        self.busy_days = {}
+        self.busy_musicians = {}
+        # Documents containing each feature column, over both sides
+        self.df = np.zeros(dimensions, np.int64)
+        self.changed = 0
+        self.last_change = 0
+
+    # Building and updating
+
+    def load(self, conn):
+        # (Re)build from the tables; the change log position is read first, so changes made during the load are
+        # applied again on the next refresh (applying a change twice is harmless)
+        with self.lock:
+            last_change = conn.execute("SELECT COALESCE(MAX(ChangeID), 0) FROM MatchingChanges").fetchone()[0]
+            self._clear()
+            self.last_change = last_change
+            # Rows are weighted all at once at the end, with the final IDF
+            self.loading = True
+            try:
+                self._load_events(conn, None)
+                self._load_musicians(conn, None)
+            finally:
+                self.loading = False
+            self.reweight()
+            self.counts['rebuilds'] += 1
+
+    def _set_features(self, side, row, tf):
+        old = side.arrays['tf'][row]
+        self.df -= old > 0
+        self.df += tf > 0
+        side.arrays['tf'][row] = tf
+        if not self.loading:
+            side.arrays['weighted'][row] = self._weighted(tf)
+        self.changed += 1
+
+    def _remove(self, side, item_id):
+        row = side.row_of.get(item_id)
+        if row is not None:
+            self.df -= side.arrays['tf'][row] > 0
+            side.release(item_id)
+            self.changed += 1
+
+    def _idf(self):
+        documents = len(self.events) + len(self.musicians)
+        return (np.log((1 + documents) / (1 + self.df)) + 1).astype(np.float32)
+
+    def _weighted(self, tf, idf=None):
+        weighted = tf * (self._idf() if idf is None else idf)
+        norms = np.linalg.norm(weighted, axis=-1, keepdims=True)
+        return np.divide(weighted, norms, out=np.zeros_like(weighted), where=norms > 0)
+
+    def reweight(self):
+        idf = self._idf()
+        for side in (self.events, self.musicians):
+            side.arrays['weighted'][:side.size] = self._weighted(side['tf'], idf)
+        self.changed = 0
+        self.counts['reweights'] += 1
+
+    def _load_events(self, conn, event_ids):
+        # Index the open events among event_ids (all of them for None) and drop the rest
+        sql = """
+            SELECT EventID, Date, Time, Venue, Description FROM Events
+            WHERE Status = 'pending' AND Date >= ?
+        """
+        today = date.today().isoformat()
+        for chunk in self._chunks(event_ids):
+            if chunk is None:
+                rows = conn.execute(sql, (today,)).fetchall()
+            else:
+                rows = conn.execute(sql + f" AND EventID IN ({','.join('?' * len(chunk))})",
+                                    [today] + chunk).fetchall()
+                for event_id in set(chunk) - {row[0] for row in rows}:
+                    self._remove(self.events, event_id)
+            for event_id, date_text, time_text, venue, description in rows:
+                row = self.events.allocate(event_id)
+                self._set_features(self.events, row, term_frequencies(event_terms(description, venue),
+                                                                      self.dimensions))
+                self.events.arrays['slot'][row] = event_slot(date_text, time_text)
+                self.events.arrays['day'][row] = day_number(date_text)
+
+    def _load_musicians(self, conn, musician_ids):
+        # Index the musicians among musician_ids (all of them for None) with their booking history; IDs that
+        # aren't musicians (any more) are dropped
+        for chunk in self._chunks(musician_ids):
+            where, params = "", []
+            if chunk is not None:
+                where, params = f" AND UserID IN ({','.join('?' * len(chunk))})", chunk
+            profiles = conn.execute(f"SELECT UserID, ProfileInformation FROM Users WHERE UserType = 'musician'{where}",
+                                    params).fetchall()
+            history = {}
+            for musician_id, date_text, time_text, venue, description in conn.execute(f"""
+                SELECT b.MusicianUserID, e.Date, e.Time, e.Venue, e.Description
+                FROM Bookings b
+                JOIN Events e ON e.EventID = b.EventID
+                WHERE b.Status = 'confirmed'{where.replace('UserID', 'b.MusicianUserID')}
+            """, params):
+                history.setdefault(musician_id, []).append((date_text, time_text, venue, description))
+
+            if chunk is not None:
+                for musician_id in set(chunk) - {row[0] for row in profiles}:
+                    self._remove(self.musicians, musician_id)
+                    self._set_busy(musician_id, ())
+            for musician_id, profile in profiles:
+                booked = history.get(musician_id, ())
+                words = terms(profile)
+                preference = np.ones(SLOTS + 1, np.float32)
+                for date_text, time_text, venue, description in booked:
+                    words += event_terms(description, venue)
+                    preference[event_slot(date_text, time_text)] += 1
+                preference[:SLOTS] /= preference[:SLOTS].max()
+                preference[SLOTS] = 1.0
+                row = self.musicians.allocate(musician_id)
+                self._set_features(self.musicians, row, term_frequencies(words, self.dimensions))
+                self.musicians.arrays['preference'][row] = preference
+                self._set_busy(musician_id, {day_number(date_text) for date_text, *_ in booked})
+
+    def _set_busy(self, musician_id, days):
+        for day in self.busy_days.pop(musician_id, ()):
+            self.busy_musicians[day].discard(musician_id)
+        if days:
+            self.busy_days[musician_id] = np.array(sorted(days), np.int32)
+            for day in days:
+                self.busy_musicians.setdefault(day, set()).add(musician_id)
+
+    @staticmethod
+    def _chunks(ids):
+        if ids is None:
+            yield None
+            return
+        ids = list(ids)
+        for start in range(0, len(ids), CHUNK_SIZE):
+            yield ids[start:start + CHUNK_SIZE]
+
+    def refresh(self, conn, interval=REFRESH_INTERVAL):
+        # Apply the change log entries written since the last refresh (by any process); at most every interval
+        if time.monotonic() - self.checked_at < interval:
+            return
+        with self.lock:
+            if time.monotonic() - self.checked_at < interval:
+                return
+            self.checked_at = time.monotonic()
+            first = conn.execute("SELECT MIN(ChangeID) FROM MatchingChanges").fetchone()[0]
+            changes = conn.execute("SELECT ChangeID, Kind, ItemID FROM MatchingChanges WHERE ChangeID > ?",
+                                   (self.last_change,)).fetchall()
+            if random.randrange(CLEANUP_EVERY) == 0:
+                conn.execute("DELETE FROM MatchingChanges WHERE CreatedAt < ?", (time.time() - CHANGE_RETENTION,))
+                conn.commit()
+            if not changes:
+                return
+            if (first is not None and first > self.last_change + 1
+                    or len(changes) > max(MIN_REBUILD, REBUILD_FRACTION * (len(self.events) + len(self.musicians)))):
+                # Entries this process never saw were pruned, or rebuilding is cheaper than applying them one by one
+                self.load(conn)
+                return
+            self._load_events(conn, {item_id for _, kind, item_id in changes if kind == 'event'})
+            self._load_musicians(conn, {item_id for _, kind, item_id in changes if kind == 'musician'})
+            self.last_change = max(change_id for change_id, _, _ in changes)
+            self.counts['updates'] += 1
+            if self.changed > REWEIGHT_FRACTION * (len(self.events) + len(self.musicians)):
+                self.reweight()
+
+    # Ranking
+
+    def rank_events(self, musician_ids, limit=10, today=None):
+        # {musician ID: [(event ID, score), ...] best first} for several musicians in one matrix product; events on
+        # a day the musician is already booked, already past or with a date that can't be read are left out
+        today = (today or date.today()).toordinal()
+        results = {musician_id: [] for musician_id in musician_ids}
+        with self.lock:
+            events, musicians = self.events, self.musicians
+            found = [(musician_id, musicians.row_of[musician_id]) for musician_id in musician_ids
+                     if musician_id in musicians.row_of]
+            if not found or not len(events):
+                return results
+            rows = np.array([row for _, row in found])
+            text = musicians.arrays['weighted'][rows] @ events['weighted'].T
+            scores = TEXT_WEIGHT * text + SLOT_WEIGHT * musicians.arrays['preference'][rows][:, events['slot']]
+            scores[text <= 0] = -np.inf
+            scores[:, ~events['valid'] | (events['day'] < today)] = -np.inf
+            days = events['day']
+            for i, (musician_id, _) in enumerate(found):
+                busy = self.busy_days.get(musician_id)
+                if busy is not None:
+                    scores[i, np.isin(days, busy)] = -np.inf
+                results[musician_id] = top(scores[i], events['ids'], limit)
+        return results
+
+    def rank_musicians(self, event_ids, limit=10):
+        # {event ID: [(musician ID, score), ...] best first} for several events in one matrix product; musicians
+        # already booked on an event's day are left out
+        results = {event_id: [] for event_id in event_ids}
+        with self.lock:
+            events, musicians = self.events, self.musicians
+            found = [(event_id, events.row_of[event_id]) for event_id in event_ids if event_id in events.row_of]
+            if not found or not len(musicians):
+                return results
+            rows = np.array([row for _, row in found])
+            text = events.arrays['weighted'][rows] @ musicians['weighted'].T
+            scores = TEXT_WEIGHT * text + SLOT_WEIGHT * musicians['preference'][:, events.arrays['slot'][rows]].T
+            scores[text <= 0] = -np.inf
+            scores[:, ~musicians['valid']] = -np.inf
+            for i, (event_id, row) in enumerate(found):
+                busy = self.busy_musicians.get(int(events.arrays['day'][row]))
+                if busy:
+                    scores[i, [musicians.row_of[m] for m in busy if m in musicians.row_of]] = -np.inf
+                results[event_id] = top(scores[i], musicians['ids'], limit)
+        return results
+
+    def stats(self):
+        with self.lock:
+            return {'events': len(self.events), 'musicians': len(self.musicians), 'last_change': self.last_change,
+                    'bytes': sum(array.nbytes for side in (self.events, self.musicians)
+                                 for array in side.arrays.values()),
+                    **self.counts}
+
+
+_build_lock = threading.Lock()
+
+
+def get_index(app=None):
+    # This process's index, built on first use and kept up to date with the change log; None when matching is
+    # turned off or NumPy isn't installed
+    app = app or current_app
+    if np is None or not app.config.get('MATCHING_ENABLED', True):
+        return None
+    index = app.extensions.get('matching_index')
+    if index is None or index.pid != os.getpid():
+        # A forked worker builds its own rather than sharing (and locking) its parent's
+        with _build_lock:
+            index = app.extensions.get('matching_index')
+            if index is None or index.pid != os.getpid():
+                index = MatchingIndex(app.config.get('MATCHING_DIMENSIONS', DIMENSIONS))
+                index.load(get_db())
+                app.extensions['matching_index'] = index
+                return index
+    index.refresh(get_db(), app.config.get('MATCHING_REFRESH_INTERVAL', REFRESH_INTERVAL))
+    return index
+
+
+def recommended_events(musician_id, limit=10):
+    # [(event ID, score), ...] for one musician, best first ([] without an index)
+    index = get_index()
+    return index.rank_events([musician_id], limit)[musician_id] if index is not None else []
+
+
+def suggested_musicians(event_ids, limit=3):
+    # {event ID: [(musician ID, score), ...]} for several events at once ({} without an index)
+    index = get_index()
+    return index.rank_musicians(list(event_ids), limit) if index is not None else {}
+
+
+def init_app(app):
+    if np is None and app.config.get('MATCHING_ENABLED', True):
+        app.logger.info("NumPy is not installed; recommendations are turned off")
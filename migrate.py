@@ -0,0 +1,121 @@
+# Versioned schema migrations for crescendo.db
+import os
+import re
+import sqlite3
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+
+# Numbered migration scripts live next to this file, e.g. migrations/0002_hot_path_indexes.sql
+MIGRATIONS_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+MIGRATION_NAME = re.compile(r"^(\d+)_(\w+)\.sql$")
+
+
+# Raised when a migration script fails; the database is left at the previous version
+class MigrationError(Exception):
+    pass
+
+
+def load_migrations(folder=MIGRATIONS_FOLDER):
+    # Return (version, name, path) for every migration script, in version order
+    migrations = []
+    for filename in os.listdir(folder):
+        match = MIGRATION_NAME.match(filename)
+        if match:
+            migrations.append((int(match.group(1)), match.group(2), os.path.join(folder, filename)))
+    migrations.sort()
+
+    # Two scripts with the same number would make the order ambiguous
+    versions = [version for version, _, _ in migrations]
+    if len(versions) != len(set(versions)):
+        raise MigrationError("Duplicate migration version numbers in " + folder)
+    return migrations
+
+
+def ensure_version_table(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS SchemaVersion (
+            Version INTEGER PRIMARY KEY,
+            Name TEXT NOT NULL,
+            AppliedAt TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    conn.commit()
+
+
+def current_version(conn):
+    # Highest applied migration number (0 for a database that has never been migrated)
+    ensure_version_table(conn)
+    row = conn.execute("SELECT MAX(Version) FROM SchemaVersion").fetchone()
+    return row[0] or 0
+
+
+def pending_migrations(conn, folder=MIGRATIONS_FOLDER):
+    version = current_version(conn)
+    return [migration for migration in load_migrations(folder) if migration[0] > version]
+
+
+def upgrade(conn, target=None, folder=MIGRATIONS_FOLDER):
+    # Apply each pending migration in its own transaction and record it in SchemaVersion
+    applied = []
+    for version, name, path in pending_migrations(conn, folder):
+        if target is not None and version > target:
+            break
+        with open(path) as f:
+            script = f.read()
+        try:
+            # executescript commits any open transaction first, so the BEGIN/COMMIT pair makes the
+            # script and its version row atomic
+            conn.executescript("BEGIN;\n" + script + "\n;INSERT INTO SchemaVersion (Version, Name) VALUES (%d, '%s');\nCOMMIT;"
+                               % (version, name))
+        except sqlite3.Error as e:
+            if conn.in_transaction:
+                conn.rollback()
+            raise MigrationError(f"Migration {version:04d}_{name} failed: {e}") from e
+        applied.append((version, name))
+    return applied
+
+
+def upgrade_database(database, target=None):
+    # Upgrade a database file using a short-lived connection of its own
+    conn = sqlite3.connect(database)
+    try:
+        return upgrade(conn, target)
+    finally:
+        conn.close()
+
+
+# `flask db ...` commands
+db_cli = AppGroup('db', help="Manage the crescendo.db schema.")
+
+
+@db_cli.command('upgrade')
+@click.option('--target', type=int, default=None, help="Stop after this migration version.")
+def upgrade_command(target):
+    """Apply pending schema migrations."""
+    applied = upgrade_database(current_app.config['DATABASE'], target)
+    for version, name in applied:
+        click.echo(f"Applied {version:04d}_{name}")
+    if not applied:
+        click.echo("Database is up to date.")
+
+
+@db_cli.command('current')
+def current_command():
+    """Show the applied schema version and any pending migrations."""
+    conn = sqlite3.connect(current_app.config['DATABASE'])
+    try:
+        click.echo(f"Current version: {current_version(conn)}")
+        for version, name, _ in pending_migrations(conn):
+            click.echo(f"Pending: {version:04d}_{name}")
+    finally:
+        conn.close()
+
+
+def init_app(app):
+    app.cli.add_command(db_cli)
+
+    # Bring the schema up to date once at startup so routes can rely on it
+    if app.config.get('AUTO_MIGRATE', True):
+        upgrade_database(app.config['DATABASE'])
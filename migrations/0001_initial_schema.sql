@@ -0,0 +1,41 @@
+-- Baseline Crescendo schema (matches the tables shipped in crescendo.db)
+CREATE TABLE IF NOT EXISTS Users (
+    UserID INTEGER PRIMARY KEY,
+    Username TEXT NOT NULL,
+    Password TEXT NOT NULL, -- Store hashed passwords
+    Email TEXT NOT NULL,
+    UserType TEXT NOT NULL, -- 'musician' or 'organization'
+    ProfileInformation TEXT
+);
+
+CREATE TABLE IF NOT EXISTS Events (
+    EventID INTEGER PRIMARY KEY,
+    OrganizerUserID INTEGER,
+    Date TEXT,
+    Time TEXT,
+    Venue TEXT,
+    Description TEXT,
+    Status TEXT, -- 'pending', 'confirmed', 'completed'
+    FOREIGN KEY (OrganizerUserID) REFERENCES Users(UserID)
+);
+
+CREATE TABLE IF NOT EXISTS Bookings (
+    BookingID INTEGER PRIMARY KEY,
+    EventID INTEGER,
+    MusicianUserID INTEGER,
+    Status TEXT, -- 'requested', 'confirmed', 'declined'
+    RequestDate TEXT,
+    ConfirmationDate TEXT,
+    FOREIGN KEY (EventID) REFERENCES Events(EventID),
+    FOREIGN KEY (MusicianUserID) REFERENCES Users(UserID)
+);
+
+CREATE TABLE IF NOT EXISTS EventImages (
+    ImageID INTEGER PRIMARY KEY,
+    EventID INTEGER,
+    MusicianUserID INTEGER,
+    ImagePath TEXT NOT NULL,
+    EventReference TEXT,
+    FOREIGN KEY (EventID) REFERENCES Events(EventID) ON DELETE NO ACTION,
+    FOREIGN KEY (MusicianUserID) REFERENCES Users(UserID)
+);
@@ -0,0 +1,22 @@
+-- Indexes for the queries app.py runs on every page view
+
+-- register: the username/email existence check becomes two index probes
+CREATE UNIQUE INDEX IF NOT EXISTS idx_users_username ON Users (Username);
+CREATE UNIQUE INDEX IF NOT EXISTS idx_users_email ON Users (Email);
+
+-- home: pending events in date order
+CREATE INDEX IF NOT EXISTS idx_events_status_date ON Events (Status, Date, Time);
+
+-- organization / delete_event: an organizer's events
+CREATE INDEX IF NOT EXISTS idx_events_organizer ON Events (OrganizerUserID, Status);
+
+-- home: a musician's confirmed bookings (covering, no table lookup needed)
+CREATE INDEX IF NOT EXISTS idx_bookings_musician_status ON Bookings (MusicianUserID, Status, EventID);
+
+-- organization / delete_event: bookings for an event (covering)
+CREATE INDEX IF NOT EXISTS idx_bookings_event_status ON Bookings (EventID, Status, MusicianUserID);
+
+-- gallery / delete_event: images for an event
+CREATE INDEX IF NOT EXISTS idx_eventimages_event ON EventImages (EventID);
+
+ANALYZE;
@@ -0,0 +1,16 @@
+-- Downscaled renditions of gallery images and the original's dimensions
+ALTER TABLE EventImages ADD COLUMN Width INTEGER;
+ALTER TABLE EventImages ADD COLUMN Height INTEGER;
+
+CREATE TABLE IF NOT EXISTS EventImageRenditions (
+    RenditionID INTEGER PRIMARY KEY,
+    ImageID INTEGER NOT NULL,
+    Format TEXT NOT NULL, -- 'avif', 'webp' or 'jpeg'
+    Width INTEGER NOT NULL,
+    Height INTEGER NOT NULL,
+    Path TEXT NOT NULL, -- Relative to the 'static' folder, like EventImages.ImagePath
+    Bytes INTEGER,
+    FOREIGN KEY (ImageID) REFERENCES EventImages(ImageID)
+);
+
+CREATE INDEX IF NOT EXISTS idx_renditions_image ON EventImageRenditions (ImageID, Format, Width);
@@ -0,0 +1,16 @@
+-- Durable background job queue
+CREATE TABLE IF NOT EXISTS Jobs (
+    JobID INTEGER PRIMARY KEY,
+    Kind TEXT NOT NULL, -- Name of the registered task, e.g. 'process_image'
+    Payload TEXT NOT NULL, -- JSON arguments for the task
+    Status TEXT NOT NULL DEFAULT 'queued', -- 'queued', 'running', 'done', 'failed'
+    Attempts INTEGER NOT NULL DEFAULT 0,
+    MaxAttempts INTEGER NOT NULL DEFAULT 5,
+    RunAt REAL NOT NULL, -- Unix time the job becomes due (pushed back on retry)
+    LastError TEXT,
+    CreatedAt REAL NOT NULL,
+    UpdatedAt REAL NOT NULL
+);
+
+-- Workers claim the oldest due job
+CREATE INDEX IF NOT EXISTS idx_jobs_status_runat ON Jobs (Status, RunAt);
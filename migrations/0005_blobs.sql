@@ -0,0 +1,10 @@
+-- Content-addressed upload storage with reference counts
+CREATE TABLE IF NOT EXISTS Blobs (
+    Hash TEXT PRIMARY KEY, -- SHA-256 of the file contents
+    Path TEXT NOT NULL, -- Relative to the 'static' folder, as stored in EventImages.ImagePath
+    Size INTEGER NOT NULL,
+    RefCount INTEGER NOT NULL DEFAULT 0,
+    CreatedAt TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_blobs_path ON Blobs (Path);
@@ -0,0 +1,7 @@
+-- Generation counters for cached fragments; bumping a counter invalidates every fragment built from it
+CREATE TABLE IF NOT EXISTS CacheGenerations (
+    Name TEXT PRIMARY KEY,
+    Generation INTEGER NOT NULL DEFAULT 0
+);
+
+INSERT OR IGNORE INTO CacheGenerations (Name, Generation) VALUES ('gallery', 0);
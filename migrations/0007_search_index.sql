@@ -0,0 +1,44 @@
+-- FTS5 search indexes over events and user profiles, kept in sync with their tables by triggers
+-- (external-content tables: the text lives only in Events/Users, the index stores tokens)
+
+CREATE VIRTUAL TABLE IF NOT EXISTS EventsSearch USING fts5(
+    Description, Venue,
+    content='Events', content_rowid='EventID',
+    tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+);
+
+CREATE TRIGGER IF NOT EXISTS events_search_insert AFTER INSERT ON Events BEGIN
+    INSERT INTO EventsSearch (rowid, Description, Venue) VALUES (new.EventID, new.Description, new.Venue);
+END;
+
+CREATE TRIGGER IF NOT EXISTS events_search_delete AFTER DELETE ON Events BEGIN
+    INSERT INTO EventsSearch (EventsSearch, rowid, Description, Venue) VALUES ('delete', old.EventID, old.Description, old.Venue);
+END;
+
+CREATE TRIGGER IF NOT EXISTS events_search_update AFTER UPDATE OF Description, Venue ON Events BEGIN
+    INSERT INTO EventsSearch (EventsSearch, rowid, Description, Venue) VALUES ('delete', old.EventID, old.Description, old.Venue);
+    INSERT INTO EventsSearch (rowid, Description, Venue) VALUES (new.EventID, new.Description, new.Venue);
+END;
+
+CREATE VIRTUAL TABLE IF NOT EXISTS UsersSearch USING fts5(
+    Username, ProfileInformation,
+    content='Users', content_rowid='UserID',
+    tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+);
+
+CREATE TRIGGER IF NOT EXISTS users_search_insert AFTER INSERT ON Users BEGIN
+    INSERT INTO UsersSearch (rowid, Username, ProfileInformation) VALUES (new.UserID, new.Username, new.ProfileInformation);
+END;
+
+CREATE TRIGGER IF NOT EXISTS users_search_delete AFTER DELETE ON Users BEGIN
+    INSERT INTO UsersSearch (UsersSearch, rowid, Username, ProfileInformation) VALUES ('delete', old.UserID, old.Username, old.ProfileInformation);
+END;
+
+CREATE TRIGGER IF NOT EXISTS users_search_update AFTER UPDATE OF Username, ProfileInformation ON Users BEGIN
+    INSERT INTO UsersSearch (UsersSearch, rowid, Username, ProfileInformation) VALUES ('delete', old.UserID, old.Username, old.ProfileInformation);
+    INSERT INTO UsersSearch (rowid, Username, ProfileInformation) VALUES (new.UserID, new.Username, new.ProfileInformation);
+END;
+
+-- Index the rows that already exist
+INSERT INTO EventsSearch (EventsSearch) VALUES ('rebuild');
+INSERT INTO UsersSearch (UsersSearch) VALUES ('rebuild');
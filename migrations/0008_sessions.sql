@@ -0,0 +1,10 @@
+-- Server-side session store
+CREATE TABLE IF NOT EXISTS Sessions (
+    SessionID TEXT PRIMARY KEY,
+    UserID INTEGER, -- Logged-in user, so all of a user's sessions can be refreshed at once
+    Data TEXT NOT NULL, -- JSON session contents
+    Expiry REAL NOT NULL -- Unix time after which the session is discarded
+);
+
+CREATE INDEX IF NOT EXISTS idx_sessions_user ON Sessions (UserID);
+CREATE INDEX IF NOT EXISTS idx_sessions_expiry ON Sessions (Expiry);
@@ -0,0 +1,13 @@
+-- One booking per musician per event, and at most one confirmed booking per event
+
+-- Keep the earliest of any duplicate (event, musician) bookings
+DELETE FROM Bookings
+WHERE BookingID NOT IN (SELECT MIN(BookingID) FROM Bookings GROUP BY EventID, MusicianUserID);
+
+-- Events that were double-booked keep their first confirmation; the later ones become declined
+UPDATE Bookings SET Status = 'declined'
+WHERE Status = 'confirmed'
+  AND BookingID NOT IN (SELECT MIN(BookingID) FROM Bookings WHERE Status = 'confirmed' GROUP BY EventID);
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_bookings_event_musician ON Bookings (EventID, MusicianUserID);
+CREATE UNIQUE INDEX IF NOT EXISTS idx_bookings_one_confirmed ON Bookings (EventID) WHERE Status = 'confirmed';
@@ -0,0 +1,7 @@
+-- When each cached data set last changed (Unix time), for Last-Modified headers; plus generations for the
+-- event and user data served by the JSON API
+ALTER TABLE CacheGenerations ADD COLUMN UpdatedAt REAL NOT NULL DEFAULT 0;
+
+INSERT OR IGNORE INTO CacheGenerations (Name, Generation) VALUES ('events', 0), ('users', 0);
+
+UPDATE CacheGenerations SET UpdatedAt = unixepoch('now');
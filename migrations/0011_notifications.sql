@@ -0,0 +1,17 @@
+-- Notifications pushed to users' open pages (Server-Sent Events) and kept so they can catch up later
+CREATE TABLE IF NOT EXISTS Notifications (
+    NotificationID INTEGER PRIMARY KEY,
+    Channel TEXT NOT NULL, -- 'user:<UserID>' for one user, 'musicians' for every musician
+    Kind TEXT NOT NULL,
+    Payload TEXT NOT NULL DEFAULT '{}', -- JSON
+    CreatedAt REAL NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_notifications_channel ON Notifications (Channel, NotificationID);
+
+-- The newest notification each user has seen
+CREATE TABLE IF NOT EXISTS NotificationReads (
+    UserID INTEGER PRIMARY KEY,
+    LastSeenID INTEGER NOT NULL DEFAULT 0,
+    FOREIGN KEY (UserID) REFERENCES Users(UserID)
+);
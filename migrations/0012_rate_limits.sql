@@ -0,0 +1,9 @@
+-- Token buckets for login and registration rate limits, shared by every server process
+CREATE TABLE IF NOT EXISTS RateLimits (
+    Key TEXT PRIMARY KEY, -- '<rule>:<IP address or username>'
+    Tokens REAL NOT NULL, -- Attempts left, refilled continuously since UpdatedAt
+    UpdatedAt REAL NOT NULL, -- Unix time of the last attempt
+    Granted INTEGER NOT NULL DEFAULT 1 -- Whether the last attempt was allowed
+);
+
+CREATE INDEX IF NOT EXISTS idx_rate_limits_updated ON RateLimits (UpdatedAt);
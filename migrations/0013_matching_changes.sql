@@ -0,0 +1,50 @@
+-- Log of the events and musicians whose matching features changed, so each server process can update its
+-- in-memory recommendation index row by row instead of rebuilding it (AUTOINCREMENT keeps IDs increasing even
+-- after old entries are pruned, so a process that fell behind the pruning can tell)
+CREATE TABLE IF NOT EXISTS MatchingChanges (
+    ChangeID INTEGER PRIMARY KEY AUTOINCREMENT,
+    Kind TEXT NOT NULL, -- 'event' or 'musician'
+    ItemID INTEGER NOT NULL, -- EventID or UserID
+    CreatedAt REAL NOT NULL DEFAULT ((julianday('now') - 2440587.5) * 86400.0) -- Unix time
+);
+
+CREATE INDEX IF NOT EXISTS idx_matching_changes_created ON MatchingChanges (CreatedAt);
+
+-- Events: their text, date and time, and whether they are still open
+CREATE TRIGGER IF NOT EXISTS matching_events_insert AFTER INSERT ON Events BEGIN
+    INSERT INTO MatchingChanges (Kind, ItemID) VALUES ('event', new.EventID);
+END;
+
+CREATE TRIGGER IF NOT EXISTS matching_events_update AFTER UPDATE OF Date, Time, Venue, Description, Status ON Events BEGIN
+    INSERT INTO MatchingChanges (Kind, ItemID) VALUES ('event', new.EventID);
+END;
+
+CREATE TRIGGER IF NOT EXISTS matching_events_delete AFTER DELETE ON Events BEGIN
+    INSERT INTO MatchingChanges (Kind, ItemID) VALUES ('event', old.EventID);
+END;
+
+-- Musicians: their profile text
+CREATE TRIGGER IF NOT EXISTS matching_users_insert AFTER INSERT ON Users WHEN new.UserType = 'musician' BEGIN
+    INSERT INTO MatchingChanges (Kind, ItemID) VALUES ('musician', new.UserID);
+END;
+
+CREATE TRIGGER IF NOT EXISTS matching_users_update AFTER UPDATE OF ProfileInformation, UserType ON Users BEGIN
+    INSERT INTO MatchingChanges (Kind, ItemID) VALUES ('musician', new.UserID);
+END;
+
+CREATE TRIGGER IF NOT EXISTS matching_users_delete AFTER DELETE ON Users WHEN old.UserType = 'musician' BEGIN
+    INSERT INTO MatchingChanges (Kind, ItemID) VALUES ('musician', old.UserID);
+END;
+
+-- Bookings: a musician's history (what and when they play) and the dates they are busy
+CREATE TRIGGER IF NOT EXISTS matching_bookings_insert AFTER INSERT ON Bookings BEGIN
+    INSERT INTO MatchingChanges (Kind, ItemID) VALUES ('musician', new.MusicianUserID);
+END;
+
+CREATE TRIGGER IF NOT EXISTS matching_bookings_update AFTER UPDATE OF Status ON Bookings BEGIN
+    INSERT INTO MatchingChanges (Kind, ItemID) VALUES ('musician', new.MusicianUserID);
+END;
+
+CREATE TRIGGER IF NOT EXISTS matching_bookings_delete AFTER DELETE ON Bookings BEGIN
+    INSERT INTO MatchingChanges (Kind, ItemID) VALUES ('musician', old.MusicianUserID);
+END;
@@ -0,0 +1,4 @@
+-- Renditions are named after the file they come from and shared by every gallery image of the same blob: find the
+-- images of a file (to reuse their renditions), and whether any image still uses a rendition file before deleting it
+CREATE INDEX IF NOT EXISTS idx_event_images_path ON EventImages (ImagePath);
+CREATE INDEX IF NOT EXISTS idx_renditions_path ON EventImageRenditions (Path);
@@ -0,0 +1,59 @@
+# Notifications sent to users outside the request cycle
+import smtplib
+from email.message import EmailMessage
+
+from flask import current_app
+
+from jobs import task
+
+
+def send_email(to, subject, body):
+    # Deliver through MAIL_SERVER when one is configured; otherwise only log the message
+    config = current_app.config
+    if not config.get('MAIL_SERVER'):
+        current_app.logger.info("Email to %s: %s", to, subject)
+        return
+
+    message = EmailMessage()
+    message['From'] = config.get('MAIL_FROM', 'noreply@crescendo.local')
+    message['To'] = to
+    message['Subject'] = subject
+    message.set_content(body)
+    with smtplib.SMTP(config['MAIL_SERVER'], config.get('MAIL_PORT', 25), timeout=30) as smtp:
+        if config.get('MAIL_USE_TLS'):
+            smtp.starttls()
+        if config.get('MAIL_USERNAME'):
+            smtp.login(config['MAIL_USERNAME'], config.get('MAIL_PASSWORD', ''))
+        smtp.send_message(message)
+
+
+def user_emails(conn, user_ids):
+    if not user_ids:
+        return []
+    placeholders = ",".join("?" * len(user_ids))
+    return [row[0] for row in conn.execute(f"SELECT Email FROM Users WHERE UserID IN ({placeholders})",
+                                           list(user_ids))]
+
+
+# Queued by delete_event: tell every musician booked for the event that it was cancelled
+@task('notify_event_cancelled')
+def notify_event_cancelled(conn, message, musician_ids):
+    for email in user_emails(conn, musician_ids):
+        send_email(email, "Crescendo event cancelled", message)
+
+
+# Queued by apply_for_event: tell the organizer a musician has taken their event
+@task('notify_booking_confirmed')
+def notify_booking_confirmed(conn, event_id, musician_id):
+    row = conn.execute("""
+        SELECT e.Date, e.Time, e.Venue, o.Email, m.Username
+        FROM Events e
+        JOIN Users o ON o.UserID = e.OrganizerUserID
+        JOIN Users m ON m.UserID = ?
+        WHERE e.EventID = ?
+    """, (musician_id, event_id)).fetchone()
+    if row is None:
+        return
+    date, time, venue, organizer_email, musician = row
+    send_email(organizer_email, "Crescendo booking confirmed",
+               f"{musician} will perform at {venue} on {date} at {time}.")
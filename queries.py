@@ -0,0 +1,210 @@
+# Shared, paginated queries for the pages and the JSON API
+import base64
+import json
+
+# Number of rows per dashboard page
+PAGE_SIZE = 20
+
+# Number of images per gallery page
+GALLERY_PAGE_SIZE = 24
+
+# Deepest gallery page reachable by number; deeper OFFSETs only get slower (and huge ones overflow SQLite's integers)
+MAX_GALLERY_PAGE = 1000
+
+
+def encode_cursor(values):
+    # Opaque token for the sort key of the last row on a page
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode().rstrip('=')
+
+
+def decode_cursor(token, size):
+    # The sort key a token holds, as a list of size strings or integers. Returns None for a missing or malformed
+    # token (anything else could reach the query bindings), so callers start from the first page
+    if not token:
+        return None
+    try:
+        values = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+    except ValueError:
+        return None
+    if not isinstance(values, list) or len(values) != size:
+        return None
+    for value in values:
+        if isinstance(value, bool) or not isinstance(value, (str, int)):
+            return None
+        if isinstance(value, int) and not -2 ** 63 <= value < 2 ** 63:
+            return None
+    return values
+
+
+def event_filters(date_from=None, date_to=None, venue=None):
+    # Build the extra WHERE clauses shared by both dashboard lists
+    clauses, params = [], []
+    if date_from:
+        clauses.append("e.Date >= ?")
+        params.append(date_from)
+    if date_to:
+        clauses.append("e.Date <= ?")
+        params.append(date_to)
+    if venue:
+        clauses.append("e.Venue = ? COLLATE NOCASE")
+        params.append(venue)
+    return clauses, params
+
+
+def paginate(cursor, sql, params, limit, key_columns=3, model=None):
+    # Fetch one row more than needed to learn whether another page exists; the last key_columns
+    # columns of each row are its sort key (by default (Date, Time, EventID)). limit=None fetches every row.
+    # With a model (a rendering.ViewModel class), rows come back as model instances instead of tuples.
+    cursor.execute(sql, params + [-1 if limit is None else limit + 1])
+    rows = cursor.fetchall()
+    next_cursor = None
+    if limit is not None and len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(list(rows[-1][-key_columns:]))
+    if model is not None:
+        # A view model takes the columns it names and ignores the sort key after them, so no tuple is sliced
+        return [model(*row) for row in rows], next_cursor
+    return [row[:-key_columns] for row in rows], next_cursor
+
+
+def available_events(cursor, after=None, limit=PAGE_SIZE, model=None, **filters):
+    # Pending events in date order, one keyset page at a time
+    # Rows: (EventID, Date, Time, Venue, Description, Status, OrganizerName)
+    clauses, params = event_filters(**filters)
+    key = decode_cursor(after, 3)
+    if key:
+        clauses.append("(e.Date, e.Time, e.EventID) > (?, ?, ?)")
+        params.extend(key)
+    where = "".join(" AND " + clause for clause in clauses)
+    return paginate(cursor, f"""
+        SELECT e.EventID, e.Date, e.Time, e.Venue, e.Description, e.Status, u.Username AS OrganizerName,
+               e.Date, e.Time, e.EventID
+        FROM Events e
+        LEFT JOIN Users u ON u.UserID = e.OrganizerUserID
+        WHERE e.Status = 'pending'{where}
+        ORDER BY e.Date, e.Time, e.EventID
+        LIMIT ?
+    """, params, limit, model=model)
+
+
+def confirmed_events(cursor, musician_id, after=None, limit=PAGE_SIZE, model=None, **filters):
+    # A musician's confirmed bookings in date order, one keyset page at a time
+    # Rows: (EventID, Date, Time, Venue, Description, OrganizerName)
+    clauses, params = event_filters(**filters)
+    params.insert(0, musician_id)
+    key = decode_cursor(after, 3)
+    if key:
+        clauses.append("(e.Date, e.Time, e.EventID) > (?, ?, ?)")
+        params.extend(key)
+    where = "".join(" AND " + clause for clause in clauses)
+    return paginate(cursor, f"""
+        SELECT e.EventID, e.Date, e.Time, e.Venue, e.Description, u.Username AS OrganizerName,
+               e.Date, e.Time, e.EventID
+        FROM Bookings b
+        JOIN Events e ON e.EventID = b.EventID
+        LEFT JOIN Users u ON u.UserID = e.OrganizerUserID
+        WHERE b.MusicianUserID = ? AND b.Status = 'confirmed'{where}
+        ORDER BY e.Date, e.Time, e.EventID
+        LIMIT ?
+    """, params, limit, model=model)
+
+
+def organization_bookings(cursor, organizer_id, after=None, limit=PAGE_SIZE, model=None):
+    # An organization's events with their confirmed musician, in date order
+    # Rows: (EventID, Date, Time, Venue, Description, MusicianUserID, MusicianName)
+    clauses, params = [], [organizer_id]
+    key = decode_cursor(after, 3)
+    if key:
+        clauses.append("(e.Date, e.Time, e.EventID) > (?, ?, ?)")
+        params.extend(key)
+    where = "".join(" AND " + clause for clause in clauses)
+    return paginate(cursor, f"""
+        SELECT e.EventID, e.Date, e.Time, e.Venue, e.Description, u.UserID, u.Username,
+               e.Date, e.Time, e.EventID
+        FROM Events e
+        JOIN Bookings b ON e.EventID = b.EventID AND b.Status = 'confirmed'
+        JOIN Users u ON b.MusicianUserID = u.UserID
+        WHERE e.OrganizerUserID = ?{where}
+        ORDER BY e.Date, e.Time, e.EventID
+        LIMIT ?
+    """, params, limit, model=model)
+
+
+def events_by_id(cursor, event_ids):
+    # Events in the order of event_ids (e.g. a ranking); IDs that no longer exist are skipped
+    # Rows: (EventID, Date, Time, Venue, Description, Status, OrganizerName)
+    if not event_ids:
+        return []
+    cursor.execute(f"""
+        SELECT e.EventID, e.Date, e.Time, e.Venue, e.Description, e.Status, u.Username
+        FROM Events e
+        LEFT JOIN Users u ON u.UserID = e.OrganizerUserID
+        WHERE e.EventID IN ({",".join("?" * len(event_ids))})
+    """, list(event_ids))
+    rows = {row[0]: row for row in cursor.fetchall()}
+    return [rows[event_id] for event_id in event_ids if event_id in rows]
+
+
+def organization_requests(cursor, organizer_id, date_from):
+    # An organization's events still waiting for a musician, from date_from on, in date order
+    # Rows: (EventID, Date, Time, Venue, Description)
+    cursor.execute("""
+        SELECT EventID, Date, Time, Venue, Description
+        FROM Events
+        WHERE OrganizerUserID = ? AND Status = 'pending' AND Date >= ?
+        ORDER BY Date, Time, EventID
+    """, (organizer_id, date_from))
+    return cursor.fetchall()
+
+
+def usernames(cursor, user_ids):
+    # {UserID: Username} for the given users
+    if not user_ids:
+        return {}
+    cursor.execute(f"SELECT UserID, Username FROM Users WHERE UserID IN ({','.join('?' * len(user_ids))})",
+                   list(user_ids))
+    return dict(cursor.fetchall())
+
+
+def event_detail(cursor, event_id):
+    # One event, or None
+    # Row: (EventID, Date, Time, Venue, Description, Status, OrganizerName)
+    cursor.execute("""
+        SELECT e.EventID, e.Date, e.Time, e.Venue, e.Description, e.Status, u.Username
+        FROM Events e
+        LEFT JOIN Users u ON u.UserID = e.OrganizerUserID
+        WHERE e.EventID = ?
+    """, (event_id,))
+    return cursor.fetchone()
+
+
+def user_profile(cursor, user_id):
+    # A user's public profile, or None
+    # Row: (Username, Email, UserType, ProfileInformation)
+    cursor.execute("SELECT Username, Email, UserType, ProfileInformation FROM Users WHERE UserID = ?", (user_id,))
+    return cursor.fetchone()
+
+
+def gallery_images(cursor, venue=None, page=1, after=None, limit=GALLERY_PAGE_SIZE):
+    # Newest gallery images first, either by page number or (with a cursor) one keyset page after another
+    # Rows: (ImagePath, Date, Venue, MusicianName, ImageID, Width, Height)
+    clauses, params = [], []
+    if venue:
+        clauses.append("e.Venue = ? COLLATE NOCASE")
+        params.append(venue)
+    key = decode_cursor(after, 1)
+    offset = 0
+    if key:
+        clauses.append("ei.ImageID < ?")
+        params.extend(key)
+    else:
+        offset = (min(page, MAX_GALLERY_PAGE) - 1) * limit
+    where = " WHERE " + " AND ".join(clauses) if clauses else ""
+    return paginate(cursor, f"""
+        SELECT ei.ImagePath, e.Date, e.Venue, u.Username, ei.ImageID, ei.Width, ei.Height, ei.ImageID
+        FROM EventImages ei
+        JOIN Events e ON ei.EventID = e.EventID
+        JOIN Users u ON ei.MusicianUserID = u.UserID{where}
+        ORDER BY ei.ImageID DESC
+        LIMIT ? OFFSET {int(offset)}
+    """, params, limit, key_columns=1)
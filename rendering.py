@@ -0,0 +1,122 @@
+# Page rendering: templates compiled once per deploy, dashboard rows as small view models, per-user dashboard
+# fragments in the fragment cache, and compressed HTML responses
+import gzip
+import os
+
+from flask import request
+from jinja2 import FileSystemBytecodeCache
+from markupsafe import Markup
+
+import cache
+
+# Brotli is optional; without it responses are gzipped
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Responses of these types, at least COMPRESS_MIN_SIZE bytes long, are compressed when the client accepts it
+COMPRESS_MIMETYPES = {'text/html', 'application/json'}
+COMPRESS_MIN_SIZE = 500
+
+# Fast levels: the pages are dynamic and compressed on every request
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 4
+
+
+# A row of a rendered list, with named attributes instead of tuple indexes. The slots are the leading columns of the
+# query row (trailing columns such as a pagination sort key are ignored), so one is built straight from a cursor row.
+class ViewModel:
+    __slots__ = ()
+
+    def __init__(self, *values):
+        for name, value in zip(self.__slots__, values):
+            setattr(self, name, value)
+
+    def __repr__(self):
+        fields = ", ".join(f"{name}={getattr(self, name)!r}" for name in self.__slots__)
+        return f"{type(self).__name__}({fields})"
+
+
+# queries.available_events
+class AvailableEvent(ViewModel):
+    __slots__ = ('event_id', 'date', 'time', 'venue', 'description', 'status', 'organizer')
+
+
+# queries.confirmed_events
+class ConfirmedEvent(ViewModel):
+    __slots__ = ('event_id', 'date', 'time', 'venue', 'description', 'organizer')
+
+
+# queries.organization_bookings
+class OrganizationBooking(ViewModel):
+    __slots__ = ('event_id', 'date', 'time', 'venue', 'description', 'musician_id', 'musician')
+
+
+# queries.organization_requests, plus the musicians suggested for the event as (UserID, Username) pairs
+class OpenRequest(ViewModel):
+    __slots__ = ('event_id', 'date', 'time', 'venue', 'description', 'suggestions')
+
+
+# feed.unread
+class Notification(ViewModel):
+    __slots__ = ('notification_id', 'kind', 'message')
+
+    def __init__(self, notification_id, kind, payload):
+        super().__init__(notification_id, kind, payload.get('message', ''))
+
+
+def fragment(key, render):
+    # The HTML cached under key, or render() cached for the next request; keys carry the generations of the data
+    # the fragment shows, so a stale fragment is never found
+    fragment_cache = cache.get_cache()
+    html = fragment_cache.get(key)
+    if html is None:
+        html = render()
+        fragment_cache.set(key, html)
+    return Markup(html)
+
+
+def dashboard_key(conn, section, user_id=None, filters=None):
+    # Cache key of a dashboard section. A user's own lists (user_id given) change with their bookings and events,
+    # the shared list of available events with any event; both show usernames, so renames invalidate them too.
+    names = ['users', cache.user_scope(user_id) if user_id is not None else 'events']
+    versions = ":".join(str(generation) for generation in cache.generations(conn, names))
+    filter_values = "|".join(value or '' for value in (filters or {}).values())
+    return f"dashboard:{section}:{user_id or ''}:{versions}:{filter_values}"
+
+
+def compress_response(response):
+    # gzip (or Brotli, when installed and preferred) text responses for clients that accept it. Streams (e.g.
+    # Server-Sent Events) and files handed to the server are left alone.
+    if (response.status_code != 200 or response.direct_passthrough or response.is_streamed
+            or response.mimetype not in COMPRESS_MIMETYPES or 'Content-Encoding' in response.headers):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = request.accept_encodings.best_match(['br', 'gzip'] if brotli is not None else ['gzip'])
+    if encoding is None:
+        return response
+    data = response.get_data()
+    if len(data) < COMPRESS_MIN_SIZE:
+        return response
+
+    if encoding == 'br':
+        response.set_data(brotli.compress(data, quality=BROTLI_QUALITY))
+    else:
+        response.set_data(gzip.compress(data, compresslevel=GZIP_LEVEL, mtime=0))
+    response.headers['Content-Encoding'] = encoding
+    # The compressed bytes are another representation of the same resource: its ETag becomes weak, which
+    # If-None-Match still matches (so API 304s keep working)
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+
+def init_app(app):
+    # Keep compiled templates on disk so each worker (and each restart) loads them instead of recompiling
+    directory = app.config.get('TEMPLATE_CACHE_DIR') or os.path.join(app.instance_path, 'jinja_cache')
+    os.makedirs(directory, exist_ok=True)
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(directory)
+    if app.config.get('COMPRESS_RESPONSES', True):
+        app.after_request(compress_response)
@@ -0,0 +1,65 @@
+# Ranked full-text search over events and profiles (FTS5 indexes from migration 0007)
+import re
+
+# Number of results per search page
+PAGE_SIZE = 20
+
+# Largest offset SQLite accepts; deeper pages are simply past the last result
+MAX_OFFSET = 2 ** 63 - 1
+
+# Words in the query; everything else (quotes, operators, punctuation) is dropped
+TOKEN = re.compile(r"\w+", re.UNICODE)
+
+
+def match_expression(query):
+    # Turn free text into an FTS5 query: every word must match, and the last one may be a prefix
+    # (so "jaz quar" finds "jazz quartet" as the user types)
+    words = TOKEN.findall(query.lower())[:8]
+    if not words:
+        return None
+    terms = [f'"{word}"' for word in words[:-1]]
+    terms.append(f'"{words[-1]}"*')
+    return " ".join(terms)
+
+
+def page_offset(page, limit):
+    # Rows to skip for a page, capped where SQLite's integers end (a page that far out is empty either way)
+    return min((max(page, 1) - 1) * limit, MAX_OFFSET)
+
+
+def search_events(cursor, query, page=1, status='pending', limit=PAGE_SIZE):
+    # Events whose description or venue match, best first (venue matches weigh double)
+    # Rows: (EventID, Date, Time, Venue, Description, Status, OrganizerName)
+    expression = match_expression(query)
+    if expression is None:
+        return [], False
+    # Every match is ranked (newest first among equal scores), so the best ones are found however old they are
+    cursor.execute("""
+        SELECT e.EventID, e.Date, e.Time, e.Venue, e.Description, e.Status, u.Username
+        FROM EventsSearch
+        JOIN Events e ON e.EventID = EventsSearch.rowid
+        LEFT JOIN Users u ON u.UserID = e.OrganizerUserID
+        WHERE EventsSearch MATCH ? AND (? IS NULL OR e.Status = ?)
+        ORDER BY bm25(EventsSearch, 1.0, 2.0), e.EventID DESC
+        LIMIT ? OFFSET ?
+    """, (expression, status, status, limit + 1, page_offset(page, limit)))
+    rows = cursor.fetchall()
+    return rows[:limit], len(rows) > limit
+
+
+def search_users(cursor, query, page=1, user_type='musician', limit=PAGE_SIZE):
+    # Profiles whose username or profile text match, best first (username matches weigh most)
+    # Rows: (UserID, Username, UserType, ProfileInformation)
+    expression = match_expression(query)
+    if expression is None:
+        return [], False
+    cursor.execute("""
+        SELECT u.UserID, u.Username, u.UserType, u.ProfileInformation
+        FROM UsersSearch
+        JOIN Users u ON u.UserID = UsersSearch.rowid
+        WHERE UsersSearch MATCH ? AND (? IS NULL OR u.UserType = ?)
+        ORDER BY bm25(UsersSearch, 4.0, 1.0), u.UserID DESC
+        LIMIT ? OFFSET ?
+    """, (expression, user_type, user_type, limit + 1, page_offset(page, limit)))
+    rows = cursor.fetchall()
+    return rows[:limit], len(rows) > limit
@@ -0,0 +1,214 @@
+# Server-side sessions: the cookie only carries a signed session ID, the data lives in crescendo.db
+# (or in a cachelib store shared by the workers on one host)
+import os
+import random
+import secrets
+import time
+
+import click
+from flask import current_app, g
+from flask.cli import AppGroup
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+from itsdangerous import BadSignature, Signer
+from werkzeug.datastructures import CallbackDict
+
+from db import connect, get_db, get_pool, write_transaction
+
+# Roughly one request in this many also deletes expired sessions
+CLEANUP_EVERY = 1000
+
+# Connections kept for session writes, apart from the requests' own
+WRITE_CONNECTIONS = 2
+
+
+# Session data plus the bookkeeping needed to avoid needless writes
+class ServerSession(CallbackDict, SessionMixin):
+    def __init__(self, initial=None, sid=None, new=False):
+        def on_update(session):
+            session.modified = True
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.modified = False
+
+
+# Stores sessions as JSON rows in the Sessions table
+class SqliteSessionStore:
+    def _write(self, sql, parameters):
+        # Writes go through a connection of their own, so saving a session never commits (or rolls back) what the
+        # view left on the request's connection
+        pool = get_pool(name='session_pool', size=WRITE_CONNECTIONS)
+        conn = pool.acquire()
+        try:
+            return write_transaction(conn, lambda conn: conn.execute(sql, parameters).rowcount)
+        finally:
+            pool.release(conn)
+
+    def load(self, sid):
+        row = get_db().execute("SELECT Data FROM Sessions WHERE SessionID = ? AND Expiry > ?",
+                               (sid, time.time())).fetchone()
+        return row[0] if row else None
+
+    def save(self, sid, data, user_id, expiry):
+        self._write("""
+            INSERT INTO Sessions (SessionID, UserID, Data, Expiry) VALUES (?, ?, ?, ?)
+            ON CONFLICT (SessionID) DO UPDATE SET UserID = excluded.UserID, Data = excluded.Data, Expiry = excluded.Expiry
+        """, (sid, user_id, data, expiry))
+
+    def delete(self, sid):
+        self._write("DELETE FROM Sessions WHERE SessionID = ?", (sid,))
+
+    def forget_key(self, user_id, key):
+        # Drop one cached value from every session of a user (e.g. after their profile changes)
+        self._write("UPDATE Sessions SET Data = json_remove(Data, ?) WHERE UserID = ?", ('$.' + key, user_id))
+
+    def cleanup(self, conn=None):
+        sql, parameters = "DELETE FROM Sessions WHERE Expiry <= ?", (time.time(),)
+        if conn is not None:
+            return write_transaction(conn, lambda conn: conn.execute(sql, parameters).rowcount)
+        return self._write(sql, parameters)
+
+
+# Stores sessions in a cachelib cache, e.g. a FileSystemCache directory shared by the workers on one host
+class CacheSessionStore:
+    def __init__(self, cache):
+        self.cache = cache
+
+    def load(self, sid):
+        return self.cache.get('session:' + sid)
+
+    def save(self, sid, data, user_id, expiry):
+        self.cache.set('session:' + sid, data, timeout=max(int(expiry - time.time()), 1))
+
+    def delete(self, sid):
+        self.cache.delete('session:' + sid)
+
+    def forget_key(self, user_id, key):
+        # The cache can't be searched by user; other sessions keep their copy until they expire
+        pass
+
+    def cleanup(self, conn=None):
+        # cachelib expires entries by itself
+        return 0
+
+
+class ServerSessionInterface(SessionInterface):
+    serializer = TaggedJSONSerializer()
+
+    def __init__(self, store):
+        self.store = store
+
+    def _signer(self, app):
+        return Signer(app.secret_key, salt='crescendo-session')
+
+    def open_session(self, app, request):
+        # Look up the session named by the (signed) cookie; anything invalid or expired starts a new one
+        cookie = request.cookies.get(self.get_cookie_name(app))
+        if cookie:
+            try:
+                sid = self._signer(app).unsign(cookie).decode()
+            except BadSignature:
+                sid = None
+            if sid:
+                data = self.store.load(sid)
+                if data is not None:
+                    return ServerSession(self.serializer.loads(data), sid=sid)
+        return ServerSession(sid=secrets.token_urlsafe(32), new=True)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        # Whatever a view left uncommitted belongs to a failed request and is rolled back when its connection goes
+        # back to the pool; drop it now, so it doesn't hold the write lock the session writes below wait for
+        conn = g.get('db')
+        if conn is not None and conn.in_transaction:
+            conn.rollback()
+
+        # An emptied session (e.g. after logout) is removed from the store along with its cookie
+        if not session:
+            if session.modified and not session.new:
+                self.store.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+
+        # Only write when something changed, so ordinary page views cost no session writes
+        if session.modified:
+            expiry = time.time() + app.permanent_session_lifetime.total_seconds()
+            self.store.save(session.sid, self.serializer.dumps(dict(session)), session.get('user_id'), expiry)
+            if random.randrange(CLEANUP_EVERY) == 0:
+                self.store.cleanup()
+
+        if session.new and session.modified or self.should_set_cookie(app, session):
+            response.set_cookie(name, self._signer(app).sign(session.sid).decode(),
+                                expires=self.get_expiration_time(app, session), httponly=self.get_cookie_httponly(app),
+                                domain=domain, path=path, secure=self.get_cookie_secure(app),
+                                samesite=self.get_cookie_samesite(app))
+        response.vary.add('Cookie')
+
+    def regenerate(self, session):
+        # Give the session a fresh ID (on login), so an ID seen before authentication can't be reused after it
+        if not session.new:
+            self.store.delete(session.sid)
+        session.sid = secrets.token_urlsafe(32)
+        session.new = True
+        session.modified = True
+
+
+def load_secret_key(app):
+    # A key that is the same in every worker and survives restarts: CRESCENDO_SECRET_KEY if set, otherwise a key
+    # generated once and kept in the instance folder
+    key = os.environ.get('CRESCENDO_SECRET_KEY')
+    if key:
+        return key
+
+    os.makedirs(app.instance_path, exist_ok=True)
+    path = os.path.join(app.instance_path, 'secret_key')
+    try:
+        # O_EXCL makes exactly one worker create the file; the others read what it wrote
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        for _ in range(50):
+            with open(path) as f:
+                key = f.read().strip()
+            if key:
+                return key
+            time.sleep(0.01)
+        raise RuntimeError(f"{path} is empty")
+    key = secrets.token_hex(32)
+    with os.fdopen(fd, 'w') as f:
+        f.write(key)
+    return key
+
+
+def get_store(app=None):
+    return (app or current_app).session_interface.store
+
+
+# `flask sessions ...` commands
+sessions_cli = AppGroup('sessions', help="Manage server-side sessions.")
+
+
+@sessions_cli.command('cleanup')
+def cleanup_command():
+    """Delete expired sessions."""
+    conn = connect(current_app.config['DATABASE'])
+    try:
+        click.echo(f"Deleted {get_store().cleanup(conn)} expired sessions")
+    finally:
+        conn.close()
+
+
+def init_app(app):
+    app.secret_key = load_secret_key(app)
+
+    # SESSION_BACKEND: 'sqlite' (default, shared by every worker using the database) or 'cachelib' (SESSION_DIR)
+    if app.config.get('SESSION_BACKEND', 'sqlite') == 'cachelib':
+        from cachelib import FileSystemCache
+        store = CacheSessionStore(FileSystemCache(app.config.get('SESSION_DIR') or os.path.join(app.instance_path, 'sessions')))
+    else:
+        store = SqliteSessionStore()
+    app.session_interface = ServerSessionInterface(store)
+    app.cli.add_command(sessions_cli)
@@ -0,0 +1,195 @@
+# Content-addressed storage for uploaded files
+import hashlib
+import os
+import sqlite3
+import tempfile
+
+from flask import current_app, url_for
+
+# boto3 is only needed for the S3 backend
+try:
+    import boto3
+    from botocore.exceptions import ClientError
+except ImportError:
+    boto3 = None
+
+# Uploads are read and hashed in chunks of this size, never as a whole
+CHUNK_SIZE = 64 * 1024
+
+# Blobs are stored as uploads/blobs/<first two hex digits>/<sha256>.<extension>
+BLOBS_PREFIX = 'uploads/blobs'
+
+
+def blob_path(digest, extension):
+    return f"{BLOBS_PREFIX}/{digest[:2]}/{digest}.{extension}"
+
+
+def copy_hashed(stream, target):
+    # Copy a stream into an open file chunk by chunk and return (sha256 hex digest, size)
+    digest = hashlib.sha256()
+    size = 0
+    while True:
+        chunk = stream.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        digest.update(chunk)
+        target.write(chunk)
+        size += len(chunk)
+    return digest.hexdigest(), size
+
+
+# Files on the local disk, under the Flask static folder (the default backend)
+class LocalStorage:
+    def __init__(self, root):
+        self.root = root
+        # Uploads are spooled here; created once rather than on every save
+        os.makedirs(self._full_path(BLOBS_PREFIX + '/tmp'), exist_ok=True)
+
+    def _full_path(self, path):
+        return os.path.join(self.root, *path.split('/'))
+
+    def save(self, stream, extension):
+        # Stream into a temporary file next to the blobs, then move it into place under its hash; the temporary file
+        # is removed if anything on the way fails (e.g. the client disconnects mid-upload or the disk fills up).
+        # Returns (path, digest, size, whether the file is new).
+        tmp = tempfile.NamedTemporaryFile(dir=self._full_path(BLOBS_PREFIX + '/tmp'), delete=False)
+        try:
+            with tmp:
+                digest, size = copy_hashed(stream, tmp)
+
+            path = blob_path(digest, extension)
+            full_path = self._full_path(path)
+            created = not os.path.exists(full_path)
+            if created:
+                os.makedirs(os.path.dirname(full_path), exist_ok=True)
+                os.replace(tmp.name, full_path)
+            else:
+                os.remove(tmp.name)
+        except BaseException:
+            try:
+                os.unlink(tmp.name)
+            except FileNotFoundError:
+                pass
+            raise
+        return path, digest, size, created
+
+    def write(self, path, data):
+        full_path = self._full_path(path)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        with open(full_path, 'wb') as f:
+            f.write(data)
+
+    def open(self, path):
+        return open(self._full_path(path), 'rb')
+
+    def exists(self, path):
+        return os.path.exists(self._full_path(path))
+
+    def delete(self, path):
+        try:
+            os.remove(self._full_path(path))
+        except FileNotFoundError:
+            pass
+
+    def url(self, path):
+        # Uploads go through the uploaded_file route, which sets the caching headers
+        if path.startswith('uploads/'):
+            return url_for('uploaded_file', filename=path[len('uploads/'):])
+        return url_for('static', filename=path)
+
+
+# Objects in an S3-compatible bucket (AWS, or a local stand-in such as MinIO via S3_ENDPOINT_URL)
+class S3Storage:
+    def __init__(self, bucket, endpoint_url=None, public_url=None, client=None):
+        if client is None and boto3 is None:
+            raise RuntimeError("The S3 storage backend requires boto3")
+        self.bucket = bucket
+        self.client = client or boto3.client('s3', endpoint_url=endpoint_url)
+        self.public_url = (public_url or f"{endpoint_url or 'https://s3.amazonaws.com'}/{bucket}").rstrip('/')
+
+    def save(self, stream, extension):
+        # Hash while spooling to a temporary file (memory up to 1 MB, then disk), and skip the upload
+        # entirely when an object with the same hash already exists
+        with tempfile.SpooledTemporaryFile(max_size=1024 * 1024) as tmp:
+            digest, size = copy_hashed(stream, tmp)
+            path = blob_path(digest, extension)
+            created = not self.exists(path)
+            if created:
+                tmp.seek(0)
+                self.client.upload_fileobj(tmp, self.bucket, path)
+        return path, digest, size, created
+
+    def write(self, path, data):
+        self.client.put_object(Bucket=self.bucket, Key=path, Body=data)
+
+    def open(self, path):
+        # Download to a spooled temporary file so large objects don't sit in memory
+        tmp = tempfile.SpooledTemporaryFile(max_size=1024 * 1024)
+        self.client.download_fileobj(self.bucket, path, tmp)
+        tmp.seek(0)
+        return tmp
+
+    def exists(self, path):
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=path)
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+        return True
+
+    def delete(self, path):
+        self.client.delete_object(Bucket=self.bucket, Key=path)
+
+    def url(self, path):
+        return f"{self.public_url}/{path}"
+
+
+def get_storage(app=None):
+    # The configured backend, created once per application
+    app = app or current_app
+    storage = app.extensions.get('storage')
+    if storage is None:
+        if app.config.get('STORAGE_BACKEND', 'local') == 's3':
+            storage = S3Storage(app.config['S3_BUCKET'], app.config.get('S3_ENDPOINT_URL'),
+                                app.config.get('S3_PUBLIC_URL'))
+        else:
+            storage = LocalStorage(app.static_folder)
+        app.extensions['storage'] = storage
+    return storage
+
+
+def store_upload(conn, stream, extension, storage=None):
+    # Store an upload under its content hash and take a reference to the blob; the caller commits. Returns (path,
+    # whether this call created the file): if the caller then rolls back, it must delete a file it created, since
+    # without a Blobs row nothing else ever will.
+    storage = storage or get_storage()
+    path, digest, size, created = storage.save(stream, extension)
+    try:
+        stored_path = conn.execute("""
+            INSERT INTO Blobs (Hash, Path, Size, RefCount) VALUES (?, ?, ?, 1)
+            ON CONFLICT (Hash) DO UPDATE SET RefCount = RefCount + 1
+            RETURNING Path
+        """, (digest, path, size)).fetchone()[0]
+    except sqlite3.Error:
+        if created:
+            storage.delete(path)
+        raise
+
+    # The same bytes were stored before under another extension; keep only the first copy
+    if stored_path != path:
+        if created:
+            storage.delete(path)
+        return stored_path, False
+    return stored_path, created
+
+
+def release_blob(conn, path):
+    # Drop one reference to a blob; returns True when nothing refers to it any more, in which case the
+    # caller deletes the file with get_storage().delete(path) after committing
+    conn.execute("UPDATE Blobs SET RefCount = RefCount - 1 WHERE Path = ? AND RefCount > 0", (path,))
+    row = conn.execute("SELECT RefCount FROM Blobs WHERE Path = ?", (path,)).fetchone()
+    if row is not None and row[0] == 0:
+        conn.execute("DELETE FROM Blobs WHERE Path = ?", (path,))
+        return True
+    return False